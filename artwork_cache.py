@@ -0,0 +1,275 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from pyatv import interface
+
+import config
+from config_file import on_config_reload
+from log import get_logger
+from metrics import ARTWORK_CACHE_EVICTIONS, ARTWORK_CACHE_REQUESTS, ARTWORK_FETCH_SECONDS, Gauge
+from utils import s_if_plural
+
+
+# Artwork files in the disk tier are named by a hash of their key, and start with a JSON header line (see: encode_artwork())
+ARTWORK_FILE_EXTENSION: str = '.artwork'
+
+# The size counted for each cached item on top of its artwork bytes, so that items without artwork are bounded too
+ENTRY_OVERHEAD_BYTES: int = 256
+
+logger = get_logger()
+
+
+def get_artwork_key(content_identifier: Optional[str], title: Optional[str] = None, artist: Optional[str] = None,
+                    album: Optional[str] = None) -> Optional[str]:
+    """Return the cache key of what is playing: its content identifier, or else its title, artist, and album, or None if
+    none of them are known (so its artwork cannot be told apart from that of other content)"""
+    if content_identifier:
+        return content_identifier
+    if title or artist or album:
+        return '{0}|{1}|{2}'.format(title or '', artist or '', album or '')
+    return None
+
+
+def get_entry_size(artwork: Optional[interface.ArtworkInfo]) -> int:
+    return ENTRY_OVERHEAD_BYTES + (len(artwork.bytes) if artwork else 0)
+
+
+def encode_artwork(key: str, artwork: interface.ArtworkInfo) -> bytes:
+    header = {'key': key, 'mimetype': artwork.mimetype,
+              'width': artwork.width, 'height': artwork.height}
+    return json.dumps(header).encode() + b'\n' + artwork.bytes
+
+
+def decode_artwork(data: bytes) -> interface.ArtworkInfo:
+    header_line, artwork_bytes = data.split(b'\n', 1)
+    header = json.loads(header_line)
+    return interface.ArtworkInfo(artwork_bytes, header['mimetype'], header['width'], header['height'])
+
+
+class ArtworkCache:
+    """Least recently used cache of now-playing artwork, keyed by content (see: get_artwork_key())
+
+    The memory tier holds up to max_bytes of artwork. With a directory, artwork is also written to a disk tier of up to
+    disk_max_bytes, which outlives restarts and items evicted from memory. Content without artwork is cached (in memory
+    only) too, so that it is not requested again.
+
+    get() only calls the fetch function (which requests the artwork from the device) on a miss in both tiers, and
+    concurrent get() calls for the same key share a single fetch. Disk reads and writes run in a thread, so they never
+    block the event loop."""
+    max_bytes: int
+    directory: str
+    disk_max_bytes: int
+
+    hit_count: int = 0
+    disk_hit_count: int = 0
+    miss_count: int = 0
+    coalesced_count: int = 0
+    failure_count: int = 0
+    eviction_count: int = 0
+
+    def __init__(self, max_bytes: int = config.ARTWORK_CACHE_MAX_BYTES, directory: str = config.ARTWORK_CACHE_DIRECTORY,
+                 disk_max_bytes: int = config.ARTWORK_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        # Least recently used first
+        self._items: OrderedDict[str, Optional[interface.ArtworkInfo]] = OrderedDict()
+        self._size = 0
+        # The size of each artwork file in the disk tier, by file name, least recently used first
+        self._disk_files: OrderedDict[str, int] = OrderedDict()
+        self._disk_size = 0
+        self._in_flight: dict[str, asyncio.Future] = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_files()
+
+    @property
+    def size(self) -> int:
+        """The total size of the items in the memory tier, in bytes"""
+        return self._size
+
+    @property
+    def disk_size(self) -> int:
+        """The total size of the files in the disk tier, in bytes"""
+        return self._disk_size
+
+    def _load_disk_files(self):
+        """Index the artwork files left by a previous run, ordered by when they were last used"""
+        file_stats = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(ARTWORK_FILE_EXTENSION):
+                stat = os.stat(os.path.join(self.directory, file_name))
+                file_stats.append((stat.st_mtime, file_name, stat.st_size))
+        for _, file_name, file_size in sorted(file_stats):
+            self._disk_files[file_name] = file_size
+            self._disk_size += file_size
+        if self._disk_files:
+            logger.info('Found %d cached artwork file%s (%d bytes)', len(self._disk_files),
+                        s_if_plural(len(self._disk_files)), self._disk_size)
+
+    def _get_file_name(self, key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest() + ARTWORK_FILE_EXTENSION
+
+    def peek(self, key: str) -> Optional[interface.ArtworkInfo]:
+        """Return the artwork in the memory tier for key, or None if it is not there (or has no artwork), without fetching"""
+        if key in self._items:
+            self._items.move_to_end(key)
+        return self._items.get(key)
+
+    def _put(self, key: str, artwork: Optional[interface.ArtworkInfo]):
+        """Add the item to the memory tier, then evict the least recently used items while it is larger than max_bytes"""
+        if key in self._items:
+            self._size -= get_entry_size(self._items.pop(key))
+        self._items[key] = artwork
+        self._size += get_entry_size(artwork)
+        while self._size > self.max_bytes and len(self._items) > 1:
+            _, evicted_artwork = self._items.popitem(last=False)
+            self._size -= get_entry_size(evicted_artwork)
+            self.eviction_count += 1
+            ARTWORK_CACHE_EVICTIONS.inc('memory')
+
+    def _read_file(self, file_name: str) -> bytes:
+        path = os.path.join(self.directory, file_name)
+        with open(path, 'rb') as openfile:
+            data = openfile.read()
+        # Marks the file as recently used, for ordering when loading it after a restart
+        os.utime(path)
+        return data
+
+    def _write_file(self, file_name: str, data: bytes, evicted_file_names: list[str]):
+        """Write the file atomically, then delete the evicted files"""
+        path = os.path.join(self.directory, file_name)
+        with open(path + '.tmp', 'wb') as openfile:
+            openfile.write(data)
+        os.replace(path + '.tmp', path)
+        for evicted_file_name in evicted_file_names:
+            try:
+                os.remove(os.path.join(self.directory, evicted_file_name))
+            except FileNotFoundError:
+                pass
+
+    async def _get_from_disk(self, key: str) -> Optional[interface.ArtworkInfo]:
+        file_name = self._get_file_name(key)
+        if file_name not in self._disk_files:
+            return None
+        self._disk_files.move_to_end(file_name)
+        try:
+            return decode_artwork(await asyncio.to_thread(self._read_file, file_name))
+        except (OSError, ValueError) as ex:
+            logger.warning('Failed to read cached artwork %s! Details: %r', file_name, ex)
+            self._disk_size -= self._disk_files.pop(file_name, 0)
+            return None
+
+    async def _put_on_disk(self, key: str, artwork: interface.ArtworkInfo):
+        """Add the artwork to the disk tier, evicting the least recently used files while it is larger than disk_max_bytes"""
+        file_name = self._get_file_name(key)
+        data = encode_artwork(key, artwork)
+        self._disk_size += len(data) - self._disk_files.pop(file_name, 0)
+        self._disk_files[file_name] = len(data)
+        evicted_file_names = []
+        while self._disk_size > self.disk_max_bytes and len(self._disk_files) > 1:
+            evicted_file_name, evicted_size = self._disk_files.popitem(last=False)
+            self._disk_size -= evicted_size
+            evicted_file_names.append(evicted_file_name)
+            self.eviction_count += 1
+            ARTWORK_CACHE_EVICTIONS.inc('disk')
+        try:
+            await asyncio.to_thread(self._write_file, file_name, data, evicted_file_names)
+        except OSError as ex:
+            logger.warning('Failed to write cached artwork %s! Details: %r', file_name, ex)
+            self._disk_size -= self._disk_files.pop(file_name, 0)
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Optional[interface.ArtworkInfo]]]) \
+            -> Optional[interface.ArtworkInfo]:
+        """Return the artwork for key from the memory tier, else the disk tier, else by calling fetch() (once, however many
+        calls are waiting for it) and caching the result. Returns None if the content has no artwork, or fetch() failed."""
+        if key in self._items:
+            self.hit_count += 1
+            ARTWORK_CACHE_REQUESTS.inc('hit')
+            return self.peek(key)
+        if key in self._in_flight:
+            self.coalesced_count += 1
+            ARTWORK_CACHE_REQUESTS.inc('coalesced')
+            return await asyncio.shield(self._in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        artwork = None
+        try:
+            artwork = await self._load(key, fetch)
+        except Exception as ex:
+            self.failure_count += 1
+            ARTWORK_CACHE_REQUESTS.inc('failed')
+            logger.warning('Failed to fetch artwork for %s! Details: %r', key, ex)
+        finally:
+            # Also wakes up the calls waiting for this fetch if it was cancelled
+            del self._in_flight[key]
+            future.set_result(artwork)
+        return artwork
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Optional[interface.ArtworkInfo]]]) \
+            -> Optional[interface.ArtworkInfo]:
+        """Return the artwork for key from the disk tier, or else by calling fetch(), adding it to the cache"""
+        if self.directory:
+            artwork = await self._get_from_disk(key)
+            if artwork is not None:
+                self.disk_hit_count += 1
+                ARTWORK_CACHE_REQUESTS.inc('disk_hit')
+                self._put(key, artwork)
+                return artwork
+
+        start_time = time.perf_counter()
+        artwork = await fetch()
+        ARTWORK_FETCH_SECONDS.observe(time.perf_counter() - start_time)
+        self.miss_count += 1
+        ARTWORK_CACHE_REQUESTS.inc('miss')
+        self._put(key, artwork)
+        if artwork is not None and self.directory:
+            await self._put_on_disk(key, artwork)
+        return artwork
+
+    def get_stats(self) -> dict:
+        """Return the number of items and bytes in each tier, and of hits, misses, and evictions"""
+        request_count = self.hit_count + self.disk_hit_count + self.miss_count + self.coalesced_count
+        return {
+            'items': len(self._items),
+            'bytes': self._size,
+            'disk_items': len(self._disk_files),
+            'disk_bytes': self._disk_size,
+            'hits': self.hit_count,
+            'disk_hits': self.disk_hit_count,
+            'misses': self.miss_count,
+            'coalesced': self.coalesced_count,
+            'failures': self.failure_count,
+            'evictions': self.eviction_count,
+            'hit_ratio': (request_count - self.miss_count) / request_count if request_count else None,
+        }
+
+
+_artwork_cache: Optional[ArtworkCache] = None
+
+ARTWORK_CACHE_BYTES = Gauge('atv_artwork_cache_bytes', 'Size of the artwork held in memory by the artwork cache',
+                            lambda: _artwork_cache.size if _artwork_cache else 0)
+
+
+def get_artwork_cache() -> ArtworkCache:
+    """Return the shared ArtworkCache, creating it if needed"""
+    global _artwork_cache
+    if _artwork_cache is None:
+        _artwork_cache = ArtworkCache()
+    return _artwork_cache
+
+
+def apply_config_to_artwork_cache(changed_names: set[str]):
+    """Apply reloaded settings to the shared ArtworkCache, if it was created (taking effect as items are added)"""
+    if _artwork_cache is not None:
+        _artwork_cache.max_bytes = config.ARTWORK_CACHE_MAX_BYTES
+        _artwork_cache.disk_max_bytes = config.ARTWORK_CACHE_DISK_MAX_BYTES
+
+
+on_config_reload(apply_config_to_artwork_cache)
@@ -0,0 +1,328 @@
+import asyncio
+import html
+import json
+import os
+from random import randint
+import re
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from pyatv import interface, pair
+
+import config
+from credential_store import get_credential_store
+from log import get_logger
+from utils import get_device_summary_str, s_if_plural, service_to_protocol_str
+
+
+# The number of seconds between checks of a PIN file for new PINs, and of a pairing for whether the device accepted the PIN
+PIN_POLL_INTERVAL_SECONDS: float = 0.5
+
+logger = get_logger()
+
+
+def is_valid_pin(pin: str) -> bool:
+    return re.search('^[0-9]{4}$', pin) is not None
+
+
+class PinProvider:
+    """Supplies PINs for pairing without terminal prompts
+
+    get_pin() returns the PIN an Apple TV shows for a protocol (most protocols). show_pin() tells the operator a PIN to
+    enter on the Apple TV (DMAP), and returns right away; the pairing then waits for the Apple TV to accept it."""
+
+    async def start(self):
+        pass
+
+    async def get_pin(self, apple_tv: interface.BaseConfig, protocol_str: str) -> str:
+        raise NotImplementedError()
+
+    async def show_pin(self, apple_tv: interface.BaseConfig, protocol_str: str, pin: str):
+        logger.info('Enter this PIN: "%s" on %s for %s pairing',
+                    pin, apple_tv.name, protocol_str)
+
+    async def close(self):
+        pass
+
+
+class CallbackPinProvider(PinProvider):
+    """Gets PINs by awaiting get_pin_callback(apple_tv, protocol_str), and optionally shows them with show_pin_callback"""
+
+    def __init__(self, get_pin_callback: Callable[[interface.BaseConfig, str], Awaitable[str]],
+                 show_pin_callback: Optional[Callable[[interface.BaseConfig, str, str], Awaitable[None]]] = None):
+        self.get_pin_callback = get_pin_callback
+        self.show_pin_callback = show_pin_callback
+
+    async def get_pin(self, apple_tv: interface.BaseConfig, protocol_str: str) -> str:
+        return await self.get_pin_callback(apple_tv, protocol_str)
+
+    async def show_pin(self, apple_tv: interface.BaseConfig, protocol_str: str, pin: str):
+        if self.show_pin_callback:
+            await self.show_pin_callback(apple_tv, protocol_str, pin)
+        else:
+            await super().show_pin(apple_tv, protocol_str, pin)
+
+
+class FilePinProvider(PinProvider):
+    """Gets PINs from a JSON file, which the operator edits while pairing
+
+    The file maps each device (by MAC address or name) to its PIN, or to a PIN per protocol, e.g.
+    {"AA:BB:CC:DD:EE:FF": "1234", "Living Room": {"AirPlay": "5678", "Companion": "9012"}}.
+    It is re-read whenever it changes, until a PIN for the device and protocol appears."""
+    file_name: str
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self._pins: dict = {}
+        self._file_signature: Optional[tuple] = None
+
+    def _reload_if_changed(self):
+        try:
+            stat = os.stat(self.file_name)
+        except FileNotFoundError:
+            return
+        if (stat.st_mtime_ns, stat.st_size) == self._file_signature:
+            return
+        self._file_signature = (stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(self.file_name, 'r') as openfile:
+                self._pins = json.load(openfile)
+        except ValueError:
+            # Likely still being written, so try again next time
+            self._file_signature = None
+
+    def find_pin(self, apple_tv: interface.BaseConfig, protocol_str: str) -> Optional[str]:
+        self._reload_if_changed()
+        for key in (apple_tv.device_info.mac, apple_tv.name):
+            pin = self._pins.get(key)
+            if isinstance(pin, dict):
+                pin = pin.get(protocol_str)
+            if pin is not None:
+                return str(pin)
+        return None
+
+    async def get_pin(self, apple_tv: interface.BaseConfig, protocol_str: str) -> str:
+        logger.info('Waiting for the %s PIN shown on %s to be added to %s...',
+                    protocol_str, apple_tv.name, self.file_name)
+        while True:
+            pin = self.find_pin(apple_tv, protocol_str)
+            if pin is not None:
+                return pin
+            await asyncio.sleep(PIN_POLL_INTERVAL_SECONDS)
+
+
+class HttpPinProvider(PinProvider):
+    """Gets PINs from a local web page with a form for each pairing waiting for a PIN, which also lists PINs to enter"""
+    host: str
+    port: int
+
+    def __init__(self, port: int = config.PAIRING_HTTP_PORT, host: str = config.PAIRING_HTTP_HOST):
+        self.host = host
+        self.port = port
+        # Pairings waiting for a PIN, and PINs to enter on devices, by (MAC address, protocol)
+        self._pending_pins: dict[tuple[str, str], tuple[interface.BaseConfig, asyncio.Future]] = {}
+        self._shown_pins: dict[tuple[str, str], tuple[interface.BaseConfig, str]] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self.handle_index)
+        app.router.add_post('/pin', self.handle_pin)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info('Enter PINs at http://%s:%d/', self.host, self.port)
+
+    async def handle_index(self, request: web.Request) -> web.Response:
+        rows = []
+        for (mac, protocol_str), (apple_tv, _) in self._pending_pins.items():
+            rows.append(
+                '<form method="post" action="/pin"><label>PIN shown on {0:s} for {1:s}: '
+                '<input name="pin" pattern="[0-9]{{4}}" required autofocus></label>'
+                '<input type="hidden" name="mac" value="{2:s}"><input type="hidden" name="protocol" value="{1:s}">'
+                '<button>Pair</button></form>'.format(
+                    html.escape(get_device_summary_str(apple_tv)), html.escape(protocol_str), html.escape(mac)))
+        for (mac, protocol_str), (apple_tv, pin) in self._shown_pins.items():
+            rows.append('<p>Enter this PIN on {0:s} for {1:s}: <b>{2:s}</b></p>'.format(
+                html.escape(get_device_summary_str(apple_tv)), html.escape(protocol_str), html.escape(pin)))
+        body = '\n'.join(rows) or '<p>No pairings are waiting for a PIN. Refresh to check again.</p>'
+        return web.Response(content_type='text/html', text='<!DOCTYPE html><html><head><title>Pair Apple TVs</title></head>'
+                            '<body><h1>Pair Apple TVs</h1>\n{0:s}\n</body></html>'.format(body))
+
+    async def handle_pin(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        key = (form.get('mac', ''), form.get('protocol', ''))
+        pin = form.get('pin', '').strip()
+        if key not in self._pending_pins:
+            raise web.HTTPNotFound(text='No pairing is waiting for this PIN')
+        if not is_valid_pin(pin):
+            raise web.HTTPBadRequest(text='The PIN must be 4 digits')
+        future = self._pending_pins.pop(key)[1]
+        if not future.done():
+            future.set_result(pin)
+        raise web.HTTPSeeOther('/')
+
+    async def get_pin(self, apple_tv: interface.BaseConfig, protocol_str: str) -> str:
+        key = (apple_tv.device_info.mac, protocol_str)
+        future = asyncio.get_running_loop().create_future()
+        self._pending_pins[key] = (apple_tv, future)
+        logger.info('Waiting for the %s PIN shown on %s to be entered at http://%s:%d/...',
+                    protocol_str, apple_tv.name, self.host, self.port)
+        try:
+            return await future
+        finally:
+            self._pending_pins.pop(key, None)
+
+    async def show_pin(self, apple_tv: interface.BaseConfig, protocol_str: str, pin: str):
+        self._shown_pins[(apple_tv.device_info.mac, protocol_str)] = (
+            apple_tv, pin)
+        await super().show_pin(apple_tv, protocol_str, pin)
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class ProtocolPairingResult:
+    """Outcome and timing of pairing one protocol of a device"""
+    __slots__ = ('protocol_str', 'has_paired', 'credentials', 'seconds', 'pin_wait_seconds', 'error')
+
+    def __init__(self, protocol_str: str):
+        self.protocol_str = protocol_str
+        self.has_paired = False
+        self.credentials: Optional[str] = None
+        self.seconds = 0.0
+        self.pin_wait_seconds = 0.0
+        self.error: Optional[str] = None
+
+
+class DevicePairingResult:
+    """Outcome and timing of pairing every protocol of a device"""
+    apple_tv: interface.BaseConfig
+    protocol_results: list[ProtocolPairingResult]
+    seconds: float = 0.0
+
+    def __init__(self, apple_tv: interface.BaseConfig):
+        self.apple_tv = apple_tv
+        self.protocol_results = []
+
+    @property
+    def device_mac(self) -> str:
+        return self.apple_tv.device_info.mac
+
+    @property
+    def has_paired(self) -> bool:
+        """Whether at least one protocol was paired"""
+        return any(protocol_result.has_paired for protocol_result in self.protocol_results)
+
+    def get_credentials(self) -> dict[str, str]:
+        return {protocol_result.protocol_str: protocol_result.credentials
+                for protocol_result in self.protocol_results if protocol_result.has_paired}
+
+
+async def pair_protocol(apple_tv: interface.BaseConfig, service: interface.BaseService, pin_provider: PinProvider,
+                        pair_function: Callable[..., Awaitable[interface.PairingHandler]] = pair,
+                        pin_timeout_seconds: float = config.PAIRING_PIN_TIMEOUT_SECONDS) -> ProtocolPairingResult:
+    """Pair one service of apple_tv, getting or showing its PIN with pin_provider, and return the result without saving it"""
+    protocol_str = service_to_protocol_str(service)
+    result = ProtocolPairingResult(protocol_str)
+    start_time = time.perf_counter()
+    pairing = None
+    try:
+        pairing = await pair_function(apple_tv, service.protocol, asyncio.get_running_loop())
+        await pairing.begin()
+        pin_start_time = time.perf_counter()
+        if pairing.device_provides_pin:
+            pin = await asyncio.wait_for(pin_provider.get_pin(apple_tv, protocol_str), pin_timeout_seconds)
+            if not is_valid_pin(pin):
+                raise ValueError('Invalid PIN "{0:s}", expected 4 digits'.format(pin))
+            pairing.pin(pin)
+            result.pin_wait_seconds = time.perf_counter() - pin_start_time
+        else:
+            pin = str(randint(1, 9999)).zfill(4)
+            pairing.pin(pin)
+            await pin_provider.show_pin(apple_tv, protocol_str, pin)
+            # The device pairs once the PIN is entered on it, so wait for that before finishing
+            deadline = time.perf_counter() + pin_timeout_seconds
+            while not pairing.has_paired and time.perf_counter() < deadline:
+                await asyncio.sleep(PIN_POLL_INTERVAL_SECONDS)
+            result.pin_wait_seconds = time.perf_counter() - pin_start_time
+        await pairing.finish()
+        result.has_paired = pairing.has_paired
+        if result.has_paired:
+            result.credentials = pairing.service.credentials
+        else:
+            result.error = 'Pairing did not complete'
+    except asyncio.TimeoutError:
+        result.error = 'Timed out after {0}s waiting for a PIN'.format(pin_timeout_seconds)
+    except Exception as ex:
+        result.error = repr(ex)
+    finally:
+        if pairing:
+            try:
+                await pairing.close()
+            except Exception as ex:
+                logger.warning('Failed to close %s pairing with %s! Details: %r',
+                               protocol_str, apple_tv.name, ex)
+    result.seconds = time.perf_counter() - start_time
+
+    if result.has_paired:
+        logger.info('%s pairing on %s completed successfully in %.1fs (%.1fs waiting for the PIN)!',
+                    protocol_str, apple_tv.name, result.seconds, result.pin_wait_seconds)
+    else:
+        logger.error('%s pairing on %s failed after %.1fs! Details: %s',
+                     protocol_str, apple_tv.name, result.seconds, result.error)
+    return result
+
+
+async def pair_device(apple_tv: interface.BaseConfig, pin_provider: PinProvider,
+                      pair_function: Callable[..., Awaitable[interface.PairingHandler]] = pair,
+                      pin_timeout_seconds: float = config.PAIRING_PIN_TIMEOUT_SECONDS) -> DevicePairingResult:
+    """Pair each enabled service of apple_tv in turn, since a device can only pair one protocol at a time"""
+    result = DevicePairingResult(apple_tv)
+    start_time = time.perf_counter()
+    for service in apple_tv.services:
+        if not service.enabled:
+            logger.warning('Skipping %s pairing for %s because the service is disabled!',
+                           service_to_protocol_str(service), apple_tv.name)
+            continue
+        result.protocol_results.append(await pair_protocol(apple_tv, service, pin_provider, pair_function, pin_timeout_seconds))
+    result.seconds = time.perf_counter() - start_time
+    return result
+
+
+async def pair_devices(apple_tvs: list[interface.BaseConfig], pin_provider: PinProvider,
+                       pair_function: Callable[..., Awaitable[interface.PairingHandler]] = pair,
+                       pin_timeout_seconds: float = config.PAIRING_PIN_TIMEOUT_SECONDS,
+                       save: bool = True) -> list[DevicePairingResult]:
+    """Pair every protocol of every provided Apple TV without terminal prompts, getting PINs from pin_provider
+
+    Devices are paired concurrently. Unless save is False, the credentials of every device are saved in one write once
+    all pairings have finished. pair_function may be replaced (e.g. with fake pairing handlers), and defaults to pyatv.pair"""
+    start_time = time.perf_counter()
+    logger.info('Pairing %d Apple TV%s...', len(apple_tvs),
+                s_if_plural(len(apple_tvs)))
+    await pin_provider.start()
+    try:
+        results = await asyncio.gather(*[pair_device(apple_tv, pin_provider, pair_function, pin_timeout_seconds)
+                                         for apple_tv in apple_tvs])
+    finally:
+        await pin_provider.close()
+
+    credentials_by_device_mac = {result.device_mac: result.get_credentials()
+                                 for result in results if result.has_paired}
+    if save and credentials_by_device_mac:
+        credential_store = get_credential_store()
+        credential_store.save_credentials(credentials_by_device_mac)
+        credential_store.flush()
+
+    for result in results:
+        logger.info('%s: %s in %.1fs', get_device_summary_str(result.apple_tv), ', '.join(
+            '{0:s} {1:s} ({2:.1f}s)'.format(protocol_result.protocol_str, 'paired' if protocol_result.has_paired else 'failed',
+                                            protocol_result.seconds)
+            for protocol_result in result.protocol_results) or 'no enabled services', result.seconds)
+    logger.info('Paired %d of %d Apple TV%s in %.1fs', len(credentials_by_device_mac), len(apple_tvs),
+                s_if_plural(len(apple_tvs)), time.perf_counter() - start_time)
+    return results
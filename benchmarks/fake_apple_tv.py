@@ -0,0 +1,180 @@
+"""A fake connected Apple TV, for driving the listeners without real hardware, and fake pairing handlers
+
+FakeAppleTV has the attributes DeviceSession uses on a connected pyatv AppleTV (listener, power, audio, keyboard, and
+push_updater), and methods which call the attached listeners the way pyatv would when the device's state changes. It also
+accepts the commands macros.py sends (remote_control, power, apps, and audio), recording them in commands, and returns
+made-up artwork from metadata.
+FakePairingHandler has the methods batch_pairing.py uses on a pyatv PairingHandler.
+"""
+import asyncio
+from typing import Optional
+
+from pyatv import const, interface
+
+
+class FakeFeature:
+    """Stands in for the power, audio, keyboard, and push_updater interfaces, which each hold one listener"""
+    listener = None
+
+
+class FakeCommands:
+    """Stands in for the remote_control and apps interfaces, recording each command (method name and arguments) called"""
+
+    def __init__(self, apple_tv: 'FakeAppleTV', command_seconds: float = 0):
+        self._apple_tv = apple_tv
+        self._command_seconds = command_seconds
+
+    def __getattr__(self, name: str):
+        async def command(*args):
+            if self._command_seconds:
+                await asyncio.sleep(self._command_seconds)
+            self._apple_tv.commands.append((name, *args))
+        return command
+
+
+class FakeMetadata:
+    """Stands in for the metadata interface, returning made-up artwork for what is playing and counting the requests"""
+    artwork_requests: int = 0
+
+    def __init__(self, apple_tv: 'FakeAppleTV', command_seconds: float = 0):
+        self._apple_tv = apple_tv
+        self._command_seconds = command_seconds
+
+    async def artwork(self, width: Optional[int] = 512, height: Optional[int] = None) -> Optional[interface.ArtworkInfo]:
+        self.artwork_requests += 1
+        if self._command_seconds:
+            await asyncio.sleep(self._command_seconds)
+        content_identifier = self._apple_tv.playing.content_identifier
+        if content_identifier is None:
+            return None
+        return interface.ArtworkInfo(content_identifier.encode() * 100, 'image/jpeg', width or 512, width or 512)
+
+
+class FakePower(FakeFeature):
+    power_state: const.PowerState
+
+    def __init__(self, power_state: const.PowerState):
+        self.power_state = power_state
+
+
+class FakeAudio(FakeFeature):
+    volume: float = 0.0
+
+
+class FakePushUpdater(FakeFeature):
+    is_started: bool = False
+
+    def start(self, initial_delay: int = 0):
+        self.is_started = True
+
+    def stop(self):
+        self.is_started = False
+
+
+class FakeAppleTV:
+    """A connected Apple TV whose state changes are driven by calling its methods"""
+    listener: Optional[interface.DeviceListener] = None
+    is_closed: bool = False
+
+    def __init__(self, power_state: const.PowerState = const.PowerState.On, command_seconds: float = 0):
+        self.power = FakePower(power_state)
+        self.audio = FakeAudio()
+        self.keyboard = FakeFeature()
+        self.push_updater = FakePushUpdater()
+        self.playing = interface.Playing()
+        self.commands: list[tuple] = []
+        self.remote_control = FakeCommands(self, command_seconds)
+        self.apps = FakeCommands(self, command_seconds)
+        self.metadata = FakeMetadata(self, command_seconds)
+        # Power and volume commands change the state too, as if the device reported it right away
+        self.power.turn_on = self._get_state_command('turn_on', self.set_power_state, const.PowerState.On, command_seconds)
+        self.power.turn_off = self._get_state_command('turn_off', self.set_power_state, const.PowerState.Off, command_seconds)
+        self.audio.set_volume = self._get_state_command('set_volume', self.set_volume, None, command_seconds)
+
+    def _get_state_command(self, name: str, set_state, state, command_seconds: float):
+        async def command(*args):
+            if command_seconds:
+                await asyncio.sleep(command_seconds)
+            self.commands.append((name, *args))
+            set_state(state if state is not None else args[0])
+        return command
+
+    def set_power_state(self, power_state: const.PowerState):
+        old_power_state = self.power.power_state
+        self.power.power_state = power_state
+        if self.power.listener:
+            self.power.listener.powerstate_update(
+                old_power_state, power_state)
+
+    def set_volume(self, volume: float):
+        old_volume = self.audio.volume
+        self.audio.volume = volume
+        if self.audio.listener:
+            self.audio.listener.volume_update(old_volume, volume)
+
+    def set_playing(self, playing: interface.Playing):
+        self.playing = playing
+        if self.push_updater.listener and self.push_updater.is_started:
+            self.push_updater.listener.playstatus_update(
+                self.push_updater, playing)
+
+    def lose_connection(self, exception: Exception):
+        if self.listener:
+            self.listener.connection_lost(exception)
+
+    def close(self):
+        self.is_closed = True
+        if self.listener:
+            self.listener.connection_closed()
+
+
+def get_fake_connect_function(power_state: const.PowerState = const.PowerState.On, connect_seconds: float = 0):
+    """Return a function with the signature of pyatv.connect, to pass to DeviceSession, which returns a new FakeAppleTV"""
+    async def connect(config: interface.BaseConfig, loop: asyncio.AbstractEventLoop, **kwargs) -> FakeAppleTV:
+        if connect_seconds:
+            await asyncio.sleep(connect_seconds)
+        return FakeAppleTV(power_state)
+    return connect
+
+
+class FakePairingHandler:
+    """Stands in for a pyatv PairingHandler, accepting expected_pin (or any PIN, if None) after pair_seconds"""
+    device_provides_pin: bool
+    has_paired: bool = False
+
+    def __init__(self, service: interface.BaseService, device_provides_pin: bool = True, expected_pin: Optional[str] = None,
+                 pair_seconds: float = 0):
+        self.service = service
+        self.device_provides_pin = device_provides_pin
+        self.expected_pin = expected_pin
+        self.pair_seconds = pair_seconds
+        self._pin: Optional[str] = None
+        self.is_closed = False
+
+    async def begin(self):
+        if self.pair_seconds:
+            await asyncio.sleep(self.pair_seconds)
+
+    def pin(self, pin: str):
+        self._pin = str(pin)
+        if not self.device_provides_pin:
+            # As if the PIN was entered on the device right away
+            self.has_paired = self.expected_pin is None or self._pin == self.expected_pin
+
+    async def finish(self):
+        if self.device_provides_pin:
+            self.has_paired = self.expected_pin is None or self._pin == self.expected_pin
+        if self.has_paired:
+            self.service.credentials = 'fake-credentials-{0:s}'.format(
+                self._pin)
+
+    async def close(self):
+        self.is_closed = True
+
+
+def get_fake_pair_function(device_provides_pin: bool = True, expected_pin: Optional[str] = None, pair_seconds: float = 0):
+    """Return a function with the signature of pyatv.pair, to pass to batch_pairing.pair_devices(), which returns a new
+    FakePairingHandler for the config's service of the requested protocol"""
+    async def pair(config: interface.BaseConfig, protocol: const.Protocol, loop: asyncio.AbstractEventLoop, **kwargs) -> FakePairingHandler:
+        return FakePairingHandler(config.get_service(protocol), device_provides_pin, expected_pin, pair_seconds)
+    return pair
@@ -0,0 +1,207 @@
+"""Drive the listeners of many fake Apple TVs with event storms, and measure throughput, latency, and memory per device
+
+Every simulated device has a PowerListener, PushListener, AudioListener, and DeviceListener attached to a FakeAppleTV
+(see: ./fake_apple_tv.py). Rules POST stable power, play state, and volume changes to a local aiohttp stand-in for a
+webhook service through the shared WebhookDispatcher, which records the latency from each event to its webhook.
+
+Run from the root path: python -m benchmarks.load_benchmark [--devices 1 10 100] [--rounds N] [--round-interval SECONDS]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from aiohttp import web
+from pyatv import const, interface
+
+import config
+# Imported before other modules of this project, so that settings missing from config.py (and those in config.json) apply
+#   to their defaults too
+import config_file
+from benchmarks.fake_apple_tv import FakeAppleTV
+from events import EVENT_DEVICE_STATE, EVENT_POWER, EVENT_VOLUME, subscribe, unsubscribe
+from listeners.audio_listener import AudioListener
+from listeners.device_listener import DeviceListener
+from listeners.power_listener import PowerListener
+from listeners.push_listener import PushListener
+from log import setup_logging
+from rules import RuleEngine
+from webhook_dispatcher import close_webhook_dispatcher, get_percentile, get_webhook_dispatcher
+
+
+# How often (in rounds) each simulated device changes its play state, volume, and power state
+DEVICE_STATE_EVERY_ROUNDS: int = 10
+VOLUME_EVERY_ROUNDS: int = 5
+POWER_EVERY_ROUNDS: int = 20
+
+
+class WebhookStandIn:
+    """Local aiohttp server which accepts webhook POST requests and records the latency since each event's timestamp"""
+
+    url: str = ''
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self._runner: web.AppRunner = None
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        event_json = await request.json()
+        self.latencies.append(time.time() - event_json['timestamp'])
+        return web.Response(text='OK')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/webhook', self.handle_webhook)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = 'http://{0:s}:{1:d}/webhook'.format(host, port)
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+class SimulatedDevice:
+    """A FakeAppleTV with every listener attached, like DeviceSession.add_listeners() with all listeners enabled"""
+
+    def __init__(self, idx: int):
+        name = 'Apple TV {0:d}'.format(idx)
+        mac = '00:00:00:00:{0:02X}:{1:02X}'.format(idx // 256, idx % 256)
+        # Offset each device's changes, so that they are spread out instead of all happening in the same round
+        self.phase = idx
+        self.apple_tv = FakeAppleTV(const.PowerState.On)
+        self.apple_tv.listener = DeviceListener(name, None, mac)
+        self.apple_tv.power.listener = PowerListener(
+            self.apple_tv.power.power_state, name, mac)
+        self.apple_tv.audio.listener = AudioListener(name, mac)
+        self.apple_tv.push_updater.listener = PushListener(name, mac)
+        self.apple_tv.push_updater.start()
+
+    def run_round(self, round_idx: int) -> int:
+        """Make this round's state changes, and return the number of listener callbacks made"""
+        round_idx += self.phase
+        device_state = const.DeviceState.Playing if (
+            round_idx // DEVICE_STATE_EVERY_ROUNDS) % 2 == 0 else const.DeviceState.Paused
+        self.apple_tv.set_playing(interface.Playing(
+            media_type=const.MediaType.Video, device_state=device_state, title='Episode {0:d}'.format(round_idx // 100),
+            position=round_idx, total_time=3600))
+        callback_count = 1
+        if round_idx % VOLUME_EVERY_ROUNDS == 0:
+            self.apple_tv.set_volume(float(round_idx % 100))
+            callback_count += 1
+        if round_idx % POWER_EVERY_ROUNDS == 0:
+            self.apple_tv.set_power_state(
+                const.PowerState.Off if self.apple_tv.power.power_state == const.PowerState.On else const.PowerState.On)
+            callback_count += 1
+        return callback_count
+
+    def close(self):
+        self.apple_tv.power.listener.debouncer.cancel()
+        self.apple_tv.audio.listener.volume_debouncer.cancel()
+        self.apple_tv.close()
+
+
+def measure_memory_per_device(device_count: int) -> float:
+    """Return the bytes allocated per simulated device, including its listeners' state after one round"""
+    tracemalloc.start()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    devices = [SimulatedDevice(idx) for idx in range(device_count)]
+    for device in devices:
+        device.run_round(1)
+    end_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for device in devices:
+        device.close()
+    return (end_bytes - start_bytes) / device_count
+
+
+async def run_storm(device_count: int, rounds: int, round_interval_seconds: float, stand_in: WebhookStandIn) -> dict:
+    """Run rounds of state changes on device_count simulated devices, sleeping round_interval_seconds after each round"""
+    dispatcher = get_webhook_dispatcher()
+    start_stats = dispatcher.get_stats()
+    stand_in.latencies = []
+
+    devices = [SimulatedDevice(idx) for idx in range(device_count)]
+    callback_count = 0
+    callback_seconds = 0.0
+    start_time = time.perf_counter()
+    for round_idx in range(rounds):
+        round_start_time = time.perf_counter()
+        for device in devices:
+            callback_count += device.run_round(round_idx)
+        callback_seconds += time.perf_counter() - round_start_time
+        await asyncio.sleep(round_interval_seconds)
+    # Let the rule actions scheduled by the last round enqueue their requests, then wait for them to be sent
+    await asyncio.sleep(0)
+    await dispatcher.join()
+    total_seconds = time.perf_counter() - start_time
+    for device in devices:
+        device.close()
+
+    end_stats = dispatcher.get_stats()
+    latencies = sorted(stand_in.latencies)
+    return {
+        'devices': device_count,
+        'callbacks': callback_count,
+        'callbacks_per_second': callback_count / callback_seconds,
+        'total_seconds': total_seconds,
+        'webhooks': len(latencies),
+        'dropped': end_stats['dropped'] - start_stats['dropped'],
+        'failed': end_stats['failed'] - start_stats['failed'],
+        'latency_p50': get_percentile(latencies, 50),
+        'latency_p95': get_percentile(latencies, 95),
+        'latency_p99': get_percentile(latencies, 99),
+        'latency_max': latencies[-1] if latencies else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 10, 100],
+                        help='Numbers of simulated devices to run with')
+    parser.add_argument('--rounds', type=int, default=100,
+                        help='Number of rounds of state changes per device')
+    parser.add_argument('--round-interval', type=float, default=0.05,
+                        help='Seconds between rounds (0 to run rounds back to back, which overflows the webhook queue)')
+    parser.add_argument('--log-level', default='CRITICAL',
+                        help='Level of logs to write (ERROR logs every dropped webhook, INFO every push update)')
+    args = parser.parse_args()
+
+    setup_logging(level=args.log_level)
+    # Make every state change stable right away, so each one goes through the rules to a webhook
+    config.POWER_OFF_STABLE_AFTER_SECONDS = 0
+    config.VOLUME_STABLE_AFTER_SECONDS = 0
+
+    stand_in = WebhookStandIn()
+    await stand_in.start()
+    rule_engine = RuleEngine([{'event': event_type, 'actions': [{'type': 'webhook', 'url': stand_in.url}]}
+                              for event_type in (EVENT_POWER, EVENT_DEVICE_STATE, EVENT_VOLUME)])
+    subscribe(rule_engine.dispatch)
+
+    results = []
+    try:
+        for device_count in args.devices:
+            result = await run_storm(device_count, args.rounds, args.round_interval, stand_in)
+            result['memory_per_device'] = measure_memory_per_device(
+                device_count)
+            results.append(result)
+    finally:
+        unsubscribe(rule_engine.dispatch)
+        await close_webhook_dispatcher()
+        await stand_in.close()
+
+    print('{0:d} rounds per device, {1:.3f}s apart, with webhooks sent to {2:s}'.format(
+        args.rounds, args.round_interval, stand_in.url))
+    print('{0:>8s}{1:>12s}{2:>14s}{3:>10s}{4:>10s}{5:>9s}{6:>10s}{7:>10s}{8:>10s}{9:>10s}{10:>12s}'.format(
+        'devices', 'callbacks', 'callbacks/s', 'total s', 'webhooks', 'dropped', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+        'KiB/device'))
+    for result in results:
+        print('{0:>8d}{1:>12d}{2:>14.0f}{3:>10.2f}{4:>10d}{5:>9d}{6:>10.1f}{7:>10.1f}{8:>10.1f}{9:>10.1f}{10:>12.1f}'.format(
+            result['devices'], result['callbacks'], result['callbacks_per_second'], result['total_seconds'],
+            result['webhooks'], result['dropped'], result['latency_p50'] * 1e3, result['latency_p95'] * 1e3,
+            result['latency_p99'] * 1e3, result['latency_max'] * 1e3, result['memory_per_device'] / 1024))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
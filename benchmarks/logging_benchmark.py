@@ -0,0 +1,93 @@
+"""Measure how much event loop time logging costs, before (print()) and after (queue-backed logging)
+
+Run from the root path: python -m benchmarks.logging_benchmark [--records N] [--output FILE]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from log import flush_logs, get_logger, get_logging_stats, setup_logging
+from utils import get_log_prefix
+
+
+class FakePlaying:
+    """Stands in for interface.Playing, whose str() lists every field on its own line"""
+
+    def __init__(self, idx: int):
+        self.fields = {
+            'Media type': 'Video', 'Device state': 'Playing', 'Title': 'Episode {0:d}'.format(idx),
+            'Artist': 'Some Artist', 'Album': 'Some Album', 'Genre': 'Drama', 'Position': '{0:d}/3600s'.format(idx),
+            'Repeat': 'Off', 'Shuffle': 'Off',
+        }
+
+    def __str__(self):
+        return '\n'.join('{0:>13s}: {1:s}'.format(key, value) for key, value in self.fields.items())
+
+
+async def measure_loop_lag(stop_event: asyncio.Event, lags: list[float], interval: float = 0.001):
+    while not stop_event.is_set():
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start_time - interval)
+
+
+async def run(log_function, records: int) -> tuple[float, float]:
+    """Call log_function for each record, yielding to the loop in between, and return (seconds on loop, max loop lag)"""
+    stop_event = asyncio.Event()
+    lags = []
+    lag_task = asyncio.ensure_future(measure_loop_lag(stop_event, lags))
+    loop_seconds = 0.0
+    for idx in range(records):
+        playing = FakePlaying(idx)
+        start_time = time.perf_counter()
+        log_function(playing)
+        loop_seconds += time.perf_counter() - start_time
+        if idx % 100 == 0:
+            await asyncio.sleep(0)
+    stop_event.set()
+    await lag_task
+    return loop_seconds, max(lags, default=0.0)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--output', help='File to write logs to (defaults to a temporary file)')
+    args = parser.parse_args()
+
+    output_file_name = args.output or os.path.join(
+        tempfile.mkdtemp(), 'logging_benchmark.log')
+
+    with open(output_file_name, 'a') as output_file:
+        def print_log(playing):
+            print(
+                f'{get_log_prefix(True, "PushListener", "Living Room")}playstatus_update():\n{playing}', file=output_file, flush=True)
+        print_seconds, print_lag = await run(print_log, args.records)
+
+    setup_logging(level='INFO', json_lines=False, file_name=output_file_name)
+    logger = get_logger('PushListener', 'Living Room')
+
+    def queue_log(playing):
+        logger.info('playstatus_update():\n%s', playing)
+    queue_seconds, queue_lag = await run(queue_log, args.records)
+    drain_start_time = time.perf_counter()
+    flush_logs()
+    drain_seconds = time.perf_counter() - drain_start_time
+    stats = get_logging_stats()
+
+    print('Logged {0:d} push updates per method to {1:s}'.format(
+        args.records, output_file_name))
+    print('{0:<28s}{1:>14s}{2:>16s}{3:>16s}'.format(
+        '', 'loop time (s)', 'per record (us)', 'max lag (ms)'))
+    print('{0:<28s}{1:>14.3f}{2:>16.1f}{3:>16.2f}'.format('print() (before)',
+          print_seconds, print_seconds / args.records * 1e6, print_lag * 1e3))
+    print('{0:<28s}{1:>14.3f}{2:>16.1f}{3:>16.2f}'.format('queue logging (after)',
+          queue_seconds, queue_seconds / args.records * 1e6, queue_lag * 1e3))
+    print('Queue logging drained {0:.3f}s after the last record, and dropped {1:d} records'.format(
+        drain_seconds, stats['dropped']))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
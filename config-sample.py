@@ -1,8 +1,178 @@
+# Settings in config.json override these, and are reloaded while running when it changes (see README.md)
+
 # The number of seconds to scan the network for Apple TV devices for
 SCAN_TIMEOUT_SECONDS: int = 5
 
-# The number of seconds after the most recent On state change required for treating an Off state change as stable (see comments in ./listeners/power_listener.py)
+# The number of seconds to wait for known Apple TVs to respond at their last-known addresses (see discovery_cache.json)
+#   before falling back to scanning the whole network
+DISCOVERY_CACHE_SCAN_TIMEOUT_SECONDS: float = 1
+
+# The listeners to add for each Apple TV: any of 'audio', 'keyboard', 'power', and 'push' (see: https://pyatv.dev/development/listeners/)
+#   A DeviceListener is always added, to reconnect when the connection is lost. May be overridden with main.py --listeners
+LISTENERS: list = ['power']
+
+# The number of seconds to wait for a connection to an Apple TV to be established before giving up on it
+CONNECT_TIMEOUT_SECONDS: int = 15
+
+# The number of seconds to wait before the first attempt to reconnect to an Apple TV after the connection was lost
+#   The wait doubles after each failed attempt, up to RECONNECT_MAX_DELAY_SECONDS
+RECONNECT_INITIAL_DELAY_SECONDS: int = 1
+
+# The maximum number of seconds to wait between attempts to reconnect to an Apple TV
+RECONNECT_MAX_DELAY_SECONDS: int = 60
+
+# Whether to probe each connection with a cheap TCP connect, to detect dead connections (and reconnect) within seconds
+#   rather than when the OS gives up on them, which can take minutes after a network blip
+HEALTH_PROBE_ENABLED: bool = False
+
+# The interval between health probes starts at the minimum, and backs off towards the maximum while probes succeed
+HEALTH_PROBE_MIN_INTERVAL_SECONDS: float = 5
+HEALTH_PROBE_MAX_INTERVAL_SECONDS: float = 60
+
+# The number of seconds to wait for a health probe before treating it as failed
+HEALTH_PROBE_TIMEOUT_SECONDS: float = 2
+
+# The number of health probes in a row which must fail before the connection is treated as dead and reconnected
+#   A dead connection is detected within about HEALTH_PROBE_MAX_INTERVAL_SECONDS
+#   + HEALTH_PROBE_FAILURES_UNTIL_DEAD * (HEALTH_PROBE_TIMEOUT_SECONDS + HEALTH_PROBE_MIN_INTERVAL_SECONDS)
+HEALTH_PROBE_FAILURES_UNTIL_DEAD: int = 3
+
+# Whether to keep rescanning the network in the background, to notice Apple TVs which appear, go, or change address (e.g.
+#   through DHCP), and to connect to paired Apple TVs which appear after startup (see ./presence.py)
+PRESENCE_ENABLED: bool = False
+
+# The interval between rescans starts at the minimum, and backs off towards the maximum while nothing changes
+PRESENCE_MIN_INTERVAL_SECONDS: float = 30
+PRESENCE_MAX_INTERVAL_SECONDS: float = 600
+
+# The number of seconds each rescan listens for Apple TVs on the network
+PRESENCE_SCAN_TIMEOUT_SECONDS: float = 3
+
+# The number of rescans in a row which must miss an Apple TV before it is treated as gone
+PRESENCE_GONE_AFTER_MISSES: int = 2
+
+# The number of seconds an Off state change must last, without flipping back to On, before it is treated as stable (see comments in ./listeners/power_listener.py)
 POWER_OFF_STABLE_AFTER_SECONDS: int = 20
 
+# The number of seconds the volume must stay unchanged before it is treated as stable (see ./listeners/audio_listener.py)
+VOLUME_STABLE_AFTER_SECONDS: float = 1
+
+# The minimum number of seconds between push updates passed on when only the position of what is playing changed
+#   Position updates arrive about every second while playing, so the ones in between are coalesced (see ./listeners/push_listener.py)
+PUSH_POSITION_UPDATE_INTERVAL_SECONDS: float = 10
+
+# The number of most recent push update states kept for each Apple TV
+PUSH_HISTORY_SIZE: int = 100
+
+# Whether to fetch the artwork of what is playing when it changes (requires the 'push' listener), caching it so that it is
+#   requested from the Apple TV once per content (see ./artwork_cache.py)
+ARTWORK_ENABLED: bool = False
+
+# The width in pixels to request artwork at (the height keeps the aspect ratio)
+ARTWORK_WIDTH: int = 512
+
+# The maximum number of bytes of artwork to keep in memory, evicting the least recently used first
+ARTWORK_CACHE_MAX_BYTES: int = 20000000
+
+# The directory to also keep artwork in, so that it outlives restarts, or '' to only keep it in memory
+ARTWORK_CACHE_DIRECTORY: str = ''
+
+# The maximum number of bytes of artwork to keep in ARTWORK_CACHE_DIRECTORY, evicting the least recently used first
+ARTWORK_CACHE_DISK_MAX_BYTES: int = 200000000
+
+# The SQLite database file to record every listener event to, to query with event_history.py, or '' to not record events
+EVENT_STORE_FILE_NAME: str = 'events.db'
+
+# The number of seconds to wait for each PIN when pairing with pair_apple_tvs.py --device or --all
+PAIRING_PIN_TIMEOUT_SECONDS: int = 300
+
+# The port and address of the web page to enter PINs on when pairing with pair_apple_tvs.py --pin-http
+#   Use '0.0.0.0' to allow entering PINs from another device (like a phone) on the network
+PAIRING_HTTP_PORT: int = 8765
+PAIRING_HTTP_HOST: str = '127.0.0.1'
+
+# The maximum number of rule actions running at the same time for each Apple TV, and of those waiting to run after
+#   them, beyond which new ones are dropped
+TASK_MAX_CONCURRENT_PER_DEVICE: int = 4
+TASK_MAX_BACKLOG_PER_DEVICE: int = 100
+
+# The number of seconds to wait for running rule actions to finish when exiting, before closing connections
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS: float = 10
+
+# The number of seconds a macro "wait" step waits for the state it expects, unless it sets its own timeout_seconds
+MACRO_WAIT_TIMEOUT_SECONDS: float = 15
+
 # The IFTTT-provided API key required for sending requests for Webhooks integrations (see: https://ifttt.com/maker_webhooks)
 IFTTT_API_KEY: str = ''
+
+
+# The maximum number of POST requests sent to IFTTT at the same time, over one shared pool of connections
+IFTTT_MAX_CONCURRENT_REQUESTS: int = 4
+
+# The maximum number of POST requests waiting to be sent to IFTTT before new ones are dropped
+IFTTT_QUEUE_SIZE: int = 100
+
+# The number of times a failed POST request to IFTTT is retried, with jittered exponential backoff, before giving up
+IFTTT_MAX_RETRIES: int = 5
+
+# The number of seconds to wait for a response from IFTTT before treating the POST request as failed
+IFTTT_REQUEST_TIMEOUT_SECONDS: int = 10
+
+# The directory to spool webhook POST requests to before sending them, so that requests which could not be sent (e.g. while
+#   offline, or when exiting) are sent later, even after a restart, or '' to not spool them
+SPOOL_DIRECTORY: str = 'spool'
+
+# The size at which the spool starts a new segment file, and the total size of segment files at which the oldest one is
+#   discarded (along with any requests in it which were never sent), in bytes
+SPOOL_SEGMENT_MAX_BYTES: int = 1000000
+SPOOL_MAX_BYTES: int = 50000000
+
+# The number of seconds between attempts to send spooled requests which could not be sent before
+SPOOL_REPLAY_INTERVAL_SECONDS: float = 60
+
+# Destinations for the "publish" rule action, each a dict with a unique 'name', a 'type', and the type's options:
+#   {'type': 'ifttt', 'name': 'ifttt', 'event_name': 'atv_{event_type}'}  (uses IFTTT_API_KEY)
+#   {'type': 'http', 'name': 'home', 'url': 'http://localhost:8123/api/webhook/atv'}
+#   {'type': 'unix_socket', 'name': 'socket', 'path': '/run/atv-events.sock'}
+#   {'type': 'file', 'name': 'file', 'file_name': 'events.jsonl'}
+#   Each may also override queue_size, timeout_seconds, failures_until_open, and open_seconds (defaults below)
+SINKS: list = []
+
+# The maximum number of events waiting to be sent to each sink before new ones are dropped
+SINK_QUEUE_SIZE: int = 100
+
+# The number of seconds to wait for an event to be sent to a sink before treating it as failed
+SINK_TIMEOUT_SECONDS: float = 5
+
+# The number of failures in a row after which a sink's circuit breaker opens, dropping its events for SINK_OPEN_SECONDS
+#   before trying one event again
+SINK_FAILURES_UNTIL_OPEN: int = 5
+SINK_OPEN_SECONDS: float = 30
+
+# The port to serve metrics on in Prometheus text format (at http://METRICS_HOST:METRICS_PORT/metrics), or 0 to not serve them
+METRICS_PORT: int = 0
+
+# The address to serve metrics on, where '127.0.0.1' only allows requests from this machine and '0.0.0.0' allows any
+METRICS_HOST: str = '127.0.0.1'
+
+# The port to serve the state of each connected Apple TV on, as JSON at http://STATE_SERVER_HOST:STATE_SERVER_PORT/devices
+#   and as a WebSocket stream of changes at ws://STATE_SERVER_HOST:STATE_SERVER_PORT/stream, or 0 to not serve it
+STATE_SERVER_PORT: int = 0
+
+# The address to serve state on, where '127.0.0.1' only allows requests from this machine and '0.0.0.0' allows any
+STATE_SERVER_HOST: str = '127.0.0.1'
+
+# The number of messages a state stream client may fall behind by before it is disconnected
+STATE_SERVER_CLIENT_QUEUE_SIZE: int = 1000
+
+# The minimum level of logs to write: 'DEBUG', 'INFO', 'WARNING', or 'ERROR'
+LOG_LEVEL: str = 'INFO'
+
+# Levels for individual loggers, overriding LOG_LEVEL, e.g. {'PushListener': 'WARNING'} to hide every push update
+LOG_LEVELS: dict = {}
+
+# Whether to write logs as JSON lines (one JSON object per line) instead of text
+LOG_JSON_LINES: bool = False
+
+# The file to write logs to, or '' to write them to stdout (and warnings and errors to stderr)
+LOG_FILE_NAME: str = ''
@@ -0,0 +1,204 @@
+"""Fills in settings missing from config.py with their defaults in config-sample.py, overrides them with those in
+config.json, and reloads them while running when config.json changes
+
+Imported by each entry point before any other module of this project (other than config), so that these settings also
+apply to defaults which are read from config when modules are imported. The modules it imports itself (log, metrics, and
+utils) only read settings when called.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import time
+from typing import Any, Callable, Optional
+
+import config
+from log import apply_log_levels, get_logger
+from metrics import CONFIG_RELOADS
+from utils import s_if_plural
+
+
+# The path of config-sample.py, whose settings are the defaults for those missing from config.py (e.g. settings added since
+#   it was copied to config.py)
+CONFIG_SAMPLE_PATH: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config-sample.py')
+
+# The filename of the config JSON file, relative to the root path, whose settings override those in config.py
+CONFIG_FILE_NAME: str = 'config.json'
+
+# The number of seconds between checks of whether config.json changed
+CONFIG_FILE_POLL_INTERVAL_SECONDS: float = 2
+
+# Settings which take effect while running when changed in config.json, either because they are read from config each
+#   time they are used, or because a reload callback applies them. Others take effect after restarting.
+RELOADABLE_SETTINGS: frozenset = frozenset({
+    'SCAN_TIMEOUT_SECONDS', 'DISCOVERY_CACHE_SCAN_TIMEOUT_SECONDS', 'CONNECT_TIMEOUT_SECONDS',
+    'RECONNECT_INITIAL_DELAY_SECONDS', 'RECONNECT_MAX_DELAY_SECONDS', 'HEALTH_PROBE_MIN_INTERVAL_SECONDS',
+    'HEALTH_PROBE_MAX_INTERVAL_SECONDS', 'HEALTH_PROBE_TIMEOUT_SECONDS', 'HEALTH_PROBE_FAILURES_UNTIL_DEAD',
+    'PRESENCE_MIN_INTERVAL_SECONDS', 'PRESENCE_MAX_INTERVAL_SECONDS', 'PRESENCE_SCAN_TIMEOUT_SECONDS',
+    'PRESENCE_GONE_AFTER_MISSES', 'ARTWORK_WIDTH', 'ARTWORK_CACHE_MAX_BYTES', 'ARTWORK_CACHE_DISK_MAX_BYTES',
+    'POWER_OFF_STABLE_AFTER_SECONDS', 'VOLUME_STABLE_AFTER_SECONDS', 'PUSH_POSITION_UPDATE_INTERVAL_SECONDS',
+    'TASK_MAX_CONCURRENT_PER_DEVICE', 'TASK_MAX_BACKLOG_PER_DEVICE', 'SHUTDOWN_DRAIN_TIMEOUT_SECONDS', 'IFTTT_API_KEY',
+    'IFTTT_MAX_RETRIES', 'IFTTT_REQUEST_TIMEOUT_SECONDS', 'LOG_LEVEL', 'LOG_LEVELS',
+})
+
+logger = get_logger()
+
+# The value of every setting in config.py (or config-sample.py), used for settings which are not (or no longer) in config.json
+_base_settings: dict[str, Any] = {}
+_reload_callbacks: list[Callable[[set[str]], None]] = []
+_file_stamp: Optional[tuple] = None
+_watcher_task: Optional[asyncio.Task] = None
+
+
+def get_settings(module: Any) -> dict[str, Any]:
+    """Return the settings defined in a config module, by name"""
+    return {name: value for name, value in vars(module).items() if name.isupper() and not name.startswith('_')}
+
+
+def fill_in_default_settings(sample_path: str = CONFIG_SAMPLE_PATH) -> set[str]:
+    """Set each setting which is in config-sample.py but missing from config.py to its default value, and return their names,
+    so that a config.py copied from an older config-sample.py keeps working"""
+    if not os.path.exists(sample_path):
+        return set()
+    spec = importlib.util.spec_from_file_location('config_sample', sample_path)
+    config_sample = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config_sample)
+    missing_names = set()
+    for name, value in get_settings(config_sample).items():
+        if not hasattr(config, name):
+            setattr(config, name, value)
+            missing_names.add(name)
+    return missing_names
+
+
+def validate_settings(settings: Any) -> list[str]:
+    """Return a description of each problem with the settings from the config JSON file, or an empty list if they are valid
+
+    Each setting must be one defined in config.py (or config-sample.py), with a value of the same type (any number for
+    number settings), and numbers may not be negative"""
+    if not isinstance(settings, dict):
+        return ['expected a JSON object of settings']
+    problems = []
+    for name, value in settings.items():
+        if name not in _base_settings:
+            problems.append('unknown setting {0:s}'.format(name))
+            continue
+        base_value = _base_settings[name]
+        if isinstance(base_value, bool) or isinstance(value, bool):
+            is_valid_type = isinstance(value, bool) and isinstance(base_value, bool)
+        elif isinstance(base_value, (int, float)):
+            is_valid_type = isinstance(value, (int, float))
+            if is_valid_type and value < 0:
+                problems.append('{0:s} may not be negative'.format(name))
+        else:
+            is_valid_type = isinstance(value, type(base_value))
+        if not is_valid_type:
+            problems.append('{0:s} must be a {1:s}, not {2:s}'.format(
+                name, type(base_value).__name__, type(value).__name__))
+    return problems
+
+
+def get_file_stamp(file_name: str) -> Optional[tuple]:
+    """Return the modification time and size of the file, which change whenever it is written, or None if it does not exist"""
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_settings(file_name: str) -> dict:
+    """Read and validate the settings in the config JSON file, raising a ValueError if it is invalid"""
+    try:
+        with open(file_name, 'r') as openfile:
+            settings = json.load(openfile)
+    except json.JSONDecodeError as ex:
+        raise ValueError('invalid JSON: {0}'.format(ex))
+    problems = validate_settings(settings)
+    if problems:
+        raise ValueError('; '.join(problems))
+    return settings
+
+
+def apply_settings(settings: dict) -> set[str]:
+    """Set every setting to its value in settings, or else in config.py (or config-sample.py), and return the names of those
+    which changed
+
+    Every setting is set before returning, without awaiting anything in between, so the event loop never runs code which
+    sees a mix of old and new settings"""
+    changed_names = set()
+    for name, base_value in _base_settings.items():
+        value = settings.get(name, base_value)
+        if getattr(config, name) != value:
+            setattr(config, name, value)
+            changed_names.add(name)
+    return changed_names
+
+
+def on_config_reload(callback: Callable[[set[str]], None]):
+    """Call callback with the names of the changed settings whenever config.json is reloaded, to apply them to running
+    objects (like listeners) which copied them when they were created"""
+    _reload_callbacks.append(callback)
+
+
+def load_config_file(file_name: str = CONFIG_FILE_NAME) -> bool:
+    """Apply the settings in the config JSON file over those in config.py, and return whether it was valid
+
+    An invalid file is logged and ignored, keeping the current settings. A missing file restores the settings in config.py"""
+    global _file_stamp
+    start_time = time.perf_counter()
+    _file_stamp = get_file_stamp(file_name)
+    try:
+        settings = read_settings(file_name) if _file_stamp is not None else {}
+    except (OSError, ValueError) as ex:
+        CONFIG_RELOADS.inc('invalid')
+        logger.error('Ignoring %s, keeping the current settings! Details: %s', file_name, ex)
+        return False
+
+    changed_names = apply_settings(settings)
+    if not changed_names:
+        return True
+    if changed_names & {'LOG_LEVEL', 'LOG_LEVELS'}:
+        apply_log_levels()
+    for callback in _reload_callbacks:
+        try:
+            callback(changed_names)
+        except Exception as ex:
+            logger.error('Failed to apply reloaded settings! Details: %r', ex)
+    CONFIG_RELOADS.inc('applied')
+    logger.info('Applied %d setting%s from %s in %.1fms: %s', len(changed_names), s_if_plural(len(changed_names)),
+                file_name, (time.perf_counter() - start_time) * 1000, ', '.join(sorted(changed_names)))
+    restart_names = changed_names - RELOADABLE_SETTINGS
+    if restart_names and _watcher_task is not None:
+        logger.warning('Restart to apply: %s', ', '.join(sorted(restart_names)))
+    return True
+
+
+async def watch_config_file(file_name: str = CONFIG_FILE_NAME, poll_interval_seconds: float = CONFIG_FILE_POLL_INTERVAL_SECONDS):
+    """Reload the config JSON file whenever its modification time or size changes"""
+    while True:
+        await asyncio.sleep(poll_interval_seconds)
+        if get_file_stamp(file_name) != _file_stamp:
+            load_config_file(file_name)
+
+
+def start_config_watcher():
+    """Start reloading config.json when it changes, if not already started (requires a running event loop)"""
+    global _watcher_task
+    if _watcher_task is None:
+        _watcher_task = asyncio.ensure_future(watch_config_file())
+
+
+def stop_config_watcher():
+    global _watcher_task
+    if _watcher_task is not None:
+        _watcher_task.cancel()
+        _watcher_task = None
+
+
+_default_names = fill_in_default_settings()
+if _default_names:
+    logger.debug('Using the defaults in config-sample.py for %d setting%s missing from config.py: %s', len(_default_names),
+                 s_if_plural(len(_default_names)), ', '.join(sorted(_default_names)))
+_base_settings.update(get_settings(config))
+load_config_file()
@@ -1,22 +1,27 @@
 import asyncio
 import inquirer
 from pyatv import connect, interface
-import sys
 
+# Imported before other modules of this project, so that settings missing from config.py (and those in config.json) apply
+#   to their defaults too
+import config_file
+from log import flush_logs, get_logger
 from pair_apple_tvs import pair_apple_tv
-from utils import CREDENTIALS_LAST_CONNECTED_KEY, get_apple_tvs, get_credentials, get_device_summary_str, get_inquirer_padding, get_log_prefix, protocol_str_to_protocol, read_credentials_json, save_last_connected
+from utils import CREDENTIALS_LAST_CONNECTED_KEY, get_apple_tvs, get_credentials, get_device_summary_str, get_inquirer_padding, get_paired_mac_adrs, protocol_str_to_protocol, read_credentials_json, save_last_connected
 
 
-async def connect_apple_tv() -> interface.AppleTV:
-    """Scan for Apple TVs on network, ask which one to connect to, pair if needed, establish connection, and return connected_apple_tv.
+logger = get_logger()
 
-    NOTE: connected_apple_tv.close() must be called when finished"""
-    loop = asyncio.get_event_loop()
-    apple_tvs = await get_apple_tvs()
 
+async def select_apple_tv() -> interface.BaseConfig:
+    """Scan for Apple TVs on network, ask which one to connect to, pair if needed, and return its config with credentials set
+
+    When every paired Apple TV is found at its last-known address, only those are offered, skipping the full network scan.
+    Use pair_apple_tvs.py to pair additional Apple TVs."""
     credentials = read_credentials_json()
-    mac_adrs_with_credentials = [
-        mac_adr for mac_adr in credentials.keys() if not mac_adr.startswith('_')]
+    mac_adrs_with_credentials = get_paired_mac_adrs()
+
+    apple_tvs = await get_apple_tvs(mac_adrs_with_credentials)
 
     apple_tvs_mac_adrs = [''] * len(apple_tvs)
     apple_tvs_is_paired = [False] * len(apple_tvs)
@@ -53,6 +58,7 @@ async def connect_apple_tv() -> interface.AppleTV:
             choices=device_connect_summary_strs,
             default=device_connect_summary_strs[idx_to_connect]
         )
+        flush_logs()
         answers = inquirer.prompt(
             [select_to_connect], raise_keyboard_interrupt=True)
         idx_to_connect = device_connect_summary_strs.index(
@@ -61,23 +67,32 @@ async def connect_apple_tv() -> interface.AppleTV:
     if not apple_tvs_is_paired[idx_to_connect]:
         # Selected Apple TV has not yet been paired, so pair it before attempting to connect
         await pair_apple_tv(apple_tvs[idx_to_connect], device_connect_summary_strs[idx_to_connect])
-        return await connect_apple_tv()
+        return await select_apple_tv()
 
-    print(
-        f'{get_log_prefix()}Connecting to {get_device_summary_str(apple_tvs[idx_to_connect])}...')
     # Set credentials for each protocol
     for protocol_str, credentials in get_credentials(apple_tvs_mac_adrs[idx_to_connect]).items():
         apple_tvs[idx_to_connect].set_credentials(
             protocol_str_to_protocol(protocol_str), credentials)
 
+    return apple_tvs[idx_to_connect]
+
+
+async def connect_apple_tv() -> interface.AppleTV:
+    """Scan for Apple TVs on network, ask which one to connect to, pair if needed, establish connection, and return connected_apple_tv.
+
+    NOTE: connected_apple_tv.close() must be called when finished"""
+    loop = asyncio.get_event_loop()
+    apple_tv = await select_apple_tv()
+
+    logger.info('Connecting to %s...', get_device_summary_str(apple_tv))
     connected_apple_tv = None
     try:
-        connected_apple_tv = await connect(apple_tvs[idx_to_connect], loop)
-        print(
-            f'{get_log_prefix()}Successfully connected to {get_device_summary_str(apple_tvs[idx_to_connect])}!')
-        save_last_connected(apple_tvs_mac_adrs[idx_to_connect])
+        connected_apple_tv = await connect(apple_tv, loop)
+        logger.info('Successfully connected to %s!',
+                    get_device_summary_str(apple_tv))
+        save_last_connected(apple_tv.device_info.mac)
     except:
-        print(
-            f'{get_log_prefix()}ERROR: Failed to connect to {get_device_summary_str(apple_tvs[idx_to_connect])}!', file=sys.stderr)
+        logger.error('Failed to connect to %s!',
+                     get_device_summary_str(apple_tv))
     finally:
         return connected_apple_tv
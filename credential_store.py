@@ -0,0 +1,220 @@
+import asyncio
+import atexit
+from contextlib import contextmanager
+import copy
+import json
+import os
+import tempfile
+from typing import Callable, Optional
+
+from log import get_logger
+from utils import CREDENTIALS_FILE_NAME, CREDENTIALS_LAST_CONNECTED_KEY
+
+try:
+    import fcntl
+except ImportError:
+    # fcntl is not available on Windows, so msvcrt is used for locking instead
+    fcntl = None
+    import msvcrt
+
+
+# The number of seconds to wait after an update before writing, so that bursts of updates are coalesced into one write
+WRITE_DELAY_SECONDS: float = 0.5
+
+logger = get_logger()
+
+
+@contextmanager
+def file_lock(lock_file_name: str):
+    """Hold an exclusive inter-process lock on the provided lock file for the duration of the with block"""
+    with open(lock_file_name, 'a+') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_file_atomically(file_name: str, contents: str):
+    """Write contents to a temp file next to file_name, fsync it, then rename it over file_name
+
+    A crash at any point leaves either the old or the new contents in place, never a partial file
+    """
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_file_name = tempfile.mkstemp(
+        dir=dir_name, prefix='.{0:s}.'.format(os.path.basename(file_name)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(contents)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+    if hasattr(os, 'O_DIRECTORY'):
+        # Persist the rename itself (not supported on Windows)
+        dir_fd = os.open(dir_name, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class CredentialStore:
+    """In-memory view of the credentials JSON file
+
+    The file is loaded once and reads are served from memory. It is only re-read when its modification time or size changes,
+    for example when another process has written to it. Updates are applied in memory immediately, then coalesced into a
+    single atomic write, guarded by a lock file so that multiple processes can share the store.
+
+    NOTE: flush() should be called before exiting, which is done automatically at interpreter exit for get_credential_store()"""
+    file_name: str
+    lock_file_name: str
+    write_delay_seconds: float
+
+    def __init__(self, file_name: str = CREDENTIALS_FILE_NAME, write_delay_seconds: float = WRITE_DELAY_SECONDS):
+        self.file_name = file_name
+        self.lock_file_name = file_name + '.lock'
+        self.write_delay_seconds = write_delay_seconds
+        self._credentials: dict = {}
+        self._file_signature: Optional[tuple] = None
+        # Updates not yet written, replayed over the file's latest contents when writing so that other processes' updates are kept
+        self._pending_updates: list[Callable[[dict], None]] = []
+        self._write_handle: Optional[asyncio.TimerHandle] = None
+        self._load()
+
+    def _get_file_signature(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.file_name)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _read_file(self) -> dict:
+        """Read and return contents of the credentials JSON file, or {} if it does not exist or is empty"""
+        self._file_signature = self._get_file_signature()
+        if self._file_signature is None:
+            return {}
+        with open(self.file_name, 'r') as openfile:
+            contents = openfile.read()
+        if not contents.strip():
+            return {}
+        try:
+            return json.loads(contents)
+        except ValueError:
+            logger.error(
+                '%s is not valid JSON! Fix or remove it before continuing.', self.file_name)
+            raise
+
+    def _load(self):
+        self._credentials = self._read_file()
+        for update in self._pending_updates:
+            update(self._credentials)
+
+    def _reload_if_changed(self):
+        if self._get_file_signature() != self._file_signature:
+            self._load()
+
+    def _update(self, update: Callable[[dict], None]):
+        """Apply update to the in-memory credentials and schedule a coalesced write"""
+        self._reload_if_changed()
+        update(self._credentials)
+        self._pending_updates.append(update)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Without a running event loop, nothing would trigger a delayed write, so write now
+            self.flush()
+            return
+        if self._write_handle is None:
+            self._write_handle = loop.call_later(
+                self.write_delay_seconds, self.flush)
+
+    def get_all(self) -> dict:
+        """Return a copy of all contents of the credentials JSON file"""
+        self._reload_if_changed()
+        return copy.deepcopy(self._credentials)
+
+    def get_credentials(self, device_mac: str) -> Optional[dict]:
+        """Return a copy of the credentials for provided device_mac or None if not saved"""
+        self._reload_if_changed()
+        credentials = self._credentials.get(device_mac)
+        return dict(credentials) if credentials is not None else None
+
+    def get_paired_mac_adrs(self) -> list[str]:
+        """Return MAC addresses of all devices with credentials"""
+        self._reload_if_changed()
+        return [mac_adr for mac_adr in self._credentials.keys() if not mac_adr.startswith('_')]
+
+    def get_last_connected(self) -> Optional[str]:
+        self._reload_if_changed()
+        return self._credentials.get(CREDENTIALS_LAST_CONNECTED_KEY)
+
+    def save_credential(self, device_mac: str, protocol: str, value: str):
+        """Add or update the credentials for provided device_mac and protocol"""
+        def update(credentials: dict):
+            credentials.setdefault(device_mac, {})[protocol] = value
+        self._update(update)
+
+    def save_credentials(self, credentials_by_device_mac: dict[str, dict[str, str]]):
+        """Add or update credentials for many devices and protocols at once, as {device_mac: {protocol: value}}"""
+        credentials_by_device_mac = copy.deepcopy(credentials_by_device_mac)
+
+        def update(credentials: dict):
+            for device_mac, values in credentials_by_device_mac.items():
+                credentials.setdefault(device_mac, {}).update(values)
+        self._update(update)
+
+    def save_last_connected(self, device_mac: str):
+        def update(credentials: dict):
+            credentials[CREDENTIALS_LAST_CONNECTED_KEY] = device_mac
+        self._update(update)
+
+    def replace_all(self, credentials_json: dict):
+        """Replace all contents of the credentials JSON file"""
+        credentials_json = copy.deepcopy(credentials_json)
+
+        def update(credentials: dict):
+            credentials.clear()
+            credentials.update(copy.deepcopy(credentials_json))
+        self._update(update)
+
+    def flush(self):
+        """Write any pending updates to the credentials JSON file now"""
+        if self._write_handle is not None:
+            self._write_handle.cancel()
+            self._write_handle = None
+        if not self._pending_updates:
+            return
+
+        with file_lock(self.lock_file_name):
+            # Re-read under the lock, since another process may have written since this one last read
+            self._reload_if_changed()
+            write_file_atomically(
+                self.file_name, json.dumps(self._credentials, indent=2))
+            self._pending_updates = []
+            self._file_signature = self._get_file_signature()
+
+
+_credential_store: Optional[CredentialStore] = None
+
+
+def get_credential_store() -> CredentialStore:
+    """Return the shared CredentialStore, loading the credentials JSON file if needed"""
+    global _credential_store
+    if _credential_store is None:
+        _credential_store = CredentialStore()
+        atexit.register(_credential_store.flush)
+    return _credential_store
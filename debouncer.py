@@ -0,0 +1,75 @@
+import asyncio
+from typing import Any, Callable, Container, Optional
+
+
+class Debouncer:
+    """Report a state as stable once it has gone a quiet period without any further changes
+
+    Each update to a state other than the current stable state (re)starts a timer on the event loop. If the state flips back
+    to the stable state before the timer fires, the pending emission is cancelled. Otherwise, on_stable(old, new) is called
+    when the timer fires, even if no further updates arrive, so the latency of a stable change is bounded by its quiet period.
+
+    The quiet period may differ per state (e.g. power On is stable immediately, but Off only after a while), and updates to
+    ignored states (e.g. power Unknown) are discarded.
+
+    NOTE: cancel() should be called when finished"""
+    stable_state: Any
+    pending_state: Any = None
+    on_stable: Callable[[Any, Any], None]
+    quiet_period_seconds: float
+    quiet_periods_seconds: dict
+    ignored_states: Container
+
+    def __init__(self, initial_state: Any, on_stable: Callable[[Any, Any], None], quiet_period_seconds: float = 0,
+                 quiet_periods_seconds: Optional[dict] = None, ignored_states: Container = ()):
+        self.stable_state = initial_state
+        self.on_stable = on_stable
+        self.quiet_period_seconds = quiet_period_seconds
+        self.quiet_periods_seconds = quiet_periods_seconds or {}
+        self.ignored_states = ignored_states
+        self._timer_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def is_pending(self) -> bool:
+        return self._timer_handle is not None
+
+    def get_quiet_period_seconds(self, state: Any) -> float:
+        return self.quiet_periods_seconds.get(state, self.quiet_period_seconds)
+
+    def update(self, new_state: Any) -> bool:
+        """Report a new state, returning whether it is now stable or pending (False if it was ignored or already stable)"""
+        if new_state in self.ignored_states:
+            return False
+
+        if new_state == self.stable_state:
+            # Flipped back before the pending state became stable
+            self.cancel()
+            return False
+
+        if new_state == self.pending_state and self.is_pending:
+            # Repeated update of the pending state, so keep waiting out the original quiet period
+            return True
+
+        self.cancel()
+        quiet_period_seconds = self.get_quiet_period_seconds(new_state)
+        if quiet_period_seconds <= 0:
+            self._emit(new_state)
+        else:
+            self.pending_state = new_state
+            self._timer_handle = asyncio.get_event_loop().call_later(
+                quiet_period_seconds, self._emit, new_state)
+        return True
+
+    def _emit(self, new_state: Any):
+        self._timer_handle = None
+        self.pending_state = None
+        old_state = self.stable_state
+        self.stable_state = new_state
+        self.on_stable(old_state, new_state)
+
+    def cancel(self):
+        """Cancel any pending emission"""
+        if self._timer_handle is not None:
+            self._timer_handle.cancel()
+            self._timer_handle = None
+        self.pending_state = None
@@ -0,0 +1,290 @@
+import asyncio
+from collections import deque
+from pyatv import connect, const, interface
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+import config
+from config_file import on_config_reload
+from events import EVENT_CONNECTED, emit_event
+from health_probe import HealthProbe, get_probe_port
+from listeners.audio_listener import AudioListener
+from listeners.device_listener import DeviceListener
+from listeners.keyboard_listener import KeyboardListener
+from listeners.power_listener import PowerListener
+from listeners.push_listener import PushListener
+from log import get_logger
+from metrics import CONNECTION_LOSSES, OUTAGE_SECONDS, RECONNECT_ATTEMPTS
+from utils import get_credentials, get_device_summary_str, protocol_str_to_protocol
+
+
+# The number of most recent outages kept for each device
+MAX_OUTAGES_KEPT: int = 100
+
+# The names of listeners which may be enabled (see: config.LISTENERS), besides the DeviceListener which is always added
+LISTENER_NAMES: tuple = ('audio', 'keyboard', 'power', 'push')
+
+logger = get_logger()
+
+
+class DeviceSession:
+    """Connection to a single paired Apple TV, along with the listeners attached to it.
+
+    When the connection is lost, it is re-established in the background with capped exponential backoff, reusing the same
+    config and credentials (without rescanning), and the same listeners are reattached.
+    With health_probe_enabled, the connection is also probed periodically, so that a dead connection is detected (and
+    re-established) without waiting for the OS to give up on it.
+
+    NOTE: close() must be called when finished"""
+    apple_tv: interface.BaseConfig
+    device_summary_str: str
+    connected_apple_tv: interface.AppleTV = None
+    connect_function: Callable[..., Awaitable[interface.AppleTV]]
+    listener_names: tuple
+
+    # pyatv only holds weak references to listeners, so they are kept alive here
+    audio_listener: AudioListener = None
+    device_listener: DeviceListener = None
+    keyboard_listener: KeyboardListener = None
+    power_listener: PowerListener = None
+    push_listener: PushListener = None
+
+    # Probes the connection while connected, if health_probe_enabled (see: ./health_probe.py)
+    health_probe: Optional[HealthProbe] = None
+
+    # Each outage, as (unix timestamp when the connection was lost, seconds until it was re-established)
+    outages: deque
+
+    def __init__(self, apple_tv: interface.BaseConfig, connect_function: Callable[..., Awaitable[interface.AppleTV]] = connect,
+                 listener_names: Iterable[str] = config.LISTENERS, health_probe_enabled: bool = config.HEALTH_PROBE_ENABLED):
+        self.apple_tv = apple_tv
+        self.device_summary_str = get_device_summary_str(apple_tv)
+        self.connect_function = connect_function
+        self.listener_names = tuple(listener_names)
+        for listener_name in self.listener_names:
+            if listener_name not in LISTENER_NAMES:
+                raise ValueError('Unknown listener "{0:s}", expected one of: {1:s}'.format(
+                    listener_name, ', '.join(LISTENER_NAMES)))
+        self.health_probe_enabled = health_probe_enabled
+        self.outages = deque(maxlen=MAX_OUTAGES_KEPT)
+        self._is_closed = False
+        self._reconnect_task: Optional[asyncio.Task] = None
+        _device_sessions[self.device_mac] = self
+
+    @property
+    def device_mac(self) -> str:
+        return self.apple_tv.device_info.mac
+
+    @property
+    def is_reconnecting(self) -> bool:
+        return self._reconnect_task is not None and not self._reconnect_task.done()
+
+    async def connect(self) -> bool:
+        """Set saved credentials for each protocol, establish connection, and return whether it succeeded"""
+        logger.info('Connecting to %s...', self.device_summary_str)
+        for protocol_str, credentials in (get_credentials(self.device_mac) or {}).items():
+            self.apple_tv.set_credentials(
+                protocol_str_to_protocol(protocol_str), credentials)
+
+        start_time = time.perf_counter()
+        try:
+            self.connected_apple_tv = await asyncio.wait_for(
+                self.connect_function(self.apple_tv, asyncio.get_running_loop()), config.CONNECT_TIMEOUT_SECONDS)
+            logger.info('Successfully connected to %s in %.2fs!',
+                        self.device_summary_str, time.perf_counter() - start_time)
+            self.start_health_probe()
+            return True
+        except Exception as ex:
+            logger.error('Failed to connect to %s! Details: %r',
+                         self.device_summary_str, ex)
+            return False
+
+    def add_listeners(self):
+        """Create the enabled listeners for this device, if not already created, and attach them to the connection
+
+        Listeners are enabled by listener_names (config.LISTENERS by default). For more information about each listener, see:
+        https://pyatv.dev/development/listeners/
+
+        Listeners are reused when reconnecting, so that their state (like the previous stable power state) carries over"""
+        # DeviceListener, which is always added since it reports lost connections
+        self.device_listener = self.device_listener or DeviceListener(
+            self.apple_tv.name, self.handle_connection_lost, self.device_mac)
+        self.connected_apple_tv.listener = self.device_listener
+
+        if 'audio' in self.listener_names:
+            self.audio_listener = self.audio_listener or AudioListener(
+                self.apple_tv.name, self.device_mac)
+            self.connected_apple_tv.audio.listener = self.audio_listener
+
+        if 'keyboard' in self.listener_names:
+            self.keyboard_listener = self.keyboard_listener or KeyboardListener(
+                self.apple_tv.name, self.device_mac)
+            self.connected_apple_tv.keyboard.listener = self.keyboard_listener
+
+        if 'power' in self.listener_names:
+            if self.power_listener:
+                # Catch up on any power state change that happened while disconnected
+                power_state = self.connected_apple_tv.power.power_state
+                if power_state != self.power_listener.prev_stable_state:
+                    self.power_listener.powerstate_update(
+                        self.power_listener.prev_stable_state, power_state)
+            else:
+                self.power_listener = PowerListener(
+                    self.connected_apple_tv.power.power_state, self.apple_tv.name, self.device_mac)
+            self.connected_apple_tv.power.listener = self.power_listener
+
+        if 'push' in self.listener_names:
+            self.push_listener = self.push_listener or PushListener(
+                self.apple_tv.name, self.device_mac, fetch_artwork=self.fetch_artwork if config.ARTWORK_ENABLED else None)
+            self.connected_apple_tv.push_updater.listener = self.push_listener
+            self.connected_apple_tv.push_updater.start()
+
+        logger.info('Successfully added listeners for %s!',
+                    self.device_summary_str)
+        emit_event(EVENT_CONNECTED, self.device_mac,
+                   self.apple_tv.name, None, None)
+
+    async def start(self) -> bool:
+        """Connect and add listeners, returning whether the device is now connected
+
+        If the first connection attempt fails, keep retrying in the background"""
+        if not await self.connect():
+            self.schedule_reconnect()
+            return False
+        self.add_listeners()
+        return True
+
+    async def fetch_artwork(self) -> Optional[interface.ArtworkInfo]:
+        """Request the artwork of what is playing from the device, or return None if there is none"""
+        if self.connected_apple_tv is None:
+            raise ConnectionError('{0:s} is not connected'.format(self.device_summary_str))
+        return await self.connected_apple_tv.metadata.artwork(width=config.ARTWORK_WIDTH)
+
+    def start_health_probe(self):
+        """Start probing the new connection, if health_probe_enabled and the device has a service with a known port"""
+        self.stop_health_probe()
+        if not self.health_probe_enabled:
+            return
+        port = get_probe_port(self.apple_tv)
+        if port is None:
+            logger.warning('Not probing the connection to %s, since none of its services has a known port',
+                           self.device_summary_str)
+            return
+        self.health_probe = HealthProbe(str(self.apple_tv.address), port, self.handle_health_probe_dead,
+                                        self.apple_tv.name, self.device_mac,
+                                        config.HEALTH_PROBE_MIN_INTERVAL_SECONDS, config.HEALTH_PROBE_MAX_INTERVAL_SECONDS,
+                                        config.HEALTH_PROBE_TIMEOUT_SECONDS, config.HEALTH_PROBE_FAILURES_UNTIL_DEAD)
+        self.health_probe.start()
+
+    def stop_health_probe(self):
+        if self.health_probe:
+            self.health_probe.stop()
+            self.health_probe = None
+
+    def handle_health_probe_dead(self, exception: Exception):
+        """Treat the connection as lost after the health probe failed repeatedly, as if pyatv had reported it"""
+        self.health_probe = None
+        if self.device_listener:
+            # Emits a connection_lost event, then calls handle_connection_lost()
+            self.device_listener.connection_lost(exception)
+        else:
+            self.handle_connection_lost(exception)
+
+    def handle_connection_lost(self, exception: Exception):
+        """Start reconnecting after the connection was unexpectedly lost (called by DeviceListener)"""
+        CONNECTION_LOSSES.inc(self.device_mac)
+        self.stop_health_probe()
+        if self.connected_apple_tv:
+            # Release any resources still held by the dead connection
+            self.connected_apple_tv.close()
+            self.connected_apple_tv = None
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self._is_closed or self.is_reconnecting:
+            return
+        self._reconnect_task = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        """Reconnect with capped exponential backoff until successful, then reattach listeners and record the outage"""
+        outage_start_time = time.time()
+        attempt = 0
+        while True:
+            delay = min(config.RECONNECT_MAX_DELAY_SECONDS,
+                        config.RECONNECT_INITIAL_DELAY_SECONDS * 2 ** attempt)
+            logger.info('Reconnecting to %s in %ss (attempt %d)...',
+                        self.device_summary_str, delay, attempt + 1)
+            await asyncio.sleep(delay)
+            if await self.connect():
+                RECONNECT_ATTEMPTS.inc(self.device_mac, 'success')
+                break
+            RECONNECT_ATTEMPTS.inc(self.device_mac, 'failure')
+            attempt += 1
+
+        downtime_seconds = time.time() - outage_start_time
+        self.outages.append((outage_start_time, downtime_seconds))
+        OUTAGE_SECONDS.observe(downtime_seconds, self.device_mac)
+        logger.info('Reconnected to %s after %.1fs of downtime',
+                    self.device_summary_str, downtime_seconds)
+        self.add_listeners()
+
+    def update_apple_tv(self, apple_tv: interface.BaseConfig):
+        """Use a newly discovered config for this device (e.g. with a new address after a DHCP lease change) from the next
+        connection attempt on, without closing the current connection (see: ./presence.py)"""
+        self.apple_tv = apple_tv
+        self.device_summary_str = get_device_summary_str(apple_tv)
+
+    def apply_config(self):
+        """Apply reloaded settings to the listeners and health probe, which copied them when they were created"""
+        if self.power_listener:
+            self.power_listener.debouncer.quiet_periods_seconds[
+                const.PowerState.Off] = config.POWER_OFF_STABLE_AFTER_SECONDS
+        if self.audio_listener:
+            self.audio_listener.volume_debouncer.quiet_period_seconds = config.VOLUME_STABLE_AFTER_SECONDS
+        if self.push_listener:
+            self.push_listener.position_update_interval_seconds = config.PUSH_POSITION_UPDATE_INTERVAL_SECONDS
+        if self.health_probe:
+            self.health_probe.min_interval_seconds = config.HEALTH_PROBE_MIN_INTERVAL_SECONDS
+            self.health_probe.max_interval_seconds = config.HEALTH_PROBE_MAX_INTERVAL_SECONDS
+            self.health_probe.timeout_seconds = config.HEALTH_PROBE_TIMEOUT_SECONDS
+            self.health_probe.failures_until_dead = config.HEALTH_PROBE_FAILURES_UNTIL_DEAD
+
+    def close(self):
+        self._is_closed = True
+        if _device_sessions.get(self.device_mac) is self:
+            del _device_sessions[self.device_mac]
+        # Stop any pending stable state from being reported after closing
+        if self.power_listener:
+            self.power_listener.debouncer.cancel()
+        if self.audio_listener:
+            self.audio_listener.volume_debouncer.cancel()
+        if self.push_listener:
+            self.push_listener.cancel()
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        self.stop_health_probe()
+        if self.connected_apple_tv:
+            self.connected_apple_tv.close()
+            self.connected_apple_tv = None
+
+
+# Open sessions by device MAC address, so that their connections can be used to send commands (see: ./macros.py)
+_device_sessions: dict[str, DeviceSession] = {}
+
+
+def get_device_session(device: str) -> Optional[DeviceSession]:
+    """Return the open session for the device with the provided MAC address or name, or None if there is none"""
+    device_session = _device_sessions.get(device.upper())
+    if device_session is None:
+        device_session = next((device_session for device_session in _device_sessions.values()
+                               if device_session.apple_tv.name == device), None)
+    return device_session
+
+
+def apply_config_to_device_sessions(changed_names: set[str]):
+    for device_session in _device_sessions.values():
+        device_session.apply_config()
+
+
+on_config_reload(apply_config_to_device_sessions)
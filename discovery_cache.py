@@ -0,0 +1,76 @@
+import json
+import os
+from typing import Iterable, Optional
+
+from pyatv import interface
+
+from credential_store import write_file_atomically
+from log import get_logger
+from utils import service_to_protocol_str
+
+
+# The filename of the discovery cache JSON file, relative to the root path
+DISCOVERY_CACHE_FILE_NAME: str = 'discovery_cache.json'
+
+logger = get_logger()
+
+
+class DiscoveryCache:
+    """Persisted last-known address and service ports of each discovered Apple TV, keyed by MAC address
+
+    Used to scan known hosts directly (unicast) on startup, instead of waiting on a full network (multicast) scan"""
+    file_name: str
+
+    def __init__(self, file_name: str = DISCOVERY_CACHE_FILE_NAME):
+        self.file_name = file_name
+        self._entries: dict = {}
+        if os.path.exists(self.file_name):
+            try:
+                with open(self.file_name, 'r') as openfile:
+                    self._entries = json.load(openfile)
+            except ValueError:
+                # The cache only speeds up startup, so it is safe to discard
+                logger.warning('Ignoring invalid %s', self.file_name)
+
+    def get_entry(self, device_mac: str) -> Optional[dict]:
+        """Return the cached entry for provided device_mac, like {"address": ..., "name": ..., "ports": {protocol: port}}"""
+        return self._entries.get(device_mac)
+
+    def get_hosts(self, device_macs: Iterable[str]) -> Optional[list[str]]:
+        """Return the last-known address of each provided device_mac, or None if any of them is not cached"""
+        hosts = []
+        for device_mac in device_macs:
+            entry = self._entries.get(device_mac)
+            if not entry:
+                return None
+            if entry['address'] not in hosts:
+                hosts.append(entry['address'])
+        return hosts
+
+    def update(self, apple_tvs: list[interface.BaseConfig]):
+        """Record the address and service ports of the provided apple_tvs, writing the cache file if anything changed"""
+        changed = False
+        for apple_tv in apple_tvs:
+            entry = {
+                'address': str(apple_tv.address),
+                'name': apple_tv.name,
+                'ports': {service_to_protocol_str(service): service.port for service in apple_tv.services},
+            }
+            if self._entries.get(apple_tv.device_info.mac) != entry:
+                changed = True
+            self._entries[apple_tv.device_info.mac] = entry
+
+        if changed:
+            write_file_atomically(
+                self.file_name, json.dumps(self._entries, indent=2))
+
+
+_discovery_cache: Optional[DiscoveryCache] = None
+
+
+def get_discovery_cache() -> DiscoveryCache:
+    """Return the shared DiscoveryCache, loading the discovery cache JSON file if needed"""
+    global _discovery_cache
+    if _discovery_cache is None:
+        _discovery_cache = DiscoveryCache()
+    return _discovery_cache
@@ -0,0 +1,121 @@
+import argparse
+import csv
+from datetime import datetime
+import json
+import os
+import re
+import sys
+import time
+from typing import Optional
+
+import config
+# Imported before other modules of this project, so that settings missing from config.py (and those in config.json) apply
+#   to their defaults too
+import config_file
+from event_store import connect_event_store, get_on_durations, query_events
+from events import EVENT_TYPES
+
+
+# Units of relative times like '7d', in seconds
+RELATIVE_TIME_UNITS: dict[str, int] = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_time(value: str) -> float:
+    """Return the unix timestamp for an ISO 8601 date/time (like '2024-01-31' or '2024-01-31T18:00'), 'now', or a time
+    relative to now (like '7d' or '12h' ago)"""
+    if value == 'now':
+        return time.time()
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', value)
+    if match:
+        return time.time() - float(match.group(1)) * RELATIVE_TIME_UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid time "{0:s}", expected an ISO 8601 date/time (like 2024-01-31T18:00), now, or a relative time (like 7d)'.format(value))
+
+
+def format_timestamp(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+
+def write_rows(rows: list[dict], output_format: str, output_file):
+    """Write rows as an aligned table, CSV, or JSON"""
+    if output_format == 'json':
+        json.dump(rows, output_file, indent=2, default=str)
+        output_file.write('\n')
+        return
+    if not rows:
+        return
+    field_names = list(rows[0].keys())
+    if output_format == 'csv':
+        writer = csv.DictWriter(output_file, field_names)
+        writer.writeheader()
+        writer.writerows(rows)
+        return
+    cells = [[str(row[field_name]) for field_name in field_names]
+             for row in rows]
+    widths = [max(len(field_name), *(len(row_cells[idx]) for row_cells in cells))
+              for idx, field_name in enumerate(field_names)]
+    output_file.write('  '.join(field_name.ljust(width)
+                      for field_name, width in zip(field_names, widths)).rstrip() + '\n')
+    for row_cells in cells:
+        output_file.write('  '.join(cell.ljust(width)
+                          for cell, width in zip(row_cells, widths)).rstrip() + '\n')
+
+
+def main(argv: Optional[list[str]] = None):
+    """Query the event store (see: ./event_store.py) and print or export the results"""
+    parser = argparse.ArgumentParser(
+        description='Query and export the history of listener events recorded in the event store')
+    parser.add_argument('--db', default=config.EVENT_STORE_FILE_NAME,
+                        help='Event store database file (default: %(default)s)')
+    parser.add_argument('--device', help='Only include this device, by MAC address or name')
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help='Only include events at or after this time, like 2024-01-31, 2024-01-31T18:00, or 7d (ago)')
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help='Only include events before this time (default: now)')
+    parser.add_argument('--format', choices=('table', 'csv', 'json'), default='table',
+                        help='Output format (default: %(default)s)')
+    parser.add_argument('--output', help='File to write to (default: stdout)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    events_parser = subparsers.add_parser('events', help='List events')
+    events_parser.add_argument('--event', action='append', choices=EVENT_TYPES, dest='event_types',
+                               help='Only include this event type (may be repeated)')
+    events_parser.add_argument('--limit', type=int, help='Maximum number of events to list')
+
+    subparsers.add_parser(
+        'on-time', help='Total time each device was powered on (default: over the last 7 days)')
+
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        parser.error('{0:s} does not exist yet, since no events have been recorded'.format(args.db))
+
+    connection = connect_event_store(args.db)
+    if args.command == 'events':
+        rows = [dict(event, timestamp=format_timestamp(event['timestamp'])) for event in query_events(
+            connection, args.device, args.event_types, args.since, args.until, args.limit)]
+        if args.format != 'json':
+            rows = [dict(row, old_value=json.dumps(row['old_value']), new_value=json.dumps(row['new_value']))
+                    for row in rows]
+    else:
+        end_time = args.until if args.until is not None else time.time()
+        start_time = args.since if args.since is not None else end_time - \
+            RELATIVE_TIME_UNITS['w']
+        rows = [dict(on_duration, on_hours=round(on_duration['on_hours'], 2), on_seconds=round(on_duration['on_seconds']))
+                for on_duration in get_on_durations(connection, start_time, end_time, args.device)]
+        if args.format == 'table' and not args.output:
+            print('Powered on between {0:s} and {1:s}:'.format(
+                format_timestamp(start_time), format_timestamp(end_time)))
+    connection.close()
+
+    if args.output:
+        with open(args.output, 'w', newline='') as output_file:
+            write_rows(rows, args.format, output_file)
+    else:
+        write_rows(rows, args.format, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
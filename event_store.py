@@ -0,0 +1,240 @@
+from enum import Enum
+import json
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Optional
+
+import config
+from events import EVENT_POWER, ListenerEvent, normalize_value, subscribe, unsubscribe
+from log import get_logger
+from metrics import EVENT_STORE_EVENTS
+
+
+# The maximum number of events waiting to be written before new ones are dropped, so a stalled disk cannot exhaust memory
+EVENT_STORE_QUEUE_SIZE: int = 10000
+
+# The maximum number of events written in one transaction
+EVENT_STORE_BATCH_SIZE: int = 500
+
+# The number of seconds the writer waits for more events before committing a partial batch
+EVENT_STORE_FLUSH_INTERVAL_SECONDS: float = 1
+
+SCHEMA: str = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    device_mac TEXT NOT NULL,
+    device_name TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    old_value TEXT,
+    new_value TEXT
+);
+CREATE INDEX IF NOT EXISTS events_device_mac_ts ON events (device_mac, ts);
+CREATE INDEX IF NOT EXISTS events_event_type_device_mac_ts ON events (event_type, device_mac, ts);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+'''
+
+logger = get_logger()
+
+
+def encode_value(value: Any) -> Optional[str]:
+    """Return the value as JSON text, with pyatv enum values as their names and anything else unserializable as a str"""
+    if value is None:
+        return None
+    return json.dumps(value, default=lambda other: normalize_value(other) if isinstance(other, Enum) else str(other))
+
+
+def decode_value(value: Optional[str]) -> Any:
+    return json.loads(value) if value is not None else None
+
+
+def connect_event_store(file_name: str) -> sqlite3.Connection:
+    """Open the event store database, creating its tables and indexes if needed"""
+    connection = sqlite3.connect(file_name)
+    # WAL lets queries (like event_history.py) read while events are being written
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class EventStore:
+    """Appends every ListenerEvent to a SQLite database
+
+    Events are queued by the event loop thread (record() only enqueues), then encoded and written by a background thread in
+    batched transactions, so disk I/O never blocks the listeners.
+
+    NOTE: close() must be called when finished, to write any queued events"""
+    file_name: str
+    written_count: int = 0
+    dropped_count: int = 0
+
+    def __init__(self, file_name: str = config.EVENT_STORE_FILE_NAME, queue_size: int = EVENT_STORE_QUEUE_SIZE,
+                 batch_size: int = EVENT_STORE_BATCH_SIZE, flush_interval_seconds: float = EVENT_STORE_FLUSH_INTERVAL_SECONDS):
+        self.file_name = file_name
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self._queue = queue.Queue(queue_size)
+        # Create the database on the calling thread, so that errors (like an invalid path) are raised right away
+        connect_event_store(file_name).close()
+        self._thread = threading.Thread(
+            target=self._write_events, name='EventStoreWriter', daemon=True)
+        self._thread.start()
+
+    def record(self, event: ListenerEvent):
+        """Queue the event to be written (subscribed to events via subscribe())"""
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped_count += 1
+            EVENT_STORE_EVENTS.inc('dropped')
+
+    def _write_events(self):
+        connection = connect_event_store(self.file_name)
+        is_closing = False
+        while not is_closing:
+            batch = []
+            try:
+                event = self._queue.get(timeout=self.flush_interval_seconds)
+            except queue.Empty:
+                continue
+            while event is not None:
+                batch.append(event)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                # None is queued by close()
+                is_closing = True
+
+            if batch:
+                try:
+                    with connection:
+                        connection.executemany('INSERT INTO events (ts, device_mac, device_name, event_type, old_value, new_value) VALUES (?, ?, ?, ?, ?, ?)', [
+                            (event.timestamp, event.device_mac, event.device_name, event.event_type,
+                             encode_value(event.old_value), encode_value(event.new_value)) for event in batch])
+                    self.written_count += len(batch)
+                    EVENT_STORE_EVENTS.inc('written', amount=len(batch))
+                except sqlite3.Error as ex:
+                    logger.error('Failed to write %d events to %s! Details: %r',
+                                 len(batch), self.file_name, ex)
+        connection.close()
+
+    def close(self, timeout: float = 10):
+        """Write any queued events, waiting up to timeout seconds, then stop the writer thread"""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning('Closing event store with %d events still queued!',
+                           self._queue.qsize())
+
+
+def get_time_range_clause(start_time: Optional[float], end_time: Optional[float]) -> tuple[list[str], list]:
+    clauses, params = [], []
+    if start_time is not None:
+        clauses.append('ts >= ?')
+        params.append(start_time)
+    if end_time is not None:
+        clauses.append('ts < ?')
+        params.append(end_time)
+    return clauses, params
+
+
+def query_events(connection: sqlite3.Connection, device: Optional[str] = None, event_types: Optional[Iterable[str]] = None,
+                 start_time: Optional[float] = None, end_time: Optional[float] = None, limit: Optional[int] = None) -> list[dict]:
+    """Return stored events, oldest first, optionally limited to a device (by MAC address or name), event types, and
+    a [start_time, end_time) range of unix timestamps"""
+    clauses, params = get_time_range_clause(start_time, end_time)
+    if device:
+        clauses.append('(device_mac = ? OR device_name = ?)')
+        params.extend((device, device))
+    event_types = list(event_types or [])
+    if event_types:
+        clauses.append('event_type IN ({0:s})'.format(
+            ', '.join('?' * len(event_types))))
+        params.extend(event_types)
+    sql = 'SELECT ts, device_mac, device_name, event_type, old_value, new_value FROM events'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY ts'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return [{
+        'timestamp': ts,
+        'device_mac': device_mac,
+        'device_name': device_name,
+        'event_type': event_type,
+        'old_value': decode_value(old_value),
+        'new_value': decode_value(new_value),
+    } for ts, device_mac, device_name, event_type, old_value, new_value in connection.execute(sql, params)]
+
+
+def get_on_durations(connection: sqlite3.Connection, start_time: float, end_time: float,
+                     device: Optional[str] = None) -> list[dict]:
+    """Return the number of seconds each device was (stably) powered on during [start_time, end_time)
+
+    The power state at start_time is taken from each device's last power event before it, so only events in and just
+    before the range are read (using the (event_type, device_mac, ts) index)."""
+    device_clause, device_params = '', []
+    if device:
+        device_clause = ' AND (device_mac = ? OR device_name = ?)'
+        device_params = [device, device]
+    device_rows = connection.execute('SELECT DISTINCT device_mac FROM events WHERE event_type = ?' + device_clause,
+                                     [EVENT_POWER] + device_params).fetchall()
+
+    on_durations = []
+    for (device_mac,) in device_rows:
+        initial_row = connection.execute(
+            'SELECT device_name, new_value FROM events WHERE event_type = ? AND device_mac = ? AND ts < ? ORDER BY ts DESC LIMIT 1',
+            (EVENT_POWER, device_mac, start_time)).fetchone()
+        device_name = initial_row[0] if initial_row else ''
+        on_since = start_time if initial_row and decode_value(
+            initial_row[1]) == 'On' else None
+        on_seconds = 0.0
+        for ts, row_device_name, new_value in connection.execute(
+                'SELECT ts, device_name, new_value FROM events WHERE event_type = ? AND device_mac = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                (EVENT_POWER, device_mac, start_time, end_time)):
+            device_name = row_device_name
+            if decode_value(new_value) == 'On':
+                if on_since is None:
+                    on_since = ts
+            elif on_since is not None:
+                on_seconds += ts - on_since
+                on_since = None
+        if on_since is not None:
+            on_seconds += min(end_time, time.time()) - on_since
+        on_durations.append({'device_mac': device_mac, 'device_name': device_name,
+                             'on_seconds': on_seconds, 'on_hours': on_seconds / 3600})
+    return on_durations
+
+
+_event_store: Optional[EventStore] = None
+
+
+def start_event_store(file_name: str = config.EVENT_STORE_FILE_NAME) -> Optional[EventStore]:
+    """Record every listener event to the event store, unless file_name is '' (disabled)
+
+    Must be called before adding listeners, so that events for the initial states are not missed"""
+    global _event_store
+    if _event_store is None and file_name:
+        _event_store = EventStore(file_name)
+        subscribe(_event_store.record)
+        logger.info('Recording events to %s', file_name)
+    return _event_store
+
+
+def close_event_store():
+    """Write any queued events and close the event store, if started"""
+    global _event_store
+    if _event_store is not None:
+        unsubscribe(_event_store.record)
+        _event_store.close()
+        _event_store = None
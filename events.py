@@ -0,0 +1,83 @@
+from enum import Enum
+import time
+from typing import Any, Callable, NamedTuple
+
+from log import get_logger
+from metrics import EVENT_DISPATCH_SECONDS, LISTENER_EVENTS
+
+
+# Event types emitted by the listeners (see: ./listeners)
+EVENT_POWER: str = 'power'  # Stable power state change, or the initial power state (with old_value None)
+EVENT_POWER_UPDATE: str = 'power_update'  # Every raw power state update, stable or not
+EVENT_VOLUME: str = 'volume'  # Stable volume change
+EVENT_VOLUME_UPDATE: str = 'volume_update'  # Every raw volume update
+EVENT_OUTPUT_DEVICES: str = 'output_devices'
+EVENT_PLAYSTATUS: str = 'playstatus'  # Changed fields of a push update, as {field: value} dicts (see: ./listeners/push_listener.py)
+EVENT_DEVICE_STATE: str = 'device_state'  # Play state change (e.g. Paused -> Playing)
+EVENT_TITLE: str = 'title'  # Title of what is playing changed
+EVENT_PLAYSTATUS_ERROR: str = 'playstatus_error'
+EVENT_FOCUS: str = 'focus'
+EVENT_ARTWORK: str = 'artwork'  # Artwork of what is playing, as {key, mimetype, width, height, size} (see: ./artwork_cache.py)
+EVENT_CONNECTED: str = 'connected'  # Connected (or reconnected) and listeners added
+EVENT_CONNECTION_LOST: str = 'connection_lost'
+EVENT_CONNECTION_CLOSED: str = 'connection_closed'
+EVENT_CONNECTION_HEALTH: str = 'connection_health'  # Health probe state change, e.g. healthy -> degraded (see: ./health_probe.py)
+EVENT_DEVICE_APPEARED: str = 'device_appeared'  # Found on network by a rescan, with its address (see: ./presence.py)
+EVENT_DEVICE_GONE: str = 'device_gone'  # No longer found on network, with its last address
+EVENT_ADDRESS_CHANGED: str = 'address_changed'  # Found on network at a new address, e.g. after a DHCP lease change
+
+EVENT_TYPES: tuple = (EVENT_POWER, EVENT_POWER_UPDATE, EVENT_VOLUME, EVENT_VOLUME_UPDATE, EVENT_OUTPUT_DEVICES,
+                      EVENT_PLAYSTATUS, EVENT_DEVICE_STATE, EVENT_TITLE, EVENT_PLAYSTATUS_ERROR, EVENT_FOCUS, EVENT_ARTWORK, EVENT_CONNECTED,
+                      EVENT_CONNECTION_LOST, EVENT_CONNECTION_CLOSED, EVENT_CONNECTION_HEALTH, EVENT_DEVICE_APPEARED,
+                      EVENT_DEVICE_GONE, EVENT_ADDRESS_CHANGED)
+
+
+class ListenerEvent(NamedTuple):
+    event_type: str
+    device_mac: str
+    device_name: str
+    old_value: Any
+    new_value: Any
+    timestamp: float
+
+
+def normalize_value(value: Any) -> Any:
+    """Return the name of pyatv enum values (e.g. PowerState.On -> "On"), or the value itself otherwise"""
+    return value.name if isinstance(value, Enum) else value
+
+
+logger = get_logger()
+
+_subscribers: list[Callable[[ListenerEvent], None]] = []
+
+
+def subscribe(callback: Callable[[ListenerEvent], None]):
+    """Call callback with every ListenerEvent emitted from now on
+
+    NOTE: callbacks are called from the listener callbacks, on the event loop thread, so they must return quickly and
+    schedule any slow work (like I/O) to run separately"""
+    _subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[ListenerEvent], None]):
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+
+def emit_event(event_type: str, device_mac: str, device_name: str, old_value: Any, new_value: Any):
+    """Pass a new ListenerEvent to every subscriber"""
+    LISTENER_EVENTS.inc(event_type, device_mac)
+    if not _subscribers:
+        return
+    start_time = time.perf_counter()
+    event = ListenerEvent(event_type, device_mac, device_name,
+                          old_value, new_value, time.time())
+    for callback in _subscribers:
+        try:
+            callback(event)
+        except Exception as ex:
+            # Never let a failing subscriber break the listener callback (and pyatv's protocol handling) that emitted the event
+            logger.error(
+                'Event subscriber failed for %s event! Details: %r', event_type, ex)
+    EVENT_DISPATCH_SECONDS.observe(
+        time.perf_counter() - start_time, event_type)
@@ -0,0 +1,151 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+from pyatv import const, interface
+
+import config
+from events import EVENT_CONNECTION_HEALTH, emit_event
+from log import get_logger
+from metrics import HEALTH_PROBE_SECONDS, HEALTH_PROBES
+from utils import s_if_plural
+
+
+# Connection health states, emitted as connection_health events
+HEALTH_HEALTHY: str = 'healthy'
+HEALTH_DEGRADED: str = 'degraded'  # At least one probe failed
+HEALTH_DEAD: str = 'dead'  # config.HEALTH_PROBE_FAILURES_UNTIL_DEAD probes in a row failed, so the device is reconnected
+
+# The factor the probe interval grows by after each successful probe, up to config.HEALTH_PROBE_MAX_INTERVAL_SECONDS
+INTERVAL_BACKOFF_FACTOR: float = 1.5
+
+# The fraction each probe interval is randomly shortened or lengthened by, so that probes of many devices spread out
+INTERVAL_JITTER: float = 0.1
+
+# The order in which services are picked for probing, preferring those Apple TVs keep listening on
+PROBE_PROTOCOLS: tuple = (const.Protocol.Companion, const.Protocol.AirPlay,
+                          const.Protocol.MRP, const.Protocol.DMAP, const.Protocol.RAOP)
+
+logger = get_logger()
+
+
+def get_probe_port(apple_tv: interface.BaseConfig) -> Optional[int]:
+    """Return the port of the service to probe on apple_tv, or None if no service has a known port"""
+    for protocol in PROBE_PROTOCOLS:
+        service = apple_tv.get_service(protocol)
+        if service and service.port:
+            return service.port
+    return None
+
+
+async def probe_tcp_connect(host: str, port: int, timeout_seconds: float):
+    """Open and close a TCP connection to host:port, raising an exception if it fails or takes over timeout_seconds
+
+    A TCP handshake is answered by the device's network stack without any work by its services, so it is cheap to repeat"""
+    _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout_seconds)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+
+
+class HealthProbe:
+    """Periodically probes a connected device, and reports it as dead when several probes in a row fail
+
+    pyatv only reports a lost connection once the OS gives up on it, which can take minutes after a network blip. Probing
+    with a strict timeout detects it within a bounded time: at most max_interval_seconds (plus jitter) until the next probe,
+    then failures_until_dead probes of up to timeout_seconds each, min_interval_seconds (plus jitter) apart.
+
+    The interval starts at min_interval_seconds and grows after each successful probe, up to max_interval_seconds, so a
+    healthy fleet is probed rarely. After a failed probe, the device is marked degraded and probed again at
+    min_interval_seconds.
+
+    NOTE: stop() must be called when finished"""
+    host: str
+    port: int
+    device_name: str
+    device_mac: str
+    on_dead: Callable[[Exception], None]
+    state: str = HEALTH_HEALTHY
+    interval_seconds: float
+
+    def __init__(self, host: str, port: int, on_dead: Callable[[Exception], None], device_name: str = '', device_mac: str = '',
+                 min_interval_seconds: float = config.HEALTH_PROBE_MIN_INTERVAL_SECONDS,
+                 max_interval_seconds: float = config.HEALTH_PROBE_MAX_INTERVAL_SECONDS,
+                 timeout_seconds: float = config.HEALTH_PROBE_TIMEOUT_SECONDS,
+                 failures_until_dead: int = config.HEALTH_PROBE_FAILURES_UNTIL_DEAD,
+                 probe_function: Callable[[str, int, float], Awaitable[None]] = probe_tcp_connect):
+        self.host = host
+        self.port = port
+        self.on_dead = on_dead
+        self.device_name = device_name
+        self.device_mac = device_mac
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self.failures_until_dead = failures_until_dead
+        self.probe_function = probe_function
+        self.interval_seconds = min_interval_seconds
+        self.logger = get_logger('HealthProbe', device_name)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            emit_event(EVENT_CONNECTION_HEALTH, self.device_mac,
+                       self.device_name, self.state, state)
+            self.state = state
+
+    async def probe(self) -> bool:
+        """Probe the device once, and return whether it responded in time"""
+        start_time = time.perf_counter()
+        try:
+            await self.probe_function(self.host, self.port, self.timeout_seconds)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            HEALTH_PROBES.inc(self.device_mac, 'failure')
+            self.logger.warning('Probe of %s:%d failed after %.2fs! Details: %r',
+                                self.host, self.port, time.perf_counter() - start_time, ex)
+            return False
+        HEALTH_PROBES.inc(self.device_mac, 'success')
+        HEALTH_PROBE_SECONDS.observe(
+            time.perf_counter() - start_time, self.device_mac)
+        return True
+
+    async def _run(self):
+        failure_count = 0
+        while True:
+            await asyncio.sleep(self.interval_seconds * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER))
+            if await self.probe():
+                if failure_count:
+                    self.logger.info('Connection recovered after %d failed probe%s',
+                                     failure_count, s_if_plural(failure_count))
+                failure_count = 0
+                self._set_state(HEALTH_HEALTHY)
+                self.interval_seconds = min(
+                    self.max_interval_seconds, self.interval_seconds * INTERVAL_BACKOFF_FACTOR)
+                continue
+
+            failure_count += 1
+            self.interval_seconds = self.min_interval_seconds
+            if failure_count < self.failures_until_dead:
+                self._set_state(HEALTH_DEGRADED)
+                continue
+
+            self._set_state(HEALTH_DEAD)
+            self.logger.error('Connection is dead after %d failed probes in a row!', failure_count)
+            self._task = None
+            self.on_dead(ConnectionError(
+                'Health probe of {0:s}:{1:d} failed {2:d} times in a row'.format(self.host, self.port, failure_count)))
+            return
@@ -2,18 +2,39 @@
 
 from pyatv import interface
 
-import utils
+import config
+from debouncer import Debouncer
+from events import EVENT_OUTPUT_DEVICES, EVENT_VOLUME, EVENT_VOLUME_UPDATE, emit_event
+from log import get_logger
 
 
-def get_log_prefix(include_time: bool = True):
-    return utils.get_log_prefix(include_time, "AudioListener")
+class AudioListener(interface.AudioListener):
+    device_name: str
+    device_mac: str
+    volume_debouncer: Debouncer
 
+    def __init__(self, device_name: str = '', device_mac: str = ''):
+        self.device_name = device_name
+        self.device_mac = device_mac
+        self.logger = get_logger('AudioListener', device_name)
+        # Holding a volume button produces a burst of updates, so only treat the volume as stable once it settles
+        self.volume_debouncer = Debouncer(
+            None, self.stable_volume_update, config.VOLUME_STABLE_AFTER_SECONDS)
 
-class AudioListener(interface.AudioListener):
     def volume_update(self, old_level, new_level):
-        print(
-            f'{get_log_prefix()}volume_update() - changed from {old_level} to {new_level}')
+        self.logger.info(
+            'volume_update() - changed from %s to %s', old_level, new_level)
+        emit_event(EVENT_VOLUME_UPDATE, self.device_mac,
+                   self.device_name, old_level, new_level)
+        self.volume_debouncer.update(new_level)
+
+    def stable_volume_update(self, old_level, new_level):
+        self.logger.info('Stable volume update: %s', new_level)
+        emit_event(EVENT_VOLUME, self.device_mac,
+                   self.device_name, old_level, new_level)
 
     def outputdevices_update(self, old_devices, new_devices):
-        print(
-            f'{get_log_prefix()}outputdevices_update() - changed from {old_devices} to {new_devices}')
+        self.logger.info(
+            'outputdevices_update() - changed from %s to %s', old_devices, new_devices)
+        emit_event(EVENT_OUTPUT_DEVICES, self.device_mac,
+                   self.device_name, old_devices, new_devices)
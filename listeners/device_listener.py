@@ -1,18 +1,31 @@
 # See documentation: https://pyatv.dev/development/listeners/#device-updates
 
 from pyatv import interface
+from typing import Callable, Optional
 
-import utils
+from events import EVENT_CONNECTION_CLOSED, EVENT_CONNECTION_LOST, emit_event
+from log import get_logger
 
 
-def get_log_prefix(include_time: bool = True):
-    return utils.get_log_prefix(include_time, "DeviceListener")
+class DeviceListener(interface.DeviceListener):
+    device_name: str
+    device_mac: str
+    on_connection_lost: Optional[Callable[[Exception], None]]
 
+    def __init__(self, device_name: str = '', on_connection_lost: Optional[Callable[[Exception], None]] = None, device_mac: str = ''):
+        self.device_name = device_name
+        self.on_connection_lost = on_connection_lost
+        self.device_mac = device_mac
+        self.logger = get_logger('DeviceListener', device_name)
 
-class DeviceListener(interface.DeviceListener):
     def connection_lost(self, exception):
-        print(f'{get_log_prefix()}connection_lost(): {exception}')
+        self.logger.warning('connection_lost(): %s', exception)
+        emit_event(EVENT_CONNECTION_LOST, self.device_mac,
+                   self.device_name, None, exception)
+        if self.on_connection_lost:
+            self.on_connection_lost(exception)
 
     def connection_closed(self):
-        print(f'{get_log_prefix()}connection_closed()')
-        print("Connection closed!")
+        self.logger.info('connection_closed()')
+        emit_event(EVENT_CONNECTION_CLOSED, self.device_mac,
+                   self.device_name, None, None)
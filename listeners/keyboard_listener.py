@@ -2,14 +2,21 @@
 
 from pyatv import interface
 
-import utils
+from events import EVENT_FOCUS, emit_event
+from log import get_logger
 
 
-def get_log_prefix(include_time: bool = True):
-    return utils.get_log_prefix(include_time, "KeyboardListener")
+class KeyboardListener(interface.KeyboardListener):
+    device_name: str
+    device_mac: str
 
+    def __init__(self, device_name: str = '', device_mac: str = ''):
+        self.device_name = device_name
+        self.device_mac = device_mac
+        self.logger = get_logger('KeyboardListener', device_name)
 
-class KeyboardListener(interface.KeyboardListener):
     def focusstate_update(self, old_state, new_state):
-        print(
-            f'{get_log_prefix()}focusstate_update() - changed from {old_state} to {new_state}')
+        self.logger.info(
+            'focusstate_update() - changed from %s to %s', old_state, new_state)
+        emit_event(EVENT_FOCUS, self.device_mac,
+                   self.device_name, old_state, new_state)
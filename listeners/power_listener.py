@@ -1,54 +1,63 @@
 # See documentation: https://pyatv.dev/development/listeners/#power-state-updates
 
-import asyncio
 from pyatv import const, interface
-from time import time
 
 import config
-import utils
-
-
-def get_log_prefix(include_time: bool = True):
-    return utils.get_log_prefix(include_time, "PowerListener")
+from debouncer import Debouncer
+from events import EVENT_POWER, EVENT_POWER_UPDATE, emit_event
+from log import get_logger
+from metrics import POWER_DECISIONS
 
 
 class PowerListener(interface.PowerListener):
-    last_power_on_time: int = 0
-    prev_stable_state: const.PowerState
-
-    def __init__(self, initial_power_state: const.PowerState):
-        self.prev_stable_state = initial_power_state
-        print(
-            f'{get_log_prefix()}Initialized with initial_power_state: {initial_power_state}')
-        asyncio.ensure_future(utils.publish_event_to_ifttt_webhooks(
-            'atv_power_on' if initial_power_state == const.PowerState.On else 'atv_power_off'))
-
-    def powerstate_update(self, _: const.PowerState, new_state: const.PowerState):
-        now_time = int(time())
+    device_name: str
+    device_mac: str
+    debouncer: Debouncer
+
+    def __init__(self, initial_power_state: const.PowerState, device_name: str = '', device_mac: str = ''):
+        self.device_name = device_name
+        self.device_mac = device_mac
+        self.logger = get_logger('PowerListener', device_name)
         # Consider power state change stable if:
         #   1. New power state is On or Off
         #   - AND -
         #   2. New power state is different from the previous stable state
-        is_stable_change = (new_state == const.PowerState.On or new_state ==
-                            const.PowerState.Off) and self.prev_stable_state != new_state
-
-        if new_state == const.PowerState.On:
-            self.last_power_on_time = now_time
-        elif new_state == const.PowerState.Off:
-            # When powering on Apple TV, the power_state alternates between On and Off for about 30 seconds
-            #   To improve stability, off state changes that happen within config.POWER_OFF_STABLE_AFTER_SECONDS
-            #   after the last On state change are ignored.
-            # Since the power_state alternates, as described above, add an additional condition so that
-            #   the state is only consider stable if it has been POWER_OFF_STABLE_AFTER_SECONDS or longer since the last power on
-            is_stable_change = is_stable_change and now_time - \
-                self.last_power_on_time >= config.POWER_OFF_STABLE_AFTER_SECONDS
-
-        if is_stable_change:
-            print(
-                f'{get_log_prefix()}Stable update: {new_state}')
-            self.prev_stable_state = new_state
-            asyncio.ensure_future(utils.publish_event_to_ifttt_webhooks(
-                'atv_power_on' if new_state == const.PowerState.On else 'atv_power_off'))
-        else:
-            print(
-                f'{get_log_prefix()}Ignoring unstable update: {new_state}')
+        #   - AND -
+        #   3. New power state is On, or has been Off for config.POWER_OFF_STABLE_AFTER_SECONDS without any other update
+        # When powering on Apple TV, the power_state alternates between On and Off for about 30 seconds
+        #   To improve stability, an Off state only becomes stable once it has lasted POWER_OFF_STABLE_AFTER_SECONDS,
+        #   and is discarded if the power_state flips back to On before then.
+        self.debouncer = Debouncer(
+            initial_power_state,
+            self.stable_powerstate_update,
+            quiet_periods_seconds={
+                const.PowerState.On: 0,
+                const.PowerState.Off: config.POWER_OFF_STABLE_AFTER_SECONDS,
+            },
+            ignored_states={const.PowerState.Unknown})
+        self.logger.info(
+            'Initialized with initial_power_state: %s', initial_power_state)
+        # Actions for power events are defined by rules (see: ./rules.py)
+        emit_event(EVENT_POWER, self.device_mac, self.device_name,
+                   None, initial_power_state)
+
+    @property
+    def prev_stable_state(self) -> const.PowerState:
+        return self.debouncer.stable_state
+
+    def powerstate_update(self, old_state: const.PowerState, new_state: const.PowerState):
+        emit_event(EVENT_POWER_UPDATE, self.device_mac,
+                   self.device_name, old_state, new_state)
+        if not self.debouncer.update(new_state):
+            POWER_DECISIONS.inc(self.device_mac, 'unstable')
+            self.logger.info('Ignoring unstable update: %s', new_state)
+        elif self.debouncer.is_pending:
+            POWER_DECISIONS.inc(self.device_mac, 'pending')
+            self.logger.info('Waiting %ss for update to become stable: %s',
+                             self.debouncer.get_quiet_period_seconds(new_state), new_state)
+
+    def stable_powerstate_update(self, old_state: const.PowerState, new_state: const.PowerState):
+        POWER_DECISIONS.inc(self.device_mac, 'stable')
+        self.logger.info('Stable update: %s', new_state)
+        emit_event(EVENT_POWER, self.device_mac,
+                   self.device_name, old_state, new_state)
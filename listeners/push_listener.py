@@ -1,20 +1,191 @@
 # See documentation: https://pyatv.dev/development/listeners/#push-updates
 
+import asyncio
+from collections import deque
+import time
+from typing import Any, Awaitable, Callable, Optional
+
 from pyatv import interface
 
-import utils
+from artwork_cache import get_artwork_cache, get_artwork_key
+import config
+from events import (EVENT_ARTWORK, EVENT_DEVICE_STATE, EVENT_PLAYSTATUS, EVENT_PLAYSTATUS_ERROR, EVENT_TITLE, emit_event,
+                    normalize_value)
+from log import get_logger
+from metrics import PUSH_UPDATES
+from task_registry import get_task_registry
+
+
+# The interface.Playing fields compared between push updates
+PLAYING_FIELDS: tuple = ('media_type', 'device_state', 'title', 'artist', 'album', 'genre', 'total_time', 'position',
+                         'shuffle', 'repeat', 'series_name', 'season_number', 'episode_number', 'content_identifier')
+
+
+class PlayingSnapshot:
+    """Compact copy of the fields of an interface.Playing, along with the unix timestamp it was received at
+
+    interface.Playing computes its fields from the protocol's messages each time they are read, so each field is read once
+    into __slots__, which also keeps the snapshots in each device's history small."""
+    __slots__ = PLAYING_FIELDS + ('timestamp',)
+
+    def __init__(self, playing: Optional[interface.Playing] = None, timestamp: float = 0.0):
+        for field in PLAYING_FIELDS:
+            setattr(self, field, getattr(playing, field, None))
+        self.timestamp = timestamp
+
+    def get_changes(self, other: 'PlayingSnapshot') -> 'PlayingChanges':
+        """Return the fields whose values differ in other, as {field: (value in self, value in other)}"""
+        changes = PlayingChanges()
+        for field in PLAYING_FIELDS:
+            old_value = getattr(self, field)
+            new_value = getattr(other, field)
+            if old_value != new_value:
+                changes[field] = (old_value, new_value)
+        return changes
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class PlayingChanges(dict):
+    """Changed fields of a push update, as {field: (old value, new value)}, formatted like 'device_state: Paused -> Playing' when logged"""
 
+    def __str__(self):
+        return ', '.join('{0:s}: {1} -> {2}'.format(field, normalize_value(old_value), normalize_value(new_value))
+                         for field, (old_value, new_value) in self.items())
 
-def get_log_prefix(include_time: bool = True):
-    return utils.get_log_prefix(include_time, "PushListener")
+    def get_old_values(self) -> dict[str, Any]:
+        return {field: old_value for field, (old_value, _) in self.items()}
+
+    def get_new_values(self) -> dict[str, Any]:
+        return {field: new_value for field, (_, new_value) in self.items()}
+
+
+def get_artwork_details(artwork_key: str, artwork: Optional[interface.ArtworkInfo]) -> Optional[dict]:
+    """Return the details of the artwork passed on in artwork events, without its bytes (which stay in the artwork cache),
+    or None if there is no artwork"""
+    if artwork is None:
+        return None
+    return {'key': artwork_key, 'mimetype': artwork.mimetype, 'width': artwork.width, 'height': artwork.height,
+            'size': len(artwork.bytes)}
 
 
 class PushListener(interface.PushListener):
-    prev_playstatus: interface.Playing
+    device_name: str
+    device_mac: str
+    position_update_interval_seconds: float
+    # The latest state, including coalesced position updates
+    playstatus: PlayingSnapshot
+    # The most recent states passed on as changes, oldest first
+    history: deque
+    # Requests the artwork of what is playing from the device, if artwork is enabled
+    fetch_artwork: Optional[Callable[[], Awaitable[Optional[interface.ArtworkInfo]]]]
+    # The artwork cache key of what is playing, and the latest artwork passed on (see: get_artwork_details())
+    artwork_key: Optional[str] = None
+    artwork_details: Optional[dict] = None
+
+    def __init__(self, device_name: str = '', device_mac: str = '',
+                 position_update_interval_seconds: float = config.PUSH_POSITION_UPDATE_INTERVAL_SECONDS,
+                 history_size: int = config.PUSH_HISTORY_SIZE,
+                 fetch_artwork: Optional[Callable[[], Awaitable[Optional[interface.ArtworkInfo]]]] = None):
+        self.device_name = device_name
+        self.device_mac = device_mac
+        self.position_update_interval_seconds = position_update_interval_seconds
+        self.logger = get_logger('PushListener', device_name)
+        self.playstatus = PlayingSnapshot()
+        self.history = deque(maxlen=history_size)
+        self.fetch_artwork = fetch_artwork
+        self._flush_timer_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def prev_playstatus(self) -> Optional[PlayingSnapshot]:
+        """The latest state passed on as changes, or None if there were no push updates yet"""
+        return self.history[-1] if self.history else None
 
     def playstatus_update(self, updater, playstatus: interface.Playing):
-        print(f'{get_log_prefix()}playstatus_update():\n{playstatus}')
-        self.prev_playstatus = playstatus
+        snapshot = PlayingSnapshot(playstatus, time.time())
+        changes = self.playstatus.get_changes(snapshot)
+        if not changes:
+            PUSH_UPDATES.inc(self.device_mac, 'unchanged')
+            return
+
+        prev_playstatus = self.prev_playstatus
+        self.playstatus = snapshot
+        if len(changes) == 1 and 'position' in changes and prev_playstatus \
+                and snapshot.timestamp - prev_playstatus.timestamp < self.position_update_interval_seconds:
+            # Position ticks arrive about every second while playing, so only pass them on at the configured rate. The
+            #   latest one is passed on once the interval is up, even if no further updates arrive (e.g. after pausing)
+            PUSH_UPDATES.inc(self.device_mac, 'coalesced')
+            if self._flush_timer_handle is None:
+                self._flush_timer_handle = asyncio.get_event_loop().call_later(
+                    prev_playstatus.timestamp + self.position_update_interval_seconds - snapshot.timestamp,
+                    self.flush_position)
+            return
+        self.pass_on(snapshot)
+
+    def flush_position(self):
+        """Pass on the latest coalesced position update, unless a later update was passed on already"""
+        self._flush_timer_handle = None
+        if self.playstatus is not self.prev_playstatus:
+            self.pass_on(self.playstatus)
+
+    def cancel(self):
+        """Cancel any pending coalesced position update"""
+        if self._flush_timer_handle is not None:
+            self._flush_timer_handle.cancel()
+            self._flush_timer_handle = None
+
+    def pass_on(self, snapshot: PlayingSnapshot):
+        """Log and emit events for the changes since the last state passed on, and add snapshot to the history"""
+        self.cancel()
+        prev_playstatus = self.prev_playstatus
+        if prev_playstatus:
+            # Compare against the last state passed on, so coalesced position updates are included
+            changes = prev_playstatus.get_changes(snapshot)
+            if not changes:
+                PUSH_UPDATES.inc(self.device_mac, 'unchanged')
+                return
+        else:
+            changes = PlayingSnapshot().get_changes(snapshot)
+        PUSH_UPDATES.inc(self.device_mac, 'changed')
+        self.history.append(snapshot)
+        # changes is only converted to a str by the logging thread, if this level is enabled
+        self.logger.info('playstatus_update(): %s', changes)
+        emit_event(EVENT_PLAYSTATUS, self.device_mac, self.device_name,
+                   changes.get_old_values(), changes.get_new_values())
+        if 'title' in changes:
+            emit_event(EVENT_TITLE, self.device_mac,
+                       self.device_name, *changes['title'])
+        if 'device_state' in changes:
+            emit_event(EVENT_DEVICE_STATE, self.device_mac,
+                       self.device_name, *changes['device_state'])
+        if self.fetch_artwork:
+            artwork_key = get_artwork_key(snapshot.content_identifier, snapshot.title, snapshot.artist, snapshot.album)
+            if artwork_key != self.artwork_key:
+                self.artwork_key = artwork_key
+                if artwork_key:
+                    get_task_registry().submit(self.device_mac, 'artwork', self.update_artwork, artwork_key)
+
+    async def update_artwork(self, artwork_key: str):
+        """Get the artwork for artwork_key from the artwork cache, which only requests it from the device on a miss, and
+        pass it on as an artwork event if it is still what is playing"""
+        async def fetch_artwork() -> Optional[interface.ArtworkInfo]:
+            artwork = await self.fetch_artwork()
+            if artwork_key != self.artwork_key:
+                # The device only returns the artwork of what is playing now, so it may belong to other content
+                raise RuntimeError('What is playing changed while fetching its artwork')
+            return artwork
+
+        artwork = await get_artwork_cache().get(artwork_key, fetch_artwork)
+        if artwork_key != self.artwork_key:
+            return
+        artwork_details = get_artwork_details(artwork_key, artwork)
+        if artwork_details != self.artwork_details:
+            emit_event(EVENT_ARTWORK, self.device_mac, self.device_name,
+                       self.artwork_details, artwork_details)
+            self.artwork_details = artwork_details
 
     def playstatus_error(self, updater, exception: Exception):
-        print(f'{get_log_prefix()}playstatus_error():\n{exception}')
+        self.logger.error('playstatus_error():\n%s', exception)
+        emit_event(EVENT_PLAYSTATUS_ERROR, self.device_mac,
+                   self.device_name, None, exception)
@@ -0,0 +1,212 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Optional
+
+import config
+
+
+# The name of the parent logger of all loggers returned by get_logger()
+ROOT_LOGGER_NAME: str = 'appletv'
+
+# The maximum number of log records waiting to be written before new ones are dropped, so a blocked stdout cannot exhaust memory
+LOG_QUEUE_SIZE: int = 10000
+
+
+def get_record_prefix(record: logging.LogRecord, include_time: bool = True) -> str:
+    """Return a log prefix for the record like utils.get_log_prefix(), e.g. 'YYYY-MM-DDTHH:MM:SS PowerListener (Living Room): '"""
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(
+        record.created)) if include_time else ' ' * 19
+    class_name = getattr(record, 'class_name', '')
+    device_name = getattr(record, 'device_name', '')
+    if device_name:
+        class_name = '{0:s} ({1:s})'.format(class_name, device_name)
+    class_name_prefix = ' {0:s}:'.format(class_name) if class_name else ''
+    return '{0:s}{1:s} '.format(timestamp, class_name_prefix)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats records the same way as the print()-based logs, prefixing warnings and errors with their level"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if record.levelno >= logging.WARNING:
+            message = '{0:s}: {1:s}'.format(record.levelname, message)
+        if record.exc_info:
+            message = '{0:s}\n{1:s}'.format(
+                message, self.formatException(record.exc_info))
+        return get_record_prefix(record) + message
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        record_json = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + '.{0:03d}'.format(int(record.msecs)),
+            'level': record.levelname,
+            'logger': getattr(record, 'class_name', ''),
+            'device': getattr(record, 'device_name', ''),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            record_json['exception'] = self.formatException(record.exc_info)
+        return json.dumps(record_json, default=str)
+
+
+class LevelRangeFilter(logging.Filter):
+    """Only pass records with a level below max_level"""
+
+    def __init__(self, max_level: int):
+        super().__init__()
+        self.max_level = max_level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno < self.max_level
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler which leaves all formatting and I/O to the QueueListener thread
+
+    The standard QueueHandler formats each record before queueing it, which would still cost the event loop thread the
+    string formatting (e.g. str() of a whole interface.Playing object). Since records never leave this process, they can be
+    queued as-is. The time spent on the calling thread is measured, so the cost of logging on the event loop is known."""
+    record_count: int = 0
+    dropped_count: int = 0
+    emit_seconds: float = 0.0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+    def emit(self, record: logging.LogRecord):
+        start_time = time.perf_counter()
+        super().emit(record)
+        self.emit_seconds += time.perf_counter() - start_time
+        self.record_count += 1
+
+
+class DeviceLoggerAdapter(logging.LoggerAdapter):
+    """Adds the class_name and device_name used in log prefixes to every record, and sets up logging on first use"""
+
+    def isEnabledFor(self, level: int) -> bool:
+        if _queue_handler is None:
+            setup_logging()
+        return super().isEnabledFor(level)
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = self.extra
+        return msg, kwargs
+
+
+_queue_handler: Optional[DeferredQueueHandler] = None
+_queue_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(level: Optional[str] = None, json_lines: Optional[bool] = None, file_name: Optional[str] = None):
+    """Send all logs through a queue to a background thread, which formats them and writes them to stdout/stderr (or a file)
+
+    Arguments default to config.LOG_LEVEL, config.LOG_JSON_LINES, and config.LOG_FILE_NAME. Per-logger levels may be set in
+    config.LOG_LEVELS, like {"PushListener": "WARNING"}. Does nothing if logging was already set up."""
+    global _queue_handler, _queue_listener
+    with _setup_lock:
+        if _queue_handler is not None:
+            return
+
+        formatter = JsonLinesFormatter() if (
+            config.LOG_JSON_LINES if json_lines is None else json_lines) else TextFormatter()
+        file_name = config.LOG_FILE_NAME if file_name is None else file_name
+        if file_name:
+            file_handler = logging.FileHandler(file_name)
+            file_handler.setFormatter(formatter)
+            handlers = [file_handler]
+        else:
+            # Like the print()-based logs, send warnings and errors to stderr and everything else to stdout
+            stdout_handler = logging.StreamHandler(sys.stdout)
+            stdout_handler.addFilter(LevelRangeFilter(logging.WARNING))
+            stderr_handler = logging.StreamHandler(sys.stderr)
+            stderr_handler.setLevel(logging.WARNING)
+            handlers = [stdout_handler, stderr_handler]
+            for handler in handlers:
+                handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _queue_handler = DeferredQueueHandler(log_queue)
+        _queue_listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True)
+        _queue_listener.start()
+        atexit.register(shutdown_logging)
+
+        root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+        root_logger.addHandler(_queue_handler)
+        root_logger.propagate = False
+        apply_log_levels(level)
+
+
+# The names of the loggers whose levels were set from config.LOG_LEVELS
+_leveled_class_names: set[str] = set()
+
+
+def apply_log_levels(level: Optional[str] = None):
+    """Set the level of all logs (level, or config.LOG_LEVEL by default) and of individual loggers (config.LOG_LEVELS),
+    resetting loggers which are no longer in config.LOG_LEVELS"""
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(level or config.LOG_LEVEL)
+    for class_name in _leveled_class_names - set(config.LOG_LEVELS):
+        logging.getLogger('{0:s}.{1:s}'.format(
+            ROOT_LOGGER_NAME, class_name)).setLevel(logging.NOTSET)
+    for class_name, class_level in config.LOG_LEVELS.items():
+        logging.getLogger('{0:s}.{1:s}'.format(
+            ROOT_LOGGER_NAME, class_name)).setLevel(class_level)
+    _leveled_class_names.clear()
+    _leveled_class_names.update(config.LOG_LEVELS)
+
+
+def shutdown_logging():
+    """Write any queued logs and stop the background thread"""
+    global _queue_handler, _queue_listener
+    with _setup_lock:
+        if _queue_listener is not None:
+            _queue_listener.stop()
+            logging.getLogger(ROOT_LOGGER_NAME).removeHandler(_queue_handler)
+        _queue_handler = None
+        _queue_listener = None
+
+
+def flush_logs():
+    """Block until all queued logs have been written, e.g. before showing an interactive prompt"""
+    if _queue_handler is not None:
+        _queue_handler.queue.join()
+
+
+def get_logger(class_name: str = '', device_name: str = '') -> logging.LoggerAdapter:
+    """Return a logger whose records are prefixed with class_name and device_name, like utils.get_log_prefix()
+
+    Use %-style arguments (e.g. logger.info('Connected to %s', name)) instead of f-strings, so formatting is done off the event loop.
+    Unless setup_logging() was called before, logging is set up from config when the first record is logged."""
+    logger_name = '{0:s}.{1:s}'.format(
+        ROOT_LOGGER_NAME, class_name) if class_name else ROOT_LOGGER_NAME
+    return DeviceLoggerAdapter(logging.getLogger(logger_name), {'class_name': class_name, 'device_name': device_name})
+
+
+def get_logging_stats() -> dict:
+    """Return the number of records logged and dropped, and the time spent logging on calling threads (like the event loop)"""
+    if _queue_handler is None:
+        return {'records': 0, 'dropped': 0, 'emit_seconds': 0.0, 'emit_seconds_per_record': 0.0, 'queue_depth': 0}
+    return {
+        'records': _queue_handler.record_count,
+        'dropped': _queue_handler.dropped_count,
+        'emit_seconds': _queue_handler.emit_seconds,
+        'emit_seconds_per_record': _queue_handler.emit_seconds / _queue_handler.record_count if _queue_handler.record_count else 0.0,
+        'queue_depth': _queue_handler.queue.qsize(),
+    }
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, Callable, Optional, Union
+
+from pyatv import interface
+
+import config
+from device_session import get_device_session
+from events import EVENT_TYPES, ListenerEvent, normalize_value, subscribe
+from log import get_logger
+from metrics import MACRO_RUNS, MACRO_STEP_SECONDS
+from rules import compile_condition
+from utils import s_if_plural
+
+
+# The filename of the macros JSON file, relative to the root path (see macros-sample.json)
+MACROS_FILE_NAME: str = 'macros.json'
+
+# Remote control buttons which may be pressed by {"remote": "..."} steps (see: https://pyatv.dev/development/control/)
+REMOTE_BUTTONS: tuple = ('up', 'down', 'left', 'right', 'select', 'menu', 'home', 'home_hold', 'top_menu', 'play', 'pause',
+                         'play_pause', 'stop', 'next', 'previous', 'skip_forward', 'skip_backward', 'volume_up',
+                         'volume_down', 'channel_up', 'channel_down', 'screensaver', 'suspend', 'wakeup')
+
+POWER_COMMANDS: tuple = ('turn_on', 'turn_off')
+
+# The keys which identify the type of a step, like {"remote": "select"}
+STEP_TYPES: tuple = ('remote', 'power', 'launch_app', 'set_volume', 'wait', 'sleep')
+
+logger = get_logger()
+
+
+class MacroError(Exception):
+    pass
+
+
+class Step:
+    """A compiled macro step, which sends one command over a connection, or waits"""
+    __slots__ = ('step_type', 'argument', 'predicate', 'timeout_seconds', 'description')
+
+    def __init__(self, step_json: dict, macro_name: str):
+        step_types = [step_type for step_type in STEP_TYPES if step_type in step_json]
+        if len(step_types) != 1:
+            raise ValueError('Macro "{0:s}" has a step with {1:s}, expected exactly one of: {2:s}'.format(
+                macro_name, 'types ' + ', '.join(step_types) if step_types else 'no type', ', '.join(STEP_TYPES)))
+        self.step_type = step_types[0]
+        self.argument = step_json[self.step_type]
+        self.predicate = None
+        self.timeout_seconds = step_json.get(
+            'timeout_seconds', config.MACRO_WAIT_TIMEOUT_SECONDS)
+        self.description = '{0:s} {1}'.format(self.step_type, self.argument)
+
+        if self.step_type == 'remote' and self.argument not in REMOTE_BUTTONS:
+            raise ValueError('Macro "{0:s}" has unknown remote button "{1}", expected one of: {2:s}'.format(
+                macro_name, self.argument, ', '.join(REMOTE_BUTTONS)))
+        if self.step_type == 'power' and self.argument not in POWER_COMMANDS:
+            raise ValueError('Macro "{0:s}" has unknown power command "{1}", expected one of: {2:s}'.format(
+                macro_name, self.argument, ', '.join(POWER_COMMANDS)))
+        if self.step_type == 'wait':
+            if self.argument not in EVENT_TYPES:
+                raise ValueError('Macro "{0:s}" waits for unknown event "{1}", expected one of: {2:s}'.format(
+                    macro_name, self.argument, ', '.join(EVENT_TYPES)))
+            if 'new' not in step_json:
+                raise ValueError('Macro "{0:s}" waits for {1:s} without a "new" condition'.format(
+                    macro_name, self.argument))
+            self.predicate = compile_condition(step_json['new'])
+            self.description = 'wait {0:s} {1}'.format(
+                self.argument, json.dumps(step_json['new']))
+
+
+def compile_stage(stage_json: Union[dict, list], macro_name: str) -> list[Step]:
+    """Return the steps of a stage: a single step, or a list of independent steps which are sent without waiting for
+    each other"""
+    if isinstance(stage_json, list):
+        return [Step(step_json, macro_name) for step_json in stage_json]
+    return [Step(stage_json, macro_name)]
+
+
+class MacroEngine:
+    """Runs named sequences of commands against the connections already open in DeviceSessions
+
+    Each macro is a list of stages, run one after another. A stage is either one step, or a list of independent steps run
+    concurrently, so their commands are pipelined over the connection instead of each waiting for the previous response.
+    Instead of fixed sleeps, "wait" steps wait until a listener reports a state, like {"wait": "power", "new": "On"}, and
+    finish right away if the latest event of that type already matches. The latency of each step is logged and recorded."""
+    macros: dict[str, list[list[Step]]]
+
+    def __init__(self, macros_json: dict[str, list]):
+        self.macros = {name: [compile_stage(stage_json, name) for stage_json in stages_json]
+                       for name, stages_json in macros_json.items()}
+        # The latest normalized new value of each event type for each device, by (device MAC, event type)
+        self._latest_values: dict[tuple[str, str], Any] = {}
+        self._waiters: list[tuple[str, str, Callable[[Any], bool], asyncio.Future]] = []
+
+    def handle_event(self, event: ListenerEvent):
+        """Record the latest value of the event's type, and wake up any waits it satisfies (subscribed to events via subscribe())"""
+        new_value = normalize_value(event.new_value)
+        self._latest_values[(event.device_mac, event.event_type)] = new_value
+        for waiter in list(self._waiters):
+            device_mac, event_type, predicate, future = waiter
+            if device_mac == event.device_mac and event_type == event.event_type and predicate(new_value) \
+                    and not future.done():
+                future.set_result(new_value)
+
+    async def wait_for_state(self, device_mac: str, event_type: str, predicate: Callable[[Any], bool], timeout_seconds: float):
+        key = (device_mac, event_type)
+        if key in self._latest_values and predicate(self._latest_values[key]):
+            return
+        waiter = (device_mac, event_type, predicate,
+                  asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[3], timeout_seconds)
+        finally:
+            self._waiters.remove(waiter)
+
+    async def run_step(self, step: Step, apple_tv: interface.AppleTV, device_mac: str):
+        if step.step_type == 'remote':
+            await getattr(apple_tv.remote_control, step.argument)()
+        elif step.step_type == 'power':
+            await getattr(apple_tv.power, step.argument)()
+        elif step.step_type == 'launch_app':
+            await apple_tv.apps.launch_app(step.argument)
+        elif step.step_type == 'set_volume':
+            await apple_tv.audio.set_volume(float(step.argument))
+        elif step.step_type == 'wait':
+            await self.wait_for_state(device_mac, step.argument, step.predicate, step.timeout_seconds)
+        elif step.step_type == 'sleep':
+            await asyncio.sleep(float(step.argument))
+
+    async def run_timed_step(self, macro_name: str, step: Step, apple_tv: interface.AppleTV, device_mac: str) -> float:
+        """Run the step, and return how many seconds it took"""
+        start_time = time.perf_counter()
+        try:
+            await self.run_step(step, apple_tv, device_mac)
+        except asyncio.TimeoutError:
+            raise MacroError('{0:s} timed out after {1}s'.format(
+                step.description, step.timeout_seconds))
+        except Exception as ex:
+            raise MacroError('{0:s} failed: {1!r}'.format(step.description, ex))
+        latency = time.perf_counter() - start_time
+        MACRO_STEP_SECONDS.observe(latency, macro_name, step.step_type)
+        return latency
+
+    async def run(self, macro_name: str, device: str) -> list[tuple[str, float]]:
+        """Run the macro against the connected device with the provided MAC address or name, and return the description
+        and latency (in seconds) of each step, raising a MacroError if a step failed or the device is not connected"""
+        if macro_name not in self.macros:
+            raise MacroError('Unknown macro "{0:s}", expected one of: {1:s}'.format(
+                macro_name, ', '.join(self.macros)))
+        device_session = get_device_session(device)
+        if device_session is None or device_session.connected_apple_tv is None:
+            raise MacroError('{0:s} is not connected'.format(device))
+        apple_tv = device_session.connected_apple_tv
+        device_mac = device_session.device_mac
+
+        start_time = time.perf_counter()
+        step_latencies = []
+        try:
+            for stage in self.macros[macro_name]:
+                tasks = [asyncio.ensure_future(self.run_timed_step(macro_name, step, apple_tv, device_mac))
+                         for step in stage]
+                try:
+                    latencies = await asyncio.gather(*tasks)
+                except BaseException:
+                    # Stop the other steps of the stage, so they do not keep sending commands after the macro failed
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+                step_latencies.extend(
+                    (step.description, latency) for step, latency in zip(stage, latencies))
+        except MacroError as ex:
+            MACRO_RUNS.inc(macro_name, 'failed')
+            logger.error('Macro "%s" on %s failed after %.3fs! %s', macro_name,
+                         device_session.device_summary_str, time.perf_counter() - start_time, ex)
+            raise
+
+        MACRO_RUNS.inc(macro_name, 'succeeded')
+        logger.info('Macro "%s" on %s took %.3fs (%s)', macro_name, device_session.device_summary_str,
+                    time.perf_counter() - start_time,
+                    ', '.join('{0:s}: {1:.3f}s'.format(description, latency) for description, latency in step_latencies))
+        return step_latencies
+
+
+def load_macros(file_name: str = MACROS_FILE_NAME) -> dict[str, list]:
+    """Read and return macros from the macros JSON file, or no macros if it does not exist"""
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, 'r') as openfile:
+        return json.load(openfile)
+
+
+_macro_engine: Optional[MacroEngine] = None
+
+
+def start_macro_engine(file_name: str = MACROS_FILE_NAME) -> MacroEngine:
+    """Compile macros from the macros JSON file and subscribe the resulting MacroEngine to listener events
+
+    Must be called before adding listeners, so that the initial states are known to wait steps"""
+    global _macro_engine
+    if _macro_engine is None:
+        _macro_engine = MacroEngine(load_macros(file_name))
+        subscribe(_macro_engine.handle_event)
+        if _macro_engine.macros:
+            logger.info('Loaded %d macro%s', len(_macro_engine.macros),
+                        s_if_plural(len(_macro_engine.macros)))
+    return _macro_engine
@@ -1,82 +1,127 @@
-from aioconsole import ainput
+import time
+
+# Measured before any other imports, so that --profile-startup can report how long importing took
+STARTUP_START_TIME = time.perf_counter()
+
+import argparse
 import asyncio
-import platform
-from signal import SIGINT, SIGTERM
-import sys
+from typing import Iterable, Optional
 
-from connect_apple_tv import connect_apple_tv
-from listeners.audio_listener import AudioListener
-from listeners.device_listener import DeviceListener
-from listeners.keyboard_listener import KeyboardListener
-from listeners.power_listener import PowerListener
-from listeners.push_listener import PushListener
-from utils import get_log_prefix
+import config
+# Imported before other modules of this project, so that settings missing from config.py (and those in config.json) apply
+#   to their defaults too
+from config_file import start_config_watcher, stop_config_watcher
+from device_session import LISTENER_NAMES, DeviceSession
+from event_store import close_event_store, start_event_store
+from log import get_logger
+from macros import start_macro_engine
+from metrics import start_metrics_server, stop_metrics_server
+from rules import start_rule_engine
+from sinks import close_sinks, get_sink_fan_out
+from state_server import start_state_server, stop_state_server
+from supervisor import supervise_paired_apple_tvs
+from task_registry import drain_task_registry
+from utils import StartupProfile, save_last_connected, wait_for_exit_request
+from webhook_dispatcher import close_webhook_dispatcher, start_webhook_dispatcher
 
 
-loop = asyncio.get_event_loop()
+logger = get_logger()
 
 
-async def main():
+async def main(listener_names: Iterable[str] = config.LISTENERS, startup_profile: Optional[StartupProfile] = None):
     """Guide user through pair & connect, add listeners, and exit on keyboard interrupt."""
+    # Imported here, since the interactive prompts (and their dependencies) are not needed when running headless
+    from connect_apple_tv import select_apple_tv
+
     exit_code = 0
-    connected_apple_tv = None
+    device_session = None
     try:
-        connected_apple_tv = await connect_apple_tv()
-
-        # TODO: Comment/uncomment the following lines depending on which listeners you'd like to use
-        # For more information, see: https://pyatv.dev/development/listeners/
-        # AudioListener
-        # audio_listener = AudioListener()
-        # connected_apple_tv.audio.listener = audio_listener
-
-        # DeviceListener
-        device_listener = DeviceListener()
-        connected_apple_tv.listener = device_listener
-
-        # KeyboardListener
-        # keyboard_listener = KeyboardListener()
-        # connected_apple_tv.keyboard.listener = keyboard_listener
-
-        # PowerListener
-        power_listener = PowerListener(connected_apple_tv.power.power_state)
-        connected_apple_tv.power.listener = power_listener
-
-        # PushListener
-        # push_listener = PushListener()
-        # connected_apple_tv.push_updater.listener = push_listener
-        # connected_apple_tv.push_updater.start()
-
-        print(
-            f'{get_log_prefix()}Successfully added listeners!')
-
-        if platform.system() == 'Windows':
-            should_exit: bool = False
-            include_time: bool = False
-            while not should_exit:
-                user_input: str = await ainput(f'{get_log_prefix(include_time)}Type "exit" to close connection and exit\n')
-                include_time = True
-                should_exit = user_input.strip() == 'exit'
-        else:
-            print(
-                f'{get_log_prefix(False)}Press Ctrl+C to close connection and exit')
-            # Attach signal handlers to trigger exit event when killed or terminated
-            exit_event = asyncio.Event()
-            for signal in [SIGINT, SIGTERM]:
-                loop.add_signal_handler(signal, exit_event.set)
-            await exit_event.wait()
+        start_time = time.perf_counter()
+        start_config_watcher()
+        start_event_store()
+        start_macro_engine()
+        start_rule_engine()
+        get_sink_fan_out()
+        start_webhook_dispatcher()
+        await start_metrics_server()
+        await start_state_server()
+        if startup_profile:
+            startup_profile.mark('start services')
+        device_session = DeviceSession(await select_apple_tv(), listener_names=listener_names)
+        if startup_profile:
+            startup_profile.mark('select')
+        if not await device_session.connect():
+            raise RuntimeError(
+                f'Could not connect to {device_session.device_summary_str}')
+        logger.info('Connected in %.2fs since startup',
+                    time.perf_counter() - start_time)
+        save_last_connected(device_session.device_mac)
+
+        # Listeners are enabled by config.LISTENERS, or the --listeners argument
+        device_session.add_listeners()
+        if startup_profile:
+            startup_profile.mark('connect')
+            startup_profile.log()
+
+        await wait_for_exit_request()
 
         print()
     except KeyboardInterrupt:
         exit_code = 130
     except Exception as ex:
         exit_code = 1
-        print(
-            f'{get_log_prefix()}ERROR: An exception was thrown in main.py! Details:\n{ex}', sys.stderr)
+        logger.error('An exception was thrown in main.py! Details:\n%s', ex)
     finally:
-        print(f'{get_log_prefix()}Closing connection and exiting...')
-        if connected_apple_tv:
-            connected_apple_tv.close()
+        logger.info('Closing connection and exiting...')
+        # Let running rule actions finish while still connected, before closing connections
+        await drain_task_registry()
+        if device_session:
+            device_session.close()
+        await close_webhook_dispatcher()
+        await close_sinks()
+        close_event_store()
+        await stop_metrics_server()
+        await stop_state_server()
+        stop_config_watcher()
         exit(exit_code)
 
 
-loop.run_until_complete(main())
+def parse_listener_names(value: str) -> list[str]:
+    listener_names = [listener_name.strip()
+                      for listener_name in value.split(',') if listener_name.strip()]
+    for listener_name in listener_names:
+        if listener_name not in LISTENER_NAMES:
+            raise argparse.ArgumentTypeError('Unknown listener "{0:s}", expected any of: {1:s}'.format(
+                listener_name, ', '.join(LISTENER_NAMES)))
+    return listener_names
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Connect to Apple TVs and run rules on their events. Without --device or --all-paired, asks which Apple TV '
+                    'to connect to (and pairs it if needed).')
+    devices_group = parser.add_mutually_exclusive_group()
+    devices_group.add_argument('--device', action='append', dest='device_macs', metavar='MAC', type=str.upper,
+                               help='Connect to the paired Apple TV with this MAC address without any prompts (may be repeated)')
+    devices_group.add_argument('--all-paired', action='store_true',
+                               help='Connect to every paired Apple TV without any prompts')
+    parser.add_argument('--listeners', type=parse_listener_names, default=config.LISTENERS,
+                        help='Comma-separated listeners to add, any of: {0:s} (default: {1:s})'.format(
+                            ', '.join(LISTENER_NAMES), ','.join(config.LISTENERS)))
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Log how long each phase of startup took, including imports')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    startup_profile = None
+    if args.profile_startup:
+        startup_profile = StartupProfile(STARTUP_START_TIME)
+        startup_profile.mark('imports')
+
+    if args.device_macs or args.all_paired:
+        asyncio.run(supervise_paired_apple_tvs(
+            args.device_macs, args.listeners, startup_profile))
+    else:
+        asyncio.run(main(args.listeners, startup_profile))
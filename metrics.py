@@ -0,0 +1,262 @@
+import asyncio
+from bisect import bisect_left
+import math
+from typing import Callable, Optional
+
+from aiohttp import web
+
+import config
+from log import get_logger, get_logging_stats
+
+
+# The default histogram buckets (in seconds), from 1ms to 60s
+DEFAULT_BUCKETS: tuple = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The number of seconds between event loop lag measurements
+LOOP_LAG_INTERVAL_SECONDS: float = 0.5
+
+# The content type of the Prometheus text exposition format (see: https://prometheus.io/docs/instrumenting/exposition_formats/)
+PROMETHEUS_CONTENT_TYPE: str = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = get_logger()
+
+_metrics: list = []
+
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = '') -> str:
+    """Return a Prometheus label set like '{event_type="power",device_mac="AA:BB"}', or '' if there are no labels"""
+    labels = ['{0:s}="{1:s}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{{{0:s}}}'.format(','.join(labels)) if labels else ''
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value per label set which only ever goes up, like the number of events received
+
+    Label values are passed positionally, in the order of label_names. Updating a counter is a single dict update, so it is
+    cheap enough to call from listener callbacks."""
+    name: str
+    help: str
+    label_names: tuple
+
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {} if label_names else {(): 0}
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(
+            label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        lines = ['# HELP {0:s} {1:s}'.format(self.name, self.help),
+                 '# TYPE {0:s} counter'.format(self.name)]
+        for label_values, value in list(self._values.items()):
+            lines.append('{0:s}{1:s} {2:s}'.format(self.name, format_labels(
+                self.label_names, label_values), format_value(value)))
+        return lines
+
+
+class Gauge:
+    """A value which may go up or down, read from get_value when rendered (e.g. a queue depth)"""
+    name: str
+    help: str
+    get_value: Callable[[], float]
+
+    def __init__(self, name: str, help: str, get_value: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.get_value = get_value
+        _metrics.append(self)
+
+    def render(self) -> list[str]:
+        return ['# HELP {0:s} {1:s}'.format(self.name, self.help),
+                '# TYPE {0:s} gauge'.format(self.name),
+                '{0:s} {1:s}'.format(self.name, format_value(self.get_value()))]
+
+
+class Histogram:
+    """Counts of observed values (like latencies in seconds) per bucket and label set, along with their sum and count
+
+    Observing a value only increments one bucket; buckets are made cumulative when rendered."""
+    name: str
+    help: str
+    label_names: tuple
+    buckets: tuple
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket (plus +Inf), then the sum and count of all values
+        self._values: dict[tuple, list] = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *label_values):
+        values = self._values.get(label_values)
+        if values is None:
+            values = self._values[label_values] = [
+                0] * (len(self.buckets) + 1) + [0.0, 0]
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def get_count(self, *label_values) -> int:
+        values = self._values.get(label_values)
+        return values[-1] if values else 0
+
+    def render(self) -> list[str]:
+        lines = ['# HELP {0:s} {1:s}'.format(self.name, self.help),
+                 '# TYPE {0:s} histogram'.format(self.name)]
+        for label_values, values in list(self._values.items()):
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative_count += count
+                lines.append('{0:s}_bucket{1:s} {2:d}'.format(self.name, format_labels(
+                    self.label_names, label_values, 'le="{0:s}"'.format(format_value(upper_bound))), cumulative_count))
+            labels = format_labels(self.label_names, label_values)
+            lines.append('{0:s}_sum{1:s} {2:s}'.format(
+                self.name, labels, format_value(values[-2])))
+            lines.append('{0:s}_count{1:s} {2:d}'.format(
+                self.name, labels, values[-1]))
+        return lines
+
+
+def render_metrics() -> str:
+    """Return every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics collected across the app
+LISTENER_EVENTS = Counter('atv_listener_events_total',
+                          'Listener events emitted, per event type and device', ('event_type', 'device_mac'))
+EVENT_DISPATCH_SECONDS = Histogram('atv_event_dispatch_seconds',
+                                   'Time spent passing an event to its subscribers (e.g. matching rules)', ('event_type',),
+                                   buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+POWER_DECISIONS = Counter('atv_power_decisions_total',
+                          'Power state updates by decision: stable, pending (waiting to become stable), or unstable (ignored)',
+                          ('device_mac', 'decision'))
+PUSH_UPDATES = Counter('atv_push_updates_total',
+                       'Push updates per device, by result: changed, coalesced (only the position changed), or unchanged',
+                       ('device_mac', 'result'))
+EVENT_STORE_EVENTS = Counter('atv_event_store_events_total',
+                             'Events written to the event store, or dropped because its queue was full', ('result',))
+WEBHOOK_REQUESTS = Counter('atv_webhook_requests_total',
+                           'Webhook POST request attempts, by response status code (or "error" if no response)', ('status',))
+WEBHOOK_REQUEST_SECONDS = Histogram('atv_webhook_request_seconds',
+                                    'Webhook POST request round-trip time, by response status code (or "error")', ('status',))
+WEBHOOK_RETRIES = Counter('atv_webhook_retries_total',
+                          'Webhook POST requests retried')
+WEBHOOK_FAILURES = Counter('atv_webhook_failures_total',
+                           'Webhook POST requests given up on after retrying')
+WEBHOOK_DROPPED = Counter('atv_webhook_dropped_total',
+                          'Webhook POST requests dropped because the queue was full')
+SCAN_SECONDS = Histogram('atv_scan_seconds',
+                         'Network scan duration, by scan type (unicast for known addresses, full, or presence rescans)', ('scan_type',))
+CONNECTION_LOSSES = Counter('atv_connection_losses_total',
+                            'Connections lost unexpectedly, per device', ('device_mac',))
+RECONNECT_ATTEMPTS = Counter('atv_reconnect_attempts_total',
+                             'Reconnection attempts, per device and result', ('device_mac', 'result'))
+OUTAGE_SECONDS = Histogram('atv_outage_seconds',
+                           'Downtime from losing a connection until it was re-established, per device', ('device_mac',),
+                           buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+HEALTH_PROBES = Counter('atv_health_probes_total',
+                        'Connection health probes, per device and result', ('device_mac', 'result'))
+HEALTH_PROBE_SECONDS = Histogram('atv_health_probe_seconds',
+                                 'Round-trip time of successful connection health probes, per device', ('device_mac',))
+PRESENCE_CHANGES = Counter('atv_presence_changes_total',
+                           'Apple TVs found by rescans to have appeared, gone, or changed address, per change', ('change',))
+SPOOL_RECORDS = Counter('atv_spool_records_total',
+                        'Outbound records appended to the spool, acknowledged after delivery, or discarded when it was full', ('result',))
+SINK_EVENTS = Counter('atv_sink_events_total',
+                      'Events per sink and result (sent, failed, queue_full, or circuit_open)', ('sink', 'result'))
+SINK_SEND_SECONDS = Histogram('atv_sink_send_seconds',
+                              'Time taken to send an event to a sink successfully, per sink', ('sink',))
+SINK_CIRCUIT_OPENS = Counter('atv_sink_circuit_opens_total',
+                             'Times the circuit breaker of a sink opened after repeated failures, per sink', ('sink',))
+STATE_SERVER_CLIENTS_DROPPED = Counter('atv_state_server_clients_dropped_total',
+                                      'State stream clients disconnected for falling behind')
+TASKS = Counter('atv_tasks_total',
+                'Background tasks (like rule actions) per name and result (succeeded, failed, cancelled, or dropped)', ('name', 'result'))
+TASK_SECONDS = Histogram('atv_task_seconds',
+                         'Background task durations, per name', ('name',))
+MACRO_RUNS = Counter('atv_macro_runs_total',
+                     'Macro runs, per macro and result', ('macro', 'result'))
+MACRO_STEP_SECONDS = Histogram('atv_macro_step_seconds',
+                               'Latency of successful macro steps, per macro and step type', ('macro', 'step_type'))
+ARTWORK_CACHE_REQUESTS = Counter('atv_artwork_cache_requests_total',
+                                'Artwork cache lookups, per result (hit, disk_hit, miss, coalesced, or failed)', ('result',))
+ARTWORK_CACHE_EVICTIONS = Counter('atv_artwork_cache_evictions_total',
+                                  'Items evicted from the artwork cache, per tier (memory or disk)', ('tier',))
+ARTWORK_FETCH_SECONDS = Histogram('atv_artwork_fetch_seconds',
+                                  'Time taken to fetch artwork from a device on a cache miss')
+CONFIG_RELOADS = Counter('atv_config_reloads_total',
+                         'Loads of config.json, per result (applied or invalid)', ('result',))
+LOOP_LAG_SECONDS = Histogram('atv_event_loop_lag_seconds',
+                             'How late the event loop woke up from a sleep, i.e. how long callbacks blocked it')
+LOG_RECORDS_DROPPED = Gauge('atv_log_records_dropped',
+                            'Log records dropped because the logging queue was full', lambda: get_logging_stats()['dropped'])
+
+
+async def monitor_loop_lag(interval_seconds: float = LOOP_LAG_INTERVAL_SECONDS):
+    """Measure event loop lag every interval_seconds until cancelled"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(interval_seconds)
+        LOOP_LAG_SECONDS.observe(
+            max(0.0, loop.time() - start_time - interval_seconds))
+
+
+async def handle_metrics_request(request: web.Request) -> web.Response:
+    return web.Response(body=render_metrics().encode('utf-8'), headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+_runner: Optional[web.AppRunner] = None
+_loop_lag_task: Optional[asyncio.Task] = None
+
+
+async def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None):
+    """Serve metrics at http://host:port/metrics and start measuring event loop lag, unless port is 0 (disabled)
+
+    Arguments default to config.METRICS_PORT and config.METRICS_HOST"""
+    global _runner, _loop_lag_task
+    port = config.METRICS_PORT if port is None else port
+    host = host or config.METRICS_HOST
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics_request)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    _loop_lag_task = asyncio.ensure_future(monitor_loop_lag())
+    logger.info('Serving metrics at http://%s:%d/metrics', host, port)
+
+
+async def stop_metrics_server():
+    """Stop serving metrics, if started"""
+    global _runner, _loop_lag_task
+    if _loop_lag_task is not None:
+        _loop_lag_task.cancel()
+        _loop_lag_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -1,23 +1,34 @@
 
+import argparse
 import asyncio
 import inquirer
 from pyatv import pair, interface
 from random import randint
 import re
-import sys
+from typing import Optional
 
-from utils import get_apple_tvs, get_device_summary_str, get_inquirer_padding, get_log_prefix, s_if_plural, save_credential, service_to_protocol_str
+# Imported before other modules of this project, so that settings missing from config.py (and those in config.json) apply
+#   to their defaults too
+import config_file
+from batch_pairing import FilePinProvider, HttpPinProvider, PinProvider, pair_devices
+from credential_store import get_credential_store
+from log import flush_logs, get_logger
+from utils import get_apple_tvs, get_device_summary_str, get_inquirer_padding, s_if_plural, save_credential, service_to_protocol_str
+
+
+logger = get_logger()
 
 
 async def pair_apple_tv(apple_tv: interface.BaseConfig, device_summary_str: str):
     """Perform pairing flow for provided apple_tv device"""
-    print(f'{get_log_prefix()}Starting pairing flow for {device_summary_str}...')
+    logger.info('Starting pairing flow for %s...', device_summary_str)
 
-    # Get protocol_strs for each service and print them
+    # Get protocol_strs for each service and log them
     service_protocol_strs = list(
         map(service_to_protocol_str, apple_tv.services))
     service_protocol_strs_formatted = ', '.join(service_protocol_strs)
-    print(f'{get_log_prefix(False)}{apple_tv.name} supports {len(service_protocol_strs)} protocol{s_if_plural(len(service_protocol_strs))}: {service_protocol_strs_formatted}')
+    logger.info('%s supports %d protocol%s: %s', apple_tv.name, len(service_protocol_strs), s_if_plural(
+        len(service_protocol_strs)), service_protocol_strs_formatted)
 
     if len(apple_tv.services):
         # Ask the user to confirm the device is on
@@ -32,6 +43,7 @@ async def pair_apple_tv(apple_tv: interface.BaseConfig, device_summary_str: str)
                 get_inquirer_padding(), apple_tv.name),
             validate=validate_yes
         )
+        flush_logs()
         inquirer.prompt([device_is_on],
                         raise_keyboard_interrupt=True)
 
@@ -41,13 +53,13 @@ async def pair_apple_tv(apple_tv: interface.BaseConfig, device_summary_str: str)
         protocol_str = service_protocol_strs[i]
 
         if not service.enabled:
-            print(
-                f'{get_log_prefix(False)}WARNING: Skipping {protocol_str} pairing for {apple_tv.name} because the service is disabled!', file=sys.stderr)
+            logger.warning('Skipping %s pairing for %s because the service is disabled!',
+                           protocol_str, apple_tv.name)
             continue
 
         # Initiate pairing
-        print(
-            f'{get_log_prefix()}Starting {protocol_str} pairing on {apple_tv.name}...')
+        logger.info('Starting %s pairing on %s...',
+                    protocol_str, apple_tv.name)
         loop = asyncio.get_event_loop()
         pairing = await pair(apple_tv, service.protocol, loop)
         await pairing.begin()
@@ -65,6 +77,7 @@ async def pair_apple_tv(apple_tv: interface.BaseConfig, device_summary_str: str)
                     get_inquirer_padding(), apple_tv.name),
                 validate=validate_pin
             )
+            flush_logs()
             answers = inquirer.prompt(
                 [pairing_pin], raise_keyboard_interrupt=True)
             pairing.pin(answers['pairing_pin'])
@@ -81,28 +94,31 @@ async def pair_apple_tv(apple_tv: interface.BaseConfig, device_summary_str: str)
                 return True
             pairing_pin_entered = inquirer.Confirm(
                 'pairing_pin_entered',
-                message='{0:s}Enter this PIN: "{1:s}" on {1:s}'.format(
+                message='{0:s}Enter this PIN: "{1:s}" on {2:s}'.format(
                     get_inquirer_padding(), random_pin, apple_tv.name),
                 validate=validate_yes
             )
+            flush_logs()
             inquirer.prompt([pairing_pin_entered],
                             raise_keyboard_interrupt=True)
 
-        # Finish pairing and print result
+        # Finish pairing and log result
         await pairing.finish()
         if pairing.has_paired:
             save_credential(apple_tv.device_info.mac, protocol_str,
                             pairing.service.credentials)
-            print(
-                f'{get_log_prefix(False)}{protocol_str} pairing on {apple_tv.name} completed successfully!')
+            logger.info('%s pairing on %s completed successfully!',
+                        protocol_str, apple_tv.name)
         else:
-            print(
-                f'{get_log_prefix(False)}ERROR: {protocol_str} pairing on {apple_tv.name} failed!', file=sys.stderr)
+            logger.error('%s pairing on %s failed!',
+                         protocol_str, apple_tv.name)
             continue
 
         await pairing.close()
 
-    print(f'{get_log_prefix()}Finished pairing flow for {device_summary_str}!')
+    # Write credentials for all protocols at once
+    get_credential_store().flush()
+    logger.info('Finished pairing flow for %s!', device_summary_str)
 
 
 async def pair_apple_tvs():
@@ -125,6 +141,7 @@ async def pair_apple_tvs():
             choices=device_summary_strs,
             validate=validate_some_checked
         )
+        flush_logs()
         answers = inquirer.prompt(
             [check_to_pair], raise_keyboard_interrupt=True)
 
@@ -141,5 +158,46 @@ async def pair_apple_tvs():
     for idx in idxs_to_pair:
         await pair_apple_tv(apple_tvs[idx], device_summary_strs[idx])
 
+
+async def pair_apple_tvs_without_prompts(pin_provider: PinProvider, device_macs: Optional[list[str]] = None):
+    """Scan for Apple TVs on network, then concurrently pair every one found (or only those with the provided device_macs),
+    getting PINs from pin_provider instead of terminal prompts (see: ./batch_pairing.py)"""
+    apple_tvs = await get_apple_tvs()
+    if device_macs:
+        found_mac_adrs = [apple_tv.device_info.mac for apple_tv in apple_tvs]
+        for mac_adr in device_macs:
+            if mac_adr not in found_mac_adrs:
+                logger.warning('Apple TV %s was not found on network!', mac_adr)
+        apple_tvs = [
+            apple_tv for apple_tv in apple_tvs if apple_tv.device_info.mac in device_macs]
+    if apple_tvs:
+        await pair_devices(apple_tvs, pin_provider)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Pair Apple TVs and save their credentials. Without --device or --all, asks which Apple TVs to pair and '
+                    'prompts for each PIN.')
+    devices_group = parser.add_mutually_exclusive_group()
+    devices_group.add_argument('--device', action='append', dest='device_macs', metavar='MAC', type=str.upper,
+                               help='Pair the Apple TV with this MAC address, concurrently with any others (may be repeated)')
+    devices_group.add_argument('--all', action='store_true',
+                               help='Pair every Apple TV on network concurrently')
+    pins_group = parser.add_mutually_exclusive_group()
+    pins_group.add_argument('--pin-http', action='store_true',
+                            help='With --device or --all, enter PINs on a local web page (the default)')
+    pins_group.add_argument('--pin-file', metavar='FILE',
+                            help='With --device or --all, read PINs from a JSON file like {"MAC address or name": "1234"}, '
+                                 'which is re-read as it changes')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    asyncio.run(pair_apple_tvs())
+    args = parse_args()
+    if args.device_macs or args.all:
+        pin_provider = FilePinProvider(
+            args.pin_file) if args.pin_file else HttpPinProvider()
+        asyncio.run(pair_apple_tvs_without_prompts(
+            pin_provider, args.device_macs))
+    else:
+        asyncio.run(pair_apple_tvs())
@@ -0,0 +1,230 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+from pyatv import interface, scan
+
+import config
+from config_file import on_config_reload
+from device_session import get_device_session
+from discovery_cache import get_discovery_cache
+from events import (EVENT_ADDRESS_CHANGED, EVENT_CONNECTION_LOST, EVENT_DEVICE_APPEARED, EVENT_DEVICE_GONE, ListenerEvent,
+                    emit_event, subscribe, unsubscribe)
+from log import get_logger
+from metrics import Gauge, PRESENCE_CHANGES, SCAN_SECONDS
+from utils import get_device_summary_str, is_apple_tv, s_if_plural
+
+
+# The factor the rescan interval grows by after each rescan which found no changes, up to config.PRESENCE_MAX_INTERVAL_SECONDS
+INTERVAL_BACKOFF_FACTOR: float = 2
+
+# The fraction each rescan interval is randomly shortened or lengthened by, so that rescans by many hosts spread out
+INTERVAL_JITTER: float = 0.1
+
+logger = get_logger()
+
+
+class PresenceEntry:
+    """The latest discovered config and address of an Apple TV on the network"""
+    __slots__ = ('apple_tv', 'address', 'last_seen', 'missed_scans')
+
+    def __init__(self, apple_tv: interface.BaseConfig, last_seen: float):
+        self.apple_tv = apple_tv
+        self.address = str(apple_tv.address)
+        self.last_seen = last_seen  # Unix timestamp of the latest rescan which found it
+        self.missed_scans = 0  # The number of rescans in a row which did not find it
+
+
+class PresenceTracker:
+    """Keeps rescanning the network in the background, and reports Apple TVs which appear, go, or change address
+
+    Each rescan is diffed against an index of the Apple TVs found so far, keyed by MAC address, emitting a device_appeared,
+    device_gone, or address_changed event for each change. Apple TVs missing from a (multicast) rescan are first asked
+    directly at their last-known addresses, since multicast responses are sometimes missed, and are only treated as gone
+    after gone_after_misses rescans in a row missed them.
+
+    The interval starts at min_interval_seconds and grows after each rescan which found no changes, up to
+    max_interval_seconds, so a stable network is rescanned rarely. After a change, it drops back to min_interval_seconds.
+    A lost connection requests a rescan right away (to find an Apple TV at a new address), but rescans are never closer
+    together than min_interval_seconds.
+
+    on_appeared is called with the config of each Apple TV which appeared (e.g. to connect to it), and existing
+    DeviceSessions are updated with the new config of Apple TVs which changed address.
+
+    NOTE: stop() must be called when finished"""
+    index: dict[str, PresenceEntry]
+    interval_seconds: float
+    scan_count: int = 0
+
+    def __init__(self, on_appeared: Optional[Callable[[interface.BaseConfig], None]] = None,
+                 min_interval_seconds: float = config.PRESENCE_MIN_INTERVAL_SECONDS,
+                 max_interval_seconds: float = config.PRESENCE_MAX_INTERVAL_SECONDS,
+                 scan_timeout_seconds: float = config.PRESENCE_SCAN_TIMEOUT_SECONDS,
+                 gone_after_misses: int = config.PRESENCE_GONE_AFTER_MISSES,
+                 scan_function: Callable[..., Awaitable[list[interface.BaseConfig]]] = scan):
+        self.index = {}
+        self.on_appeared = on_appeared
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.scan_timeout_seconds = scan_timeout_seconds
+        self.gone_after_misses = gone_after_misses
+        self.scan_function = scan_function
+        self.interval_seconds = min_interval_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._rescan_requested = asyncio.Event()
+
+    def start(self):
+        """Rescan right away, then keep rescanning in the background until stopped"""
+        if self._task is None:
+            subscribe(self.handle_event)
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            unsubscribe(self.handle_event)
+            self._task.cancel()
+            self._task = None
+
+    def handle_event(self, event: ListenerEvent):
+        """Request a rescan when a connection is lost, in case the Apple TV changed address (subscribed via subscribe())"""
+        if event.event_type == EVENT_CONNECTION_LOST:
+            self.request_rescan()
+
+    def request_rescan(self):
+        """Rescan as soon as min_interval_seconds have passed since the previous rescan"""
+        self._rescan_requested.set()
+
+    async def scan_apple_tvs(self, timeout_seconds: float, hosts: Optional[list[str]] = None) -> dict[str, interface.BaseConfig]:
+        """Scan the network (or only hosts), and return the config of each Apple TV found, by MAC address"""
+        start_time = time.perf_counter()
+        devices = await self.scan_function(asyncio.get_running_loop(), timeout=timeout_seconds, hosts=hosts)
+        SCAN_SECONDS.observe(time.perf_counter() - start_time,
+                             'presence_unicast' if hosts else 'presence')
+        return {device.device_info.mac: device for device in devices
+                if is_apple_tv(device) and device.device_info.mac}
+
+    def _record_change(self, event_type: str, apple_tv: interface.BaseConfig, old_address: Optional[str],
+                       new_address: Optional[str]):
+        PRESENCE_CHANGES.inc(event_type)
+        if event_type == EVENT_DEVICE_APPEARED:
+            logger.info('%s appeared on network at %s', get_device_summary_str(apple_tv), new_address)
+        elif event_type == EVENT_DEVICE_GONE:
+            logger.warning('%s is gone from network, last seen at %s', get_device_summary_str(apple_tv), old_address)
+        else:
+            logger.info('%s changed address from %s to %s', get_device_summary_str(apple_tv), old_address, new_address)
+        emit_event(event_type, apple_tv.device_info.mac,
+                   apple_tv.name, old_address, new_address)
+
+    async def rescan(self) -> int:
+        """Rescan once, update the index and emit an event for each change, and return the number of changes"""
+        found_apple_tvs = await self.scan_apple_tvs(self.scan_timeout_seconds)
+        missing_hosts = list({entry.address for device_mac, entry in self.index.items()
+                              if device_mac not in found_apple_tvs})
+        if missing_hosts:
+            unicast_apple_tvs = await self.scan_apple_tvs(config.DISCOVERY_CACHE_SCAN_TIMEOUT_SECONDS, missing_hosts)
+            for device_mac, apple_tv in unicast_apple_tvs.items():
+                found_apple_tvs.setdefault(device_mac, apple_tv)
+        self.scan_count += 1
+
+        change_count = 0
+        now = time.time()
+        for device_mac, apple_tv in found_apple_tvs.items():
+            entry = self.index.get(device_mac)
+            if entry is None:
+                self.index[device_mac] = PresenceEntry(apple_tv, now)
+                change_count += 1
+                self._record_change(EVENT_DEVICE_APPEARED, apple_tv, None, str(apple_tv.address))
+                if self.on_appeared:
+                    try:
+                        self.on_appeared(apple_tv)
+                    except Exception as ex:
+                        logger.error('Failed to handle %s appearing! Details: %r',
+                                     get_device_summary_str(apple_tv), ex)
+                continue
+
+            old_address = entry.address
+            entry.apple_tv = apple_tv
+            entry.address = str(apple_tv.address)
+            entry.last_seen = now
+            entry.missed_scans = 0
+            if entry.address != old_address:
+                change_count += 1
+                self._record_change(EVENT_ADDRESS_CHANGED, apple_tv, old_address, entry.address)
+                device_session = get_device_session(device_mac)
+                if device_session is not None:
+                    device_session.update_apple_tv(apple_tv)
+
+        for device_mac, entry in list(self.index.items()):
+            if device_mac in found_apple_tvs:
+                continue
+            entry.missed_scans += 1
+            if entry.missed_scans >= self.gone_after_misses:
+                del self.index[device_mac]
+                change_count += 1
+                self._record_change(EVENT_DEVICE_GONE, entry.apple_tv, entry.address, None)
+
+        if found_apple_tvs:
+            get_discovery_cache().update(list(found_apple_tvs.values()))
+        return change_count
+
+    async def _run(self):
+        while True:
+            self._rescan_requested.clear()
+            start_time = time.perf_counter()
+            try:
+                change_count = await self.rescan()
+            except Exception as ex:
+                change_count = 0
+                logger.error('Failed to rescan the network! Details: %r', ex)
+            if change_count:
+                self.interval_seconds = self.min_interval_seconds
+            else:
+                self.interval_seconds = min(
+                    self.max_interval_seconds, self.interval_seconds * INTERVAL_BACKOFF_FACTOR)
+            logger.debug('Rescan found %d change%s in %.2fs, %d Apple TV%s present, next rescan in about %ss',
+                         change_count, s_if_plural(change_count), time.perf_counter() - start_time,
+                         len(self.index), s_if_plural(len(self.index)), self.interval_seconds)
+
+            delay = self.interval_seconds * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER)
+            try:
+                await asyncio.wait_for(self._rescan_requested.wait(), delay)
+                # Requested early, but rescans are rate-limited to one per min_interval_seconds
+                await asyncio.sleep(max(0.0, self.min_interval_seconds - (time.perf_counter() - start_time)))
+                self.interval_seconds = self.min_interval_seconds
+            except asyncio.TimeoutError:
+                pass
+
+
+_presence_tracker: Optional[PresenceTracker] = None
+
+PRESENT_DEVICES = Gauge('atv_present_devices', 'Apple TVs found on network by the latest presence rescans',
+                        lambda: len(_presence_tracker.index) if _presence_tracker else 0)
+
+
+def start_presence_tracker(on_appeared: Optional[Callable[[interface.BaseConfig], None]] = None) -> Optional[PresenceTracker]:
+    """Start the shared PresenceTracker, if config.PRESENCE_ENABLED and not already started, and return it"""
+    global _presence_tracker
+    if config.PRESENCE_ENABLED and _presence_tracker is None:
+        _presence_tracker = PresenceTracker(on_appeared)
+        _presence_tracker.start()
+    return _presence_tracker
+
+
+def stop_presence_tracker():
+    global _presence_tracker
+    if _presence_tracker is not None:
+        _presence_tracker.stop()
+        _presence_tracker = None
+
+
+def apply_config_to_presence_tracker(changed_names: set[str]):
+    """Apply reloaded settings to the shared PresenceTracker, if it was started"""
+    if _presence_tracker is not None:
+        _presence_tracker.min_interval_seconds = config.PRESENCE_MIN_INTERVAL_SECONDS
+        _presence_tracker.max_interval_seconds = config.PRESENCE_MAX_INTERVAL_SECONDS
+        _presence_tracker.scan_timeout_seconds = config.PRESENCE_SCAN_TIMEOUT_SECONDS
+        _presence_tracker.gone_after_misses = config.PRESENCE_GONE_AFTER_MISSES
+
+
+on_config_reload(apply_config_to_presence_tracker)
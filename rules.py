@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+from typing import Any, Callable, Optional
+
+from events import EVENT_POWER, EVENT_TYPES, ListenerEvent, normalize_value, subscribe
+from log import get_logger
+from sinks import get_sink_fan_out
+from task_registry import get_task_registry
+from utils import publish_event_to_ifttt_webhooks, s_if_plural
+from webhook_dispatcher import get_webhook_dispatcher
+
+
+# The filename of the rules JSON file, relative to the root path (see rules-sample.json)
+RULES_FILE_NAME: str = 'rules.json'
+
+# The rules used when there is no rules JSON file, which publish IFTTT events when an Apple TV powers on or off
+DEFAULT_RULES: list[dict] = [
+    {
+        'event': EVENT_POWER,
+        'when': {'new': 'On'},
+        'actions': [{'type': 'webhook', 'ifttt_event': 'atv_power_on'}],
+    },
+    {
+        'event': EVENT_POWER,
+        'when': {'new': 'Off'},
+        'actions': [{'type': 'webhook', 'ifttt_event': 'atv_power_off'}],
+    },
+]
+
+# The device value of rules which match every device
+ANY_DEVICE: str = '*'
+
+# Comparison operators that may be used in rule conditions, like {"new": {"gte": 50}}
+COMPARISON_OPERATORS: dict[str, Callable[[Any, Any], bool]] = {
+    'eq': lambda value, operand: value == operand,
+    'ne': lambda value, operand: value != operand,
+    'in': lambda value, operand: value in operand,
+    'gt': lambda value, operand: value is not None and value > operand,
+    'gte': lambda value, operand: value is not None and value >= operand,
+    'lt': lambda value, operand: value is not None and value < operand,
+    'lte': lambda value, operand: value is not None and value <= operand,
+}
+
+ACTION_TYPES: tuple = ('webhook', 'publish', 'macro', 'shell', 'log')
+
+logger = get_logger()
+
+
+def compile_condition(condition: Any) -> Callable[[Any], bool]:
+    """Return a predicate for an old/new value condition of a rule
+
+    A condition may be a single value (must be equal), a list of values (must be equal to one of them),
+    or a dict of comparison operators to operands (all must hold)"""
+    if isinstance(condition, list):
+        values = [normalize_value(value) for value in condition]
+        return lambda value: value in values
+    if isinstance(condition, dict):
+        comparisons = []
+        for operator, operand in condition.items():
+            if operator not in COMPARISON_OPERATORS:
+                raise ValueError('Unknown comparison operator "{0:s}", expected one of: {1:s}'.format(
+                    operator, ', '.join(COMPARISON_OPERATORS)))
+            comparisons.append((COMPARISON_OPERATORS[operator], operand))
+        return lambda value: all(compare(value, operand) for compare, operand in comparisons)
+    return lambda value: value == condition
+
+
+class Rule:
+    """A compiled rule, which runs its actions for events of event_type from device whose old/new values match"""
+    __slots__ = ('name', 'event_type', 'device', 'old_predicate',
+                 'new_predicate', 'actions')
+
+    def __init__(self, rule_json: dict, idx: int):
+        self.name = rule_json.get('name', 'rule #{0:d}'.format(idx + 1))
+        self.event_type = rule_json.get('event')
+        if self.event_type not in EVENT_TYPES:
+            raise ValueError('{0:s} has unknown event "{1}", expected one of: {2:s}'.format(
+                self.name, self.event_type, ', '.join(EVENT_TYPES)))
+        self.device = rule_json.get('device', ANY_DEVICE)
+
+        when = rule_json.get('when', {})
+        self.old_predicate = compile_condition(
+            when['old']) if 'old' in when else None
+        self.new_predicate = compile_condition(
+            when['new']) if 'new' in when else None
+
+        self.actions = rule_json.get('actions', [])
+        for action in self.actions:
+            if action.get('type') not in ACTION_TYPES:
+                raise ValueError('{0:s} has unknown action type "{1}", expected one of: {2:s}'.format(
+                    self.name, action.get('type'), ', '.join(ACTION_TYPES)))
+
+    def matches(self, old_value: Any, new_value: Any) -> bool:
+        return (self.old_predicate is None or self.old_predicate(old_value)) \
+            and (self.new_predicate is None or self.new_predicate(new_value))
+
+
+class RuleEngine:
+    """Runs the actions of rules matching each ListenerEvent
+
+    Rules are compiled once into an index keyed by (event type, device), so each event only checks the rules that could
+    match it. Actions run in separate tasks, so that listener callbacks (and pyatv's protocol handling) are never blocked,
+    scheduled by the shared TaskRegistry, which limits how many run at once for each device (see: ./task_registry.py)."""
+    rules: list[Rule]
+
+    def __init__(self, rules_json: list[dict]):
+        self.rules = [Rule(rule_json, idx)
+                      for idx, rule_json in enumerate(rules_json)]
+        self._index: dict[tuple[str, str], list[Rule]] = {}
+        for rule in self.rules:
+            self._index.setdefault(
+                (rule.event_type, rule.device), []).append(rule)
+
+    def get_candidate_rules(self, event: ListenerEvent) -> list[Rule]:
+        """Return the rules for the event's type which apply to the event's device (by MAC address or name) or any device"""
+        candidate_rules = []
+        for device in (event.device_mac, event.device_name, ANY_DEVICE):
+            candidate_rules.extend(self._index.get(
+                (event.event_type, device), ()))
+        return candidate_rules
+
+    def dispatch(self, event: ListenerEvent):
+        """Schedule the actions of every rule matching the event (subscribed to events via subscribe())"""
+        old_value = normalize_value(event.old_value)
+        new_value = normalize_value(event.new_value)
+        task_registry = get_task_registry()
+        for rule in self.get_candidate_rules(event):
+            if rule.matches(old_value, new_value):
+                for action in rule.actions:
+                    task_registry.submit(event.device_mac, action['type'],
+                                         self.run_action, rule, action, event)
+
+    async def run_action(self, rule: Rule, action: dict, event: ListenerEvent):
+        try:
+            if action['type'] == 'webhook':
+                await run_webhook_action(action, event)
+            elif action['type'] == 'publish':
+                run_publish_action(action, event)
+            elif action['type'] == 'macro':
+                await run_macro_action(action, event)
+            elif action['type'] == 'shell':
+                await run_shell_action(action, event)
+            elif action['type'] == 'log':
+                logger.info(format_event_template(action.get(
+                    'message', '{event_type}: {old_value} -> {new_value}'), event))
+        except Exception as ex:
+            logger.error('%s action of %s failed! Details: %r',
+                         action['type'], rule.name, ex)
+
+
+def get_event_fields(event: ListenerEvent) -> dict:
+    return {
+        'event_type': event.event_type,
+        'device_mac': event.device_mac,
+        'device_name': event.device_name,
+        'old_value': normalize_value(event.old_value),
+        'new_value': normalize_value(event.new_value),
+        'timestamp': event.timestamp,
+    }
+
+
+def format_event_template(template: str, event: ListenerEvent) -> str:
+    """Return template with {event_type}, {device_mac}, {device_name}, {old_value}, {new_value}, and {timestamp} filled in"""
+    return template.format(**get_event_fields(event))
+
+
+def get_event_json(event: ListenerEvent) -> dict:
+    """Return the event's fields, with any values that cannot be encoded as JSON converted to strings"""
+    return {key: value if isinstance(value, (str, int, float, type(None))) else str(value)
+            for key, value in get_event_fields(event).items()}
+
+
+async def run_webhook_action(action: dict, event: ListenerEvent):
+    """Publish an IFTTT event (action["ifttt_event"]) or POST the event as JSON to a URL (action["url"])"""
+    if 'ifttt_event' in action:
+        await publish_event_to_ifttt_webhooks(action['ifttt_event'])
+    else:
+        get_webhook_dispatcher().enqueue(action['url'], json=get_event_json(event))
+
+
+def run_publish_action(action: dict, event: ListenerEvent):
+    """Queue the event as JSON for every sink in config.SINKS, or only those named in action["sinks"] (see: ./sinks.py)"""
+    get_sink_fan_out().publish(get_event_json(event), action.get('sinks'))
+
+
+async def run_macro_action(action: dict, event: ListenerEvent):
+    """Run the macro named action["macro"] on the event's device, or on action["device"] (by MAC address or name)"""
+    # Imported here to avoid a circular import, since macros imports rules
+    from macros import start_macro_engine
+
+    await start_macro_engine().run(action['macro'], action.get('device', event.device_mac))
+
+
+async def run_shell_action(action: dict, event: ListenerEvent):
+    """Run action["command"] in a shell, passing event details as ATV_* environment variables instead of formatting them
+    into the command, so that values from the device (like titles) can never be interpreted by the shell"""
+    env = dict(os.environ)
+    for key, value in get_event_fields(event).items():
+        env['ATV_{0:s}'.format(key.upper())] = str(value)
+    process = await asyncio.create_subprocess_shell(action['command'], env=env)
+    return_code = await process.wait()
+    if return_code != 0:
+        logger.warning('Shell action "%s" exited with code %d',
+                       action['command'], return_code)
+
+
+def load_rules(file_name: str = RULES_FILE_NAME) -> list[dict]:
+    """Read and return rules from the rules JSON file, or DEFAULT_RULES if it does not exist"""
+    if not os.path.exists(file_name):
+        return DEFAULT_RULES
+    with open(file_name, 'r') as openfile:
+        return json.load(openfile)
+
+
+_rule_engine: Optional[RuleEngine] = None
+
+
+def start_rule_engine(file_name: str = RULES_FILE_NAME) -> RuleEngine:
+    """Compile rules from the rules JSON file and subscribe the resulting RuleEngine to listener events
+
+    Must be called before adding listeners, so that events for the initial states are not missed"""
+    global _rule_engine
+    if _rule_engine is None:
+        _rule_engine = RuleEngine(load_rules(file_name))
+        subscribe(_rule_engine.dispatch)
+        logger.info('Loaded %d rule%s', len(_rule_engine.rules),
+                    s_if_plural(len(_rule_engine.rules)))
+    return _rule_engine
@@ -0,0 +1,359 @@
+import aiohttp
+import asyncio
+import json
+import time
+from typing import Iterable, Optional
+
+import config
+from log import get_logger
+from metrics import SINK_CIRCUIT_OPENS, SINK_EVENTS, SINK_SEND_SECONDS
+from utils import s_if_plural
+from webhook_dispatcher import IFTTT_WEBHOOKS_BASE_URL
+
+
+# The types of sinks which may be configured in config.SINKS
+SINK_TYPES: tuple = ('ifttt', 'http', 'unix_socket', 'file')
+
+# Circuit breaker states
+CIRCUIT_CLOSED: str = 'closed'  # Events are sent
+CIRCUIT_OPEN: str = 'open'  # Events are dropped without being sent, until open_seconds have passed
+CIRCUIT_HALF_OPEN: str = 'half_open'  # One event is sent as a trial, which closes the circuit if it succeeds
+
+logger = get_logger()
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of a sink, and stops it from being used for a while after too many
+
+    After failures_until_open failures in a row, the circuit opens and allow() returns False for open_seconds. Then the
+    circuit is half open, allowing a single trial: if it succeeds the circuit closes, otherwise it opens again."""
+    failures_until_open: int
+    open_seconds: float
+    state: str = CIRCUIT_CLOSED
+    failure_count: int = 0
+    opened_time: float = 0.0
+
+    def __init__(self, failures_until_open: int = config.SINK_FAILURES_UNTIL_OPEN, open_seconds: float = config.SINK_OPEN_SECONDS):
+        self.failures_until_open = failures_until_open
+        self.open_seconds = open_seconds
+        self._is_trial_pending = False
+
+    @property
+    def is_open(self) -> bool:
+        """Return whether events are being dropped, without starting a trial"""
+        return self.state == CIRCUIT_OPEN and time.monotonic() - self.opened_time < self.open_seconds
+
+    def allow(self) -> bool:
+        """Return whether an event may be sent now"""
+        if self.state == CIRCUIT_OPEN:
+            if time.monotonic() - self.opened_time < self.open_seconds:
+                return False
+            self.state = CIRCUIT_HALF_OPEN
+        if self.state == CIRCUIT_HALF_OPEN:
+            if self._is_trial_pending:
+                return False
+            self._is_trial_pending = True
+        return True
+
+    def record_success(self):
+        self.state = CIRCUIT_CLOSED
+        self.failure_count = 0
+        self._is_trial_pending = False
+
+    def record_failure(self) -> bool:
+        """Count a failed send, and return whether it opened the circuit"""
+        self.failure_count += 1
+        self._is_trial_pending = False
+        if self.state == CIRCUIT_HALF_OPEN or self.failure_count >= self.failures_until_open:
+            self.state = CIRCUIT_OPEN
+            self.opened_time = time.monotonic()
+            return True
+        return False
+
+
+class Sink:
+    """Destination for outbound events, like a webhook or a file
+
+    Each sink has its own bounded queue, worker, timeout, and CircuitBreaker, so that a slow or failing sink never delays
+    the others: its queue fills up and further events for it are dropped, and while its circuit is open, events for it are
+    dropped right away without being sent.
+
+    Subclasses implement send(). NOTE: close() must be awaited when finished"""
+    name: str
+    timeout_seconds: float
+    breaker: CircuitBreaker
+
+    sent_count: int = 0
+    failed_count: int = 0
+    dropped_count: int = 0
+
+    def __init__(self, name: str, queue_size: int = config.SINK_QUEUE_SIZE, timeout_seconds: float = config.SINK_TIMEOUT_SECONDS,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.timeout_seconds = timeout_seconds
+        self.breaker = breaker or CircuitBreaker()
+        self.logger = get_logger(type(self).__name__, name)
+        self._queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        """Start the worker, if not already started (requires a running event loop)"""
+        if self._worker_task:
+            return
+        self._queue = asyncio.Queue(self._queue_size)
+        self._worker_task = asyncio.ensure_future(self._worker())
+
+    def publish(self, payload: dict) -> bool:
+        """Queue the payload to be sent, returning False if it was dropped because the queue is full or the circuit is open"""
+        self.start()
+        if self.breaker.is_open:
+            self._drop('circuit_open')
+            return False
+        try:
+            self._queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            self._drop('queue_full')
+            self.logger.error(
+                'Dropping event because the queue is full (%d pending)!', self._queue.maxsize)
+            return False
+
+    def _drop(self, reason: str):
+        self.dropped_count += 1
+        SINK_EVENTS.inc(self.name, reason)
+
+    async def send(self, payload: dict):
+        """Send the payload, raising an exception if it failed"""
+        raise NotImplementedError
+
+    async def send_with_breaker(self, payload: dict) -> bool:
+        """Send the payload within timeout_seconds unless the circuit is open, and return whether it was sent"""
+        if not self.breaker.allow():
+            self._drop('circuit_open')
+            return False
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.send(payload), self.timeout_seconds)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            self.failed_count += 1
+            SINK_EVENTS.inc(self.name, 'failed')
+            self.logger.error('Failed to send event! Details: %r', ex)
+            if self.breaker.record_failure():
+                SINK_CIRCUIT_OPENS.inc(self.name)
+                self.logger.warning('Circuit opened after %d failure%s, dropping events for %ss',
+                                    self.breaker.failure_count, s_if_plural(self.breaker.failure_count), self.breaker.open_seconds)
+            return False
+        if self.breaker.failure_count:
+            self.logger.info('Recovered after %d failure%s',
+                             self.breaker.failure_count, s_if_plural(self.breaker.failure_count))
+        self.breaker.record_success()
+        self.sent_count += 1
+        SINK_EVENTS.inc(self.name, 'sent')
+        SINK_SEND_SECONDS.observe(time.perf_counter() - start_time, self.name)
+        return True
+
+    async def _worker(self):
+        while True:
+            payload = await self._queue.get()
+            try:
+                await self.send_with_breaker(payload)
+            finally:
+                self._queue.task_done()
+
+    async def close_resources(self):
+        """Release any connections or files held by the sink (called by close())"""
+        pass
+
+    async def close(self, timeout: float = 5):
+        """Wait up to timeout seconds for queued events to be sent, then stop the worker and release resources"""
+        if self._worker_task:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning('Closing with %d event%s still queued!',
+                                    self.queue_depth, s_if_plural(self.queue_depth))
+            self._worker_task.cancel()
+            await asyncio.gather(self._worker_task, return_exceptions=True)
+            self._worker_task = None
+        await self.close_resources()
+
+
+class HttpSink(Sink):
+    """POSTs each event as JSON to url"""
+    url: str
+
+    def __init__(self, name: str, url: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.url = url
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def get_request(self, payload: dict) -> tuple[str, dict]:
+        """Return the URL and JSON body to POST for the payload"""
+        return self.url, payload
+
+    async def send(self, payload: dict):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        url, body = self.get_request(payload)
+        async with self._session.post(url, json=body) as response:
+            response.raise_for_status()
+
+    async def close_resources(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+
+class IftttSink(HttpSink):
+    """Publishes each event to IFTTT Webhooks (see: https://ifttt.com/maker_webhooks), named by formatting event_name with
+    the event's fields (like 'atv_{event_type}'), with the device name, old value, and new value as value1, value2, and value3"""
+    event_name: str
+
+    def __init__(self, name: str, event_name: str = 'atv_{event_type}', **kwargs):
+        super().__init__(name, IFTTT_WEBHOOKS_BASE_URL, **kwargs)
+        self.event_name = event_name
+
+    def get_request(self, payload: dict) -> tuple[str, dict]:
+        url = '{0:s}/trigger/{1:s}/with/key/{2:s}'.format(
+            self.url, self.event_name.format(**payload), config.IFTTT_API_KEY)
+        return url, {'value1': payload.get('device_name'), 'value2': payload.get('old_value'), 'value3': payload.get('new_value')}
+
+
+class UnixSocketSink(Sink):
+    """Writes each event as a JSON line to a Unix domain stream socket at path, reusing the connection between events"""
+    path: str
+
+    def __init__(self, name: str, path: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def send(self, payload: dict):
+        if self._writer is None or self._writer.is_closing():
+            _, self._writer = await asyncio.open_unix_connection(self.path)
+        is_sent = False
+        try:
+            self._writer.write(json.dumps(payload).encode() + b'\n')
+            await self._writer.drain()
+            is_sent = True
+        finally:
+            if not is_sent:
+                # Reconnect on the next event, also after a timeout cancelled drain(), since the rest of a partly
+                #   written line would corrupt the next one
+                self._writer.close()
+                self._writer = None
+
+    async def close_resources(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+class FileSink(Sink):
+    """Appends each event as a JSON line to file_name, writing on a separate thread so that the event loop never blocks"""
+    file_name: str
+
+    def __init__(self, name: str, file_name: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.file_name = file_name
+        self._file = None
+
+    def _write_line(self, line: str):
+        if self._file is None:
+            self._file = open(self.file_name, 'a')
+        self._file.write(line)
+        self._file.flush()
+
+    async def send(self, payload: dict):
+        await asyncio.to_thread(self._write_line, json.dumps(payload) + '\n')
+
+    async def close_resources(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def create_sink(sink_config: dict) -> Sink:
+    """Return a new sink for an entry of config.SINKS, like {'type': 'http', 'name': 'home', 'url': 'http://...'}
+
+    Besides the type's own options, each entry may set queue_size, timeout_seconds, failures_until_open, and open_seconds"""
+    options = dict(sink_config)
+    sink_type = options.pop('type', None)
+    if sink_type not in SINK_TYPES:
+        raise ValueError('Unknown sink type "{0}", expected one of: {1:s}'.format(
+            sink_type, ', '.join(SINK_TYPES)))
+    name = options.pop('name', sink_type)
+    breaker = CircuitBreaker(options.pop('failures_until_open', config.SINK_FAILURES_UNTIL_OPEN),
+                             options.pop('open_seconds', config.SINK_OPEN_SECONDS))
+    if sink_type == 'ifttt':
+        return IftttSink(name, breaker=breaker, **options)
+    if sink_type == 'http':
+        return HttpSink(name, breaker=breaker, **options)
+    if sink_type == 'unix_socket':
+        return UnixSocketSink(name, breaker=breaker, **options)
+    return FileSink(name, breaker=breaker, **options)
+
+
+class SinkFanOut:
+    """Publishes each event to every sink (or only some, by name), each of which sends it independently and concurrently"""
+    sinks: dict[str, Sink]
+
+    def __init__(self, sinks: Iterable[Sink]):
+        self.sinks = {}
+        for sink in sinks:
+            if sink.name in self.sinks:
+                raise ValueError(
+                    'Duplicate sink name "{0:s}", each sink needs a unique name'.format(sink.name))
+            self.sinks[sink.name] = sink
+
+    def publish(self, payload: dict, sink_names: Optional[Iterable[str]] = None) -> int:
+        """Queue the payload for each sink (or only those named), and return how many accepted it"""
+        if sink_names is None:
+            sinks = self.sinks.values()
+        else:
+            sinks = [self.sinks[sink_name]
+                     for sink_name in sink_names if sink_name in self.sinks]
+        return sum(sink.publish(payload) for sink in sinks)
+
+    def get_stats(self) -> dict[str, dict]:
+        """Return queue depth, event counts, and circuit state for each sink"""
+        return {name: {
+            'queue_depth': sink.queue_depth,
+            'sent': sink.sent_count,
+            'failed': sink.failed_count,
+            'dropped': sink.dropped_count,
+            'circuit': sink.breaker.state,
+        } for name, sink in self.sinks.items()}
+
+    async def close(self, timeout: float = 5):
+        await asyncio.gather(*(sink.close(timeout) for sink in self.sinks.values()))
+
+
+_sink_fan_out: Optional[SinkFanOut] = None
+
+
+def get_sink_fan_out() -> SinkFanOut:
+    """Return the shared SinkFanOut with the sinks in config.SINKS, creating it if needed"""
+    global _sink_fan_out
+    if _sink_fan_out is None:
+        _sink_fan_out = SinkFanOut(create_sink(sink_config)
+                                   for sink_config in config.SINKS)
+        if _sink_fan_out.sinks:
+            logger.info('Publishing events to %d sink%s: %s', len(_sink_fan_out.sinks),
+                        s_if_plural(len(_sink_fan_out.sinks)), ', '.join(_sink_fan_out.sinks))
+    return _sink_fan_out
+
+
+async def close_sinks():
+    """Close the shared SinkFanOut, if it was created"""
+    global _sink_fan_out
+    if _sink_fan_out is not None:
+        await _sink_fan_out.close()
+        _sink_fan_out = None
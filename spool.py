@@ -0,0 +1,340 @@
+import json
+import os
+import queue
+import threading
+from typing import Callable, Optional
+
+import config
+from log import get_logger
+from metrics import SPOOL_RECORDS
+from utils import s_if_plural
+
+
+# Segment files are named by the sequence number of their first record, so that sorting them by name orders them
+SEGMENT_FILE_NAME_FORMAT: str = '{0:016d}.seg'
+SEGMENT_FILE_EXTENSION: str = '.seg'
+
+# The extension of the temporary files segments are rewritten to when compacting, before replacing them
+TEMP_FILE_EXTENSION: str = '.tmp'
+
+# The file which acknowledged sequence numbers are appended to, one per line, until the next compaction
+ACKS_FILE_NAME: str = 'acks.log'
+
+# The number of acknowledgements buffered before they are appended to the acks file in one write
+ACK_BATCH_SIZE: int = 32
+
+# The number of acknowledgements after which segments are compacted, rewriting them without acknowledged records
+COMPACT_AFTER_ACKS: int = 1000
+
+logger = get_logger()
+
+
+class Segment:
+    """An append-only file of spooled records, one [sequence number, record] JSON array per line"""
+    __slots__ = ('first_seq', 'file_name', 'size', 'live_count')
+
+    def __init__(self, first_seq: int, file_name: str, size: int = 0, live_count: int = 0):
+        self.first_seq = first_seq
+        self.file_name = file_name
+        self.size = size
+        self.live_count = live_count  # The number of records in the segment not yet acknowledged
+
+
+def encode_record(seq: int, record: dict) -> bytes:
+    return (json.dumps([seq, record], separators=(',', ':'), default=str) + '\n').encode()
+
+
+class Spool:
+    """Durable, append-only store of outbound records (like webhook requests) which have not been delivered yet
+
+    Each record is appended to the newest segment file before delivery, and acknowledged with ack() after it was delivered.
+    Records which were never acknowledged (because delivery kept failing, or the process exited first) are returned by
+    get_unacked() in the order they were appended, including after a restart.
+
+    The index of records is kept in memory by the event loop thread, while the files are written by a background thread
+    (append() and ack() only queue writes), so disk I/O never blocks the event loop. The writer thread syncs the files to
+    disk whenever it runs out of queued writes, so a burst of records is synced once.
+
+    Acknowledgements are buffered and appended to the acks file in batches, so a record may be delivered again after a
+    crash (at least once delivery). Segments are rolled over at segment_max_bytes, deleted once all of their records are
+    acknowledged, and compacted (rewritten without acknowledged records) every COMPACT_AFTER_ACKS acknowledgements. If
+    the segments grow past max_bytes (e.g. during a long outage), the oldest segment is discarded.
+
+    NOTE: close() must be called when finished, to write any buffered acknowledgements and queued writes"""
+    directory: str
+    segment_max_bytes: int
+    max_bytes: int
+
+    def __init__(self, directory: str = config.SPOOL_DIRECTORY, segment_max_bytes: int = config.SPOOL_SEGMENT_MAX_BYTES,
+                 max_bytes: int = config.SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_bytes = max_bytes
+        self._segments: list[Segment] = []
+        # Records not yet acknowledged, by sequence number, in the order they were appended, with their encoded size
+        self._unacked: dict[int, tuple[Segment, dict, int]] = {}
+        self._pending_acks: list[int] = []
+        self._acks_since_compaction = 0
+        self._next_seq = 1
+        # Whether records are appended to the newest segment, rather than a new one
+        self._is_appending = False
+        # Only used by the writer thread
+        self._segment_file = None
+        self._segment_file_name: Optional[str] = None
+        self._acks_file = None
+        self._unsynced_files: set = set()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self._writes = queue.Queue()
+        self._thread = threading.Thread(target=self._write_files, name='SpoolWriter', daemon=True)
+        self._thread.start()
+        self.compact()
+
+    @property
+    def size(self) -> int:
+        """The total size of the segment files, in bytes"""
+        return sum(segment.size for segment in self._segments)
+
+    @property
+    def unacked_count(self) -> int:
+        return len(self._unacked)
+
+    def _get_path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def _load(self):
+        """Read the segments and acks left by a previous run (compacted once the writer thread has started)"""
+        acked_seqs = set()
+        acks_path = self._get_path(ACKS_FILE_NAME)
+        if os.path.exists(acks_path):
+            with open(acks_path, 'r') as acks_file:
+                for line in acks_file:
+                    if line.strip().isdigit():
+                        acked_seqs.add(int(line))
+
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(TEMP_FILE_EXTENSION):
+                # Left by a compaction which was interrupted before replacing its segment, which is still complete
+                logger.warning('Deleting incomplete spool file %s', file_name)
+                os.remove(self._get_path(file_name))
+
+        segment_file_names = sorted(file_name for file_name in os.listdir(self.directory)
+                                    if file_name.endswith(SEGMENT_FILE_EXTENSION))
+        for file_name in segment_file_names:
+            segment = Segment(int(file_name[:-len(SEGMENT_FILE_EXTENSION)]), file_name,
+                              os.path.getsize(self._get_path(file_name)))
+            self._segments.append(segment)
+            with open(self._get_path(file_name), 'rb') as segment_file:
+                for line in segment_file:
+                    try:
+                        seq, record = json.loads(line)
+                    except ValueError:
+                        # A partially written last line, from a crash while appending
+                        logger.warning('Skipping unreadable record in spool segment %s', file_name)
+                        continue
+                    self._next_seq = max(self._next_seq, seq + 1)
+                    if seq not in acked_seqs:
+                        self._unacked[seq] = (segment, record, len(encode_record(seq, record)))
+                        segment.live_count += 1
+
+        if self._unacked:
+            logger.info('Loaded %d undelivered record%s from the spool',
+                        len(self._unacked), s_if_plural(len(self._unacked)))
+
+    def _queue_write(self, write: Callable, *args):
+        """Queue a call of one of the _write_* methods, which the writer thread makes in the order they were queued"""
+        self._writes.put((write, args))
+
+    def _write_files(self):
+        while True:
+            write, args = self._writes.get()
+            if write is None:
+                break
+            try:
+                write(*args)
+            except Exception as ex:
+                logger.error('Failed to write to the spool in %s! Details: %r', self.directory, ex)
+            if self._writes.empty():
+                self._sync_files()
+        self._sync_files()
+        self._close_segment_file()
+        if self._acks_file:
+            self._acks_file.close()
+            self._acks_file = None
+
+    def _sync_files(self):
+        """Flush and sync the files written since they were last synced, so that their records survive a power loss or OS
+        crash too"""
+        for openfile in self._unsynced_files:
+            try:
+                openfile.flush()
+                os.fsync(openfile.fileno())
+            except (OSError, ValueError) as ex:
+                logger.error('Failed to sync spool file %s! Details: %r', openfile.name, ex)
+        self._unsynced_files.clear()
+
+    def _close_segment_file(self):
+        if self._segment_file:
+            if self._segment_file in self._unsynced_files:
+                self._sync_files()
+            self._segment_file.close()
+            self._segment_file = None
+            self._segment_file_name = None
+
+    def _write_open_segment(self, file_name: str):
+        self._close_segment_file()
+        self._segment_file = open(self._get_path(file_name), 'ab')
+        self._segment_file_name = file_name
+
+    def _write_record(self, data: bytes):
+        self._segment_file.write(data)
+        self._unsynced_files.add(self._segment_file)
+
+    def _write_acks(self, data: str):
+        if self._acks_file is None:
+            self._acks_file = open(self._get_path(ACKS_FILE_NAME), 'a')
+        self._acks_file.write(data)
+        self._unsynced_files.add(self._acks_file)
+
+    def _write_delete_segment(self, file_name: str):
+        if file_name == self._segment_file_name:
+            self._close_segment_file()
+        try:
+            os.remove(self._get_path(file_name))
+        except FileNotFoundError:
+            pass
+
+    def _write_compaction(self, deleted_file_names: list[str], rewritten_segments: list[tuple[str, list[tuple[int, dict]]]]):
+        """Delete and rewrite segments (atomically, through a temporary file), then clear the acks file"""
+        self._close_segment_file()
+        for file_name in deleted_file_names:
+            self._write_delete_segment(file_name)
+        for file_name, records in rewritten_segments:
+            temp_path = self._get_path(file_name + TEMP_FILE_EXTENSION)
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(b''.join(encode_record(seq, record) for seq, record in records))
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, self._get_path(file_name))
+
+        # Only cleared once the segments no longer contain the acknowledged records
+        if self._acks_file:
+            self._unsynced_files.discard(self._acks_file)
+            self._acks_file.close()
+            self._acks_file = None
+        open(self._get_path(ACKS_FILE_NAME), 'w').close()
+
+    def _open_segment(self) -> Segment:
+        """Start a new segment for the records appended from now on"""
+        segment = Segment(self._next_seq, SEGMENT_FILE_NAME_FORMAT.format(self._next_seq))
+        self._segments.append(segment)
+        self._is_appending = True
+        self._queue_write(self._write_open_segment, segment.file_name)
+        return segment
+
+    def append(self, record: dict) -> int:
+        """Queue the record to be written to the newest segment, and return its sequence number to pass to ack() once
+        delivered"""
+        segment = self._segments[-1] if self._is_appending else self._open_segment()
+        if segment.size >= self.segment_max_bytes:
+            segment = self._open_segment()
+            self._discard_oldest_segments()
+
+        seq = self._next_seq
+        self._next_seq += 1
+        data = encode_record(seq, record)
+        self._queue_write(self._write_record, data)
+        segment.size += len(data)
+        segment.live_count += 1
+        self._unacked[seq] = (segment, record, len(data))
+        SPOOL_RECORDS.inc('appended')
+        return seq
+
+    def ack(self, seq: int):
+        """Mark the record as delivered, so that it is not returned by get_unacked() (even after a restart)"""
+        entry = self._unacked.pop(seq, None)
+        if entry is None:
+            return
+        entry[0].live_count -= 1
+        SPOOL_RECORDS.inc('acked')
+        self._pending_acks.append(seq)
+        if len(self._pending_acks) >= ACK_BATCH_SIZE:
+            self.flush_acks()
+
+    def flush_acks(self):
+        """Queue any buffered acknowledgements to be appended to the acks file, then delete or compact segments as needed"""
+        if not self._pending_acks:
+            return
+        self._queue_write(self._write_acks, ''.join('{0:d}\n'.format(seq) for seq in self._pending_acks))
+        self._acks_since_compaction += len(self._pending_acks)
+        self._pending_acks = []
+
+        if self._acks_since_compaction >= COMPACT_AFTER_ACKS:
+            self.compact()
+        else:
+            self._delete_acked_segments()
+
+    def get_unacked(self) -> list[tuple[int, dict]]:
+        """Return (sequence number, record) for every record not yet acknowledged, oldest first"""
+        return [(seq, record) for seq, (_, record, _) in self._unacked.items()]
+
+    def _delete_segment(self, segment: Segment):
+        if segment is self._segments[-1]:
+            self._is_appending = False
+        self._segments.remove(segment)
+        self._queue_write(self._write_delete_segment, segment.file_name)
+
+    def _delete_acked_segments(self):
+        """Delete the files of older segments whose records were all acknowledged"""
+        for segment in self._segments[:-1]:
+            if segment.live_count == 0:
+                self._delete_segment(segment)
+
+    def _discard_oldest_segments(self):
+        """Discard the oldest segments, with any records not yet delivered, while the spool is larger than max_bytes"""
+        while len(self._segments) > 1 and self.size > self.max_bytes:
+            segment = self._segments[0]
+            discarded_seqs = [seq for seq, entry in self._unacked.items() if entry[0] is segment]
+            for seq in discarded_seqs:
+                del self._unacked[seq]
+            SPOOL_RECORDS.inc('discarded', amount=len(discarded_seqs))
+            logger.error('Spool is over %d bytes, discarding %d undelivered record%s!',
+                         self.max_bytes, len(discarded_seqs), s_if_plural(len(discarded_seqs)))
+            self._delete_segment(segment)
+
+    def compact(self):
+        """Queue every segment to be rewritten without its acknowledged records (deleting those left empty), then the acks
+        file to be cleared
+
+        Records keep their order, since each segment is rewritten in place. A new segment is started for later records."""
+        self._is_appending = False
+        segment_records: dict[int, list[tuple[int, dict]]] = {}
+        segment_sizes: dict[int, int] = {}
+        for seq, (segment, record, size) in self._unacked.items():
+            segment_records.setdefault(id(segment), []).append((seq, record))
+            segment_sizes[id(segment)] = segment_sizes.get(id(segment), 0) + size
+        deleted_file_names = []
+        rewritten_segments = []
+        for segment in list(self._segments):
+            records = segment_records.get(id(segment))
+            if not records:
+                self._segments.remove(segment)
+                deleted_file_names.append(segment.file_name)
+            elif segment_sizes[id(segment)] != segment.size:
+                rewritten_segments.append((segment.file_name, records))
+                segment.size = segment_sizes[id(segment)]
+        self._queue_write(self._write_compaction, deleted_file_names, rewritten_segments)
+        self._acks_since_compaction = 0
+
+    def close(self, timeout: float = 10):
+        """Write any buffered acknowledgements and compact the segments, waiting up to timeout seconds for the writer thread
+        to finish"""
+        if not self._thread.is_alive():
+            return
+        self.flush_acks()
+        self.compact()
+        self._writes.put((None, ()))
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning('Closing spool with %d writes still queued!', self._writes.qsize())
@@ -0,0 +1,260 @@
+from aiohttp import WSCloseCode, WSMsgType, web
+import asyncio
+from enum import Enum
+import time
+from typing import Any, Optional
+import weakref
+
+from artwork_cache import get_artwork_cache
+import config
+from events import (EVENT_ADDRESS_CHANGED, EVENT_ARTWORK, EVENT_CONNECTED, EVENT_CONNECTION_CLOSED, EVENT_CONNECTION_HEALTH,
+                    EVENT_CONNECTION_LOST, EVENT_DEVICE_APPEARED, EVENT_DEVICE_GONE, EVENT_DEVICE_STATE, EVENT_FOCUS,
+                    EVENT_OUTPUT_DEVICES, EVENT_PLAYSTATUS, EVENT_POWER, EVENT_TITLE, EVENT_VOLUME, EVENT_VOLUME_UPDATE,
+                    ListenerEvent, subscribe, unsubscribe)
+from log import get_logger
+from metrics import Gauge, STATE_SERVER_CLIENTS_DROPPED
+
+
+# The snapshot field set by each event type (events of other types are only streamed)
+EVENT_SNAPSHOT_FIELDS: dict[str, str] = {
+    EVENT_POWER: 'power',
+    EVENT_VOLUME: 'volume',
+    EVENT_VOLUME_UPDATE: 'volume',
+    EVENT_OUTPUT_DEVICES: 'output_devices',
+    EVENT_DEVICE_STATE: 'device_state',
+    EVENT_TITLE: 'title',
+    EVENT_FOCUS: 'focus',
+    EVENT_ARTWORK: 'artwork',
+    EVENT_CONNECTION_HEALTH: 'health',
+    EVENT_DEVICE_APPEARED: 'address',
+    EVENT_ADDRESS_CHANGED: 'address',
+    EVENT_DEVICE_GONE: 'address',
+}
+
+logger = get_logger()
+
+
+def to_json_value(value: Any) -> Any:
+    """Return the value with pyatv enum values as their names, output devices as dicts, and anything else that cannot be
+    encoded as JSON as a str"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, dict):
+        return {str(key): to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    if hasattr(value, 'identifier') and hasattr(value, 'name'):
+        return {'name': value.name, 'identifier': value.identifier}
+    return str(value)
+
+
+def create_snapshot(device_mac: str, device_name: str) -> dict:
+    return {
+        'device_mac': device_mac,
+        'device_name': device_name,
+        'connected': False,
+        'address': None,
+        'health': None,
+        'power': None,
+        'volume': None,
+        'output_devices': None,
+        'device_state': None,
+        'title': None,
+        'focus': None,
+        'artwork': None,
+        'playstatus': {},
+        'updated_at': None,
+    }
+
+
+class DeviceStateStore:
+    """In-memory snapshot of each device's state, kept up to date from listener events, with a stream of changes
+
+    Snapshots are dicts of JSON values keyed by device MAC address, so reading them never touches the devices. Each
+    stream client has its own bounded queue of messages; a client which falls behind is disconnected (and may reconnect
+    for a fresh snapshot) rather than holding up the others or growing memory."""
+    snapshots: dict[str, dict]
+
+    def __init__(self, client_queue_size: int = config.STATE_SERVER_CLIENT_QUEUE_SIZE):
+        self.snapshots = {}
+        self.client_queue_size = client_queue_size
+        self._client_queues: set[asyncio.Queue] = set()
+
+    @property
+    def client_count(self) -> int:
+        return len(self._client_queues)
+
+    def get_snapshot(self, device: str) -> Optional[dict]:
+        """Return the snapshot of the device with the provided MAC address or name, or None if unknown"""
+        snapshot = self.snapshots.get(device.upper())
+        if snapshot is None:
+            snapshot = next((snapshot for snapshot in self.snapshots.values()
+                             if snapshot['device_name'] == device), None)
+        return snapshot
+
+    def update(self, event: ListenerEvent):
+        """Apply the event to its device's snapshot and queue it for every stream client (subscribed to events via subscribe())"""
+        snapshot = self.snapshots.get(event.device_mac)
+        if snapshot is None:
+            snapshot = self.snapshots[event.device_mac] = create_snapshot(
+                event.device_mac, event.device_name)
+        new_value = to_json_value(event.new_value)
+
+        if event.event_type in EVENT_SNAPSHOT_FIELDS:
+            snapshot[EVENT_SNAPSHOT_FIELDS[event.event_type]] = new_value
+        elif event.event_type == EVENT_PLAYSTATUS:
+            snapshot['playstatus'].update(new_value)
+        elif event.event_type == EVENT_CONNECTED:
+            snapshot['connected'] = True
+        elif event.event_type in (EVENT_CONNECTION_LOST, EVENT_CONNECTION_CLOSED):
+            snapshot['connected'] = False
+        snapshot['updated_at'] = event.timestamp
+
+        if not self._client_queues:
+            return
+        message = {
+            'type': 'event',
+            'event_type': event.event_type,
+            'device_mac': event.device_mac,
+            'device_name': event.device_name,
+            'old_value': to_json_value(event.old_value),
+            'new_value': new_value,
+            'timestamp': event.timestamp,
+        }
+        for client_queue in list(self._client_queues):
+            try:
+                client_queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Make room for a None after the queued messages, which disconnects the client once it is reached
+                self._client_queues.discard(client_queue)
+                STATE_SERVER_CLIENTS_DROPPED.inc()
+                client_queue.get_nowait()
+                client_queue.put_nowait(None)
+
+    def add_client(self) -> asyncio.Queue:
+        """Return a new queue of messages for a stream client, starting with a snapshot of every device"""
+        client_queue = asyncio.Queue(self.client_queue_size + 1)
+        # Copied, since the snapshots keep changing while the message waits to be sent
+        client_queue.put_nowait({'type': 'snapshot', 'devices': [dict(snapshot, playstatus=dict(snapshot['playstatus']))
+                                                                 for snapshot in self.snapshots.values()],
+                                 'timestamp': time.time()})
+        self._client_queues.add(client_queue)
+        return client_queue
+
+    def remove_client(self, client_queue: asyncio.Queue):
+        self._client_queues.discard(client_queue)
+
+
+async def handle_devices_request(request: web.Request) -> web.Response:
+    store: DeviceStateStore = request.app['store']
+    return web.json_response({'devices': list(store.snapshots.values())})
+
+
+async def handle_device_request(request: web.Request) -> web.Response:
+    store: DeviceStateStore = request.app['store']
+    snapshot = store.get_snapshot(request.match_info['device'])
+    if snapshot is None:
+        return web.json_response({'error': 'Unknown device'}, status=404)
+    return web.json_response(snapshot)
+
+
+async def handle_artwork_request(request: web.Request) -> web.Response:
+    """Return the artwork of what is playing on the device from the artwork cache, never requesting it from the device"""
+    store: DeviceStateStore = request.app['store']
+    snapshot = store.get_snapshot(request.match_info['device'])
+    if snapshot is None:
+        return web.json_response({'error': 'Unknown device'}, status=404)
+    artwork = get_artwork_cache().peek(snapshot['artwork']['key']) if snapshot['artwork'] else None
+    if artwork is None:
+        return web.json_response({'error': 'No artwork'}, status=404)
+    return web.Response(body=artwork.bytes, content_type=artwork.mimetype)
+
+
+async def handle_stream_request(request: web.Request) -> web.WebSocketResponse:
+    """Send a snapshot of every device, then each event as it happens, as JSON messages over a WebSocket"""
+    store: DeviceStateStore = request.app['store']
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    request.app['websockets'].add(ws)
+    client_queue = store.add_client()
+
+    async def send_messages():
+        while True:
+            message = await client_queue.get()
+            if message is None:
+                logger.warning('Disconnecting stream client %s, which fell behind by %d messages',
+                               request.remote, store.client_queue_size)
+                await ws.close()
+                return
+            await ws.send_json(message)
+
+    send_task = asyncio.ensure_future(send_messages())
+    try:
+        # Messages from clients are ignored, this only waits for the client to disconnect
+        async for message in ws:
+            if message.type == WSMsgType.ERROR:
+                break
+    finally:
+        store.remove_client(client_queue)
+        send_task.cancel()
+        await asyncio.gather(send_task, return_exceptions=True)
+    return ws
+
+
+async def close_websockets(app: web.Application):
+    """Close stream clients when shutting down, rather than waiting for them to disconnect"""
+    for ws in list(app['websockets']):
+        await ws.close(code=WSCloseCode.GOING_AWAY, message=b'Server shutdown')
+
+
+_store: Optional[DeviceStateStore] = None
+_runner: Optional[web.AppRunner] = None
+
+STATE_SERVER_CLIENTS = Gauge('atv_state_server_clients', 'Connected state stream clients',
+                             lambda: _store.client_count if _store else 0)
+
+
+def get_device_state_store() -> DeviceStateStore:
+    """Return the shared DeviceStateStore, creating it and subscribing it to listener events if needed"""
+    global _store
+    if _store is None:
+        _store = DeviceStateStore()
+        subscribe(_store.update)
+    return _store
+
+
+async def start_state_server(port: Optional[int] = None, host: Optional[str] = None):
+    """Serve device state at http://host:port/devices and stream changes at ws://host:port/stream, unless port is 0 (disabled)
+
+    Arguments default to config.STATE_SERVER_PORT and config.STATE_SERVER_HOST. Must be called before adding listeners, so
+    that events for the initial states are not missed"""
+    global _runner
+    port = config.STATE_SERVER_PORT if port is None else port
+    host = host or config.STATE_SERVER_HOST
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app['store'] = get_device_state_store()
+    app['websockets'] = weakref.WeakSet()
+    app.on_shutdown.append(close_websockets)
+    app.router.add_get('/devices', handle_devices_request)
+    app.router.add_get('/devices/{device}', handle_device_request)
+    app.router.add_get('/devices/{device}/artwork', handle_artwork_request)
+    app.router.add_get('/stream', handle_stream_request)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logger.info('Serving device state at http://%s:%d/devices', host, port)
+
+
+async def stop_state_server():
+    """Stop serving device state, if started, closing any stream clients"""
+    global _runner, _store
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+    if _store is not None:
+        unsubscribe(_store.update)
+        _store = None
@@ -0,0 +1,143 @@
+import asyncio
+from pyatv import interface
+import time
+from typing import Iterable, Optional
+
+import config
+# Imported before other modules of this project, so that settings missing from config.py (and those in config.json) apply
+#   to their defaults too
+from config_file import start_config_watcher, stop_config_watcher
+from device_session import DeviceSession, get_device_session
+from event_store import close_event_store, start_event_store
+from rules import start_rule_engine
+from sinks import close_sinks, get_sink_fan_out
+from presence import start_presence_tracker, stop_presence_tracker
+from state_server import start_state_server, stop_state_server
+from task_registry import drain_task_registry, get_task_registry
+from log import get_logger
+from macros import start_macro_engine
+from metrics import start_metrics_server, stop_metrics_server
+from utils import StartupProfile, get_apple_tvs, get_device_summary_str, get_paired_mac_adrs, s_if_plural, wait_for_exit_request
+from webhook_dispatcher import close_webhook_dispatcher, start_webhook_dispatcher
+
+
+logger = get_logger()
+
+
+async def start_paired_apple_tvs(device_macs: Optional[Iterable[str]] = None, listener_names: Iterable[str] = config.LISTENERS,
+                                 startup_profile: Optional[StartupProfile] = None) -> list[DeviceSession]:
+    """Scan for Apple TVs on network, then concurrently connect to and add listeners for every paired one
+    (or only those with the provided device_macs).
+
+    Returns a DeviceSession for every paired Apple TV found, whether or not its connection succeeded.
+    A slow or failing connection does not hold up the others, since each device is started independently,
+    and failed connections keep being retried in the background.
+
+    NOTE: close() must be called on each DeviceSession when finished"""
+    start_time = time.perf_counter()
+    paired_mac_adrs = get_paired_mac_adrs()
+    if device_macs:
+        device_macs = list(device_macs)
+        for mac_adr in device_macs:
+            if mac_adr not in paired_mac_adrs:
+                logger.error(
+                    'Apple TV %s has not been paired! Run pair_apple_tvs.py first.', mac_adr)
+        paired_mac_adrs = [
+            mac_adr for mac_adr in paired_mac_adrs if mac_adr in device_macs]
+    if not paired_mac_adrs:
+        logger.error(
+            'No paired Apple TVs were found in credentials! Run pair_apple_tvs.py first.')
+        return []
+
+    apple_tvs = await get_apple_tvs(paired_mac_adrs, exit_if_none=not config.PRESENCE_ENABLED)
+    paired_apple_tvs = [
+        apple_tv for apple_tv in apple_tvs if apple_tv.device_info.mac in paired_mac_adrs]
+
+    found_mac_adrs = [apple_tv.device_info.mac for apple_tv in paired_apple_tvs]
+    for mac_adr in paired_mac_adrs:
+        if mac_adr not in found_mac_adrs:
+            logger.warning(
+                'Paired Apple TV %s was not found on network!', mac_adr)
+
+    if startup_profile:
+        startup_profile.mark('scan')
+
+    device_sessions = [DeviceSession(apple_tv, listener_names=listener_names)
+                       for apple_tv in paired_apple_tvs]
+    logger.info('Starting %d paired Apple TV%s...', len(
+        device_sessions), s_if_plural(len(device_sessions)))
+    results = await asyncio.gather(*[device_session.start() for device_session in device_sessions])
+    logger.info('Connected to %d of %d paired Apple TV%s in %.2fs since startup', results.count(True), len(
+        device_sessions), s_if_plural(len(device_sessions)), time.perf_counter() - start_time)
+    if startup_profile:
+        startup_profile.mark('connect')
+
+    return device_sessions
+
+
+async def supervise_paired_apple_tvs(device_macs: Optional[Iterable[str]] = None, listener_names: Iterable[str] = config.LISTENERS,
+                                     startup_profile: Optional[StartupProfile] = None):
+    """Connect to every paired Apple TV (or only those with the provided device_macs) on one event loop, and exit on keyboard
+    interrupt or SIGTERM, without any interactive prompts (except typing "exit" on Windows).
+
+    With config.PRESENCE_ENABLED, also connect to paired Apple TVs which appear on network after startup."""
+    exit_code = 0
+    device_sessions = []
+    device_macs = list(device_macs) if device_macs else None
+
+    def connect_appeared_apple_tv(apple_tv: interface.BaseConfig):
+        """Connect to an Apple TV found by a presence rescan, if it is paired (and wanted) but not yet connected"""
+        device_mac = apple_tv.device_info.mac
+        if get_device_session(device_mac) is not None or device_mac not in get_paired_mac_adrs() or \
+                (device_macs and device_mac not in device_macs):
+            return
+        logger.info('Paired Apple TV %s appeared on network, connecting...', get_device_summary_str(apple_tv))
+        device_session = DeviceSession(apple_tv, listener_names=listener_names)
+        device_sessions.append(device_session)
+        get_task_registry().submit(device_mac, 'connect', device_session.start)
+
+    try:
+        start_config_watcher()
+        start_event_store()
+        start_macro_engine()
+        start_rule_engine()
+        get_sink_fan_out()
+        start_webhook_dispatcher()
+        await start_metrics_server()
+        await start_state_server()
+        if startup_profile:
+            startup_profile.mark('start services')
+        device_sessions = await start_paired_apple_tvs(device_macs, listener_names, startup_profile)
+        if not device_sessions and not config.PRESENCE_ENABLED:
+            raise RuntimeError('Could not find any paired Apple TVs')
+        start_presence_tracker(connect_appeared_apple_tv)
+        if startup_profile:
+            startup_profile.log()
+
+        await wait_for_exit_request()
+
+        print()
+    except KeyboardInterrupt:
+        exit_code = 130
+    except Exception as ex:
+        exit_code = 1
+        logger.error(
+            'An exception was thrown in supervisor.py! Details:\n%s', ex)
+    finally:
+        logger.info('Closing connections and exiting...')
+        stop_presence_tracker()
+        # Let running rule actions finish while still connected, before closing connections
+        await drain_task_registry()
+        for device_session in device_sessions:
+            device_session.close()
+        await close_webhook_dispatcher()
+        await close_sinks()
+        close_event_store()
+        await stop_metrics_server()
+        await stop_state_server()
+        stop_config_watcher()
+        exit(exit_code)
+
+
+if __name__ == '__main__':
+    asyncio.run(supervise_paired_apple_tvs())
@@ -0,0 +1,189 @@
+import asyncio
+from collections import deque
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import config
+from config_file import on_config_reload
+from log import get_logger
+from metrics import Gauge, TASK_SECONDS, TASKS
+from utils import s_if_plural
+
+
+logger = get_logger()
+
+
+class TaskEntry:
+    """A scheduled side effect: the coroutine function to call, with its arguments, once a slot for its key is free"""
+    __slots__ = ('key', 'name', 'coroutine_function', 'args')
+
+    def __init__(self, key: str, name: str, coroutine_function: Callable[..., Awaitable[Any]], args: tuple):
+        self.key = key
+        self.name = name
+        self.coroutine_function = coroutine_function
+        self.args = args
+
+
+class TaskRegistry:
+    """Runs side effects (like rule actions) as background tasks, limiting how many run at once for each key (device)
+
+    Unlike bare asyncio.ensure_future(), every task is referenced until it finishes, so it cannot be garbage collected
+    mid-flight, and its duration and any exception are recorded. Once max_concurrent_per_key tasks are running for a key,
+    further tasks wait in a backlog of up to max_backlog_per_key, after which they are dropped, so a device flooding
+    events cannot start unbounded work. drain() waits for every task to finish, e.g. before exiting."""
+    max_concurrent_per_key: int
+    max_backlog_per_key: int
+
+    succeeded_count: int = 0
+    failed_count: int = 0
+    dropped_count: int = 0
+
+    def __init__(self, max_concurrent_per_key: int = config.TASK_MAX_CONCURRENT_PER_DEVICE,
+                 max_backlog_per_key: int = config.TASK_MAX_BACKLOG_PER_DEVICE):
+        self.max_concurrent_per_key = max_concurrent_per_key
+        self.max_backlog_per_key = max_backlog_per_key
+        self._tasks: dict[asyncio.Task, tuple[TaskEntry, float]] = {}
+        self._running_counts: dict[str, int] = {}
+        self._backlogs: dict[str, deque] = {}
+        self._is_draining = False
+        self._idle_event: Optional[asyncio.Event] = None
+
+    @property
+    def running_count(self) -> int:
+        return len(self._tasks)
+
+    @property
+    def backlog_count(self) -> int:
+        return sum(len(backlog) for backlog in self._backlogs.values())
+
+    def submit(self, key: str, name: str, coroutine_function: Callable[..., Awaitable[Any]], *args) -> bool:
+        """Run coroutine_function(*args) as a task named name, now or once a slot for key is free, and return False if it
+        was dropped because the backlog for key is full, or the registry is draining
+
+        A coroutine function is passed rather than a coroutine, so that nothing is created for tasks which are dropped"""
+        entry = TaskEntry(key, name, coroutine_function, args)
+        if self._is_draining:
+            self._drop(entry, 'draining')
+            return False
+        if self._running_counts.get(key, 0) < self.max_concurrent_per_key:
+            self._start(entry)
+            return True
+        backlog = self._backlogs.setdefault(key, deque())
+        if len(backlog) >= self.max_backlog_per_key:
+            self._drop(entry, 'backlog full')
+            return False
+        backlog.append(entry)
+        return True
+
+    def _drop(self, entry: TaskEntry, reason: str):
+        self.dropped_count += 1
+        TASKS.inc(entry.name, 'dropped')
+        if reason == 'draining':
+            logger.warning('Dropping %s task for %s because the task registry is draining',
+                           entry.name, entry.key)
+        else:
+            logger.error('Dropping %s task for %s because the backlog is full (%d waiting)!',
+                         entry.name, entry.key, self.max_backlog_per_key)
+
+    def _start(self, entry: TaskEntry):
+        self._running_counts[entry.key] = self._running_counts.get(entry.key, 0) + 1
+        task = asyncio.ensure_future(entry.coroutine_function(*entry.args))
+        self._tasks[task] = (entry, time.perf_counter())
+        task.add_done_callback(self._handle_task_done)
+        if self._idle_event is not None:
+            self._idle_event.clear()
+
+    def _handle_task_done(self, task: asyncio.Task):
+        entry, start_time = self._tasks.pop(task)
+        TASK_SECONDS.observe(time.perf_counter() - start_time, entry.name)
+        if task.cancelled():
+            TASKS.inc(entry.name, 'cancelled')
+        elif task.exception() is not None:
+            self.failed_count += 1
+            TASKS.inc(entry.name, 'failed')
+            logger.error('%s task for %s failed! Details: %r',
+                         entry.name, entry.key, task.exception())
+        else:
+            self.succeeded_count += 1
+            TASKS.inc(entry.name, 'succeeded')
+
+        self._running_counts[entry.key] -= 1
+        backlog = self._backlogs.get(entry.key)
+        if backlog:
+            self._start(backlog.popleft())
+        else:
+            if not self._running_counts[entry.key]:
+                del self._running_counts[entry.key]
+            self._backlogs.pop(entry.key, None)
+        if not self._tasks and self._idle_event is not None:
+            self._idle_event.set()
+
+    def get_stats(self) -> dict:
+        """Return the number of running and backlogged tasks (in total and per key), and of finished and dropped tasks"""
+        return {
+            'running': self.running_count,
+            'backlog': self.backlog_count,
+            'running_per_key': dict(self._running_counts),
+            'backlog_per_key': {key: len(backlog) for key, backlog in self._backlogs.items() if backlog},
+            'succeeded': self.succeeded_count,
+            'failed': self.failed_count,
+            'dropped': self.dropped_count,
+        }
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Stop accepting tasks, wait up to timeout seconds (config.SHUTDOWN_DRAIN_TIMEOUT_SECONDS by default) for running
+        and backlogged tasks to finish, then cancel any left, and return whether every task finished in time"""
+        timeout = config.SHUTDOWN_DRAIN_TIMEOUT_SECONDS if timeout is None else timeout
+        self._is_draining = True
+        if not self._tasks:
+            return True
+        logger.info('Waiting up to %ss for %d running and %d backlogged task%s to finish...', timeout,
+                    self.running_count, self.backlog_count, s_if_plural(self.running_count + self.backlog_count))
+        self._idle_event = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._idle_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            left_count = self.running_count + self.backlog_count
+            logger.warning('Cancelling %d task%s which did not finish in time!',
+                           left_count, s_if_plural(left_count))
+            for backlog in self._backlogs.values():
+                for entry in backlog:
+                    TASKS.inc(entry.name, 'cancelled')
+                backlog.clear()
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return False
+
+
+_task_registry: Optional[TaskRegistry] = None
+
+TASK_BACKLOG = Gauge('atv_task_backlog', 'Background tasks waiting for a free slot for their device',
+                     lambda: _task_registry.backlog_count if _task_registry else 0)
+TASKS_RUNNING = Gauge('atv_tasks_running', 'Background tasks running',
+                      lambda: _task_registry.running_count if _task_registry else 0)
+
+
+def get_task_registry() -> TaskRegistry:
+    """Return the shared TaskRegistry, creating it if needed"""
+    global _task_registry
+    if _task_registry is None:
+        _task_registry = TaskRegistry()
+    return _task_registry
+
+
+def apply_config_to_task_registry(changed_names: set[str]):
+    """Apply reloaded settings to the shared TaskRegistry, if it was created"""
+    if _task_registry is not None:
+        _task_registry.max_concurrent_per_key = config.TASK_MAX_CONCURRENT_PER_DEVICE
+        _task_registry.max_backlog_per_key = config.TASK_MAX_BACKLOG_PER_DEVICE
+
+
+on_config_reload(apply_config_to_task_registry)
+
+
+async def drain_task_registry(timeout: Optional[float] = None):
+    """Drain the shared TaskRegistry (see: TaskRegistry.drain()), which then drops any tasks submitted while exiting"""
+    await get_task_registry().drain(timeout)
@@ -0,0 +1,25 @@
+"""Shared setup for the tests. Run from the root path: python -m pytest"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+# Run in an empty directory, so that the config.json, credentials, and other files of an install are never read or written
+TEST_PATH = tempfile.mkdtemp(prefix='appletv-automate-tests-')
+atexit.register(shutil.rmtree, TEST_PATH, True)
+os.chdir(TEST_PATH)
+
+# Stands in for a config.py copied from the first config-sample.py, which only had these settings, so the tests use the
+#   defaults in config-sample.py for every other setting, filled in by config_file like after upgrading
+config = types.ModuleType('config')
+config.SCAN_TIMEOUT_SECONDS = 5
+config.POWER_OFF_STABLE_AFTER_SECONDS = 20
+config.IFTTT_API_KEY = ''
+sys.modules['config'] = config
+
+import config_file
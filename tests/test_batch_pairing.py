@@ -0,0 +1,78 @@
+import asyncio
+from ipaddress import IPv4Address
+
+from pyatv import conf, const, interface
+
+import batch_pairing
+from batch_pairing import CallbackPinProvider, pair_devices
+from benchmarks.fake_apple_tv import FakePairingHandler, get_fake_pair_function
+
+
+PIN_TIMEOUT_SECONDS: float = 0.05
+
+
+def get_apple_tv_config(name: str, device_mac: str) -> conf.AppleTV:
+    apple_tv = conf.AppleTV(IPv4Address('10.0.0.2'), name,
+                            device_info=interface.DeviceInfo({interface.DeviceInfo.MAC: device_mac}))
+    apple_tv.add_service(conf.ManualService(None, const.Protocol.AirPlay, 7000, {}))
+    apple_tv.add_service(conf.ManualService(None, const.Protocol.Companion, 49153, {}))
+    return apple_tv
+
+
+def get_recording_pair_function(pairings: list[FakePairingHandler], **kwargs):
+    """Return a fake pair function (see: get_fake_pair_function()) which adds each FakePairingHandler to pairings"""
+    fake_pair = get_fake_pair_function(**kwargs)
+
+    async def pair(*args, **pair_kwargs) -> FakePairingHandler:
+        pairing = await fake_pair(*args, **pair_kwargs)
+        pairings.append(pairing)
+        return pairing
+    return pair
+
+
+def test_pin_provider_timeout_fails_only_that_device():
+    """The PIN provider never answers for the bedroom Apple TV, which should not keep the living room one from pairing"""
+    async def get_pin(apple_tv: interface.BaseConfig, protocol_str: str) -> str:
+        if apple_tv.name == 'Bedroom':
+            await asyncio.Event().wait()
+        return '1234'
+
+    pairings = []
+    apple_tvs = [get_apple_tv_config('Living Room', 'AA:BB:CC:DD:EE:01'), get_apple_tv_config('Bedroom', 'AA:BB:CC:DD:EE:02')]
+    living_room_result, bedroom_result = asyncio.run(pair_devices(
+        apple_tvs, CallbackPinProvider(get_pin), get_recording_pair_function(pairings, expected_pin='1234'),
+        PIN_TIMEOUT_SECONDS, save=False))
+
+    assert living_room_result.has_paired
+    assert living_room_result.get_credentials() == {'AirPlay': 'fake-credentials-1234',
+                                                    'Companion': 'fake-credentials-1234'}
+    assert not bedroom_result.has_paired
+    assert [protocol_result.error for protocol_result in bedroom_result.protocol_results] == [
+        'Timed out after {0}s waiting for a PIN'.format(PIN_TIMEOUT_SECONDS)] * 2
+    assert len(pairings) == 4
+    assert all(pairing.is_closed for pairing in pairings)
+
+
+def test_pin_shown_but_never_entered_times_out(monkeypatch):
+    monkeypatch.setattr(batch_pairing, 'PIN_POLL_INTERVAL_SECONDS', 0.01)
+    shown_pins = []
+
+    async def get_pin(apple_tv: interface.BaseConfig, protocol_str: str) -> str:
+        raise AssertionError('The device shows no PIN, so none should be requested')
+
+    async def show_pin(apple_tv: interface.BaseConfig, protocol_str: str, pin: str):
+        shown_pins.append(pin)
+
+    pairings = []
+    # The device only accepts a PIN which is never generated, as if it was never entered on it
+    results = asyncio.run(pair_devices(
+        [get_apple_tv_config('Living Room', 'AA:BB:CC:DD:EE:01')], CallbackPinProvider(get_pin, show_pin),
+        get_recording_pair_function(pairings, device_provides_pin=False, expected_pin='none'),
+        PIN_TIMEOUT_SECONDS, save=False))
+
+    assert not results[0].has_paired
+    assert len(shown_pins) == 2
+    for protocol_result in results[0].protocol_results:
+        assert protocol_result.error == 'Pairing did not complete'
+        assert protocol_result.pin_wait_seconds >= PIN_TIMEOUT_SECONDS
+    assert all(pairing.is_closed for pairing in pairings)
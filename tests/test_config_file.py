@@ -0,0 +1,41 @@
+import json
+import os
+
+import config
+import config_file
+from config_file import fill_in_default_settings, load_config_file
+
+
+def test_settings_missing_from_config_py_use_defaults():
+    """The tests' config.py only has the settings of the first config-sample.py (see: conftest.py)"""
+    assert fill_in_default_settings() == set()
+    sample_globals = {}
+    with open(config_file.CONFIG_SAMPLE_PATH, 'r') as openfile:
+        exec(openfile.read(), sample_globals)
+    for name, value in sample_globals.items():
+        if name.isupper():
+            assert getattr(config, name) == value
+
+
+def test_config_json_overrides_settings_until_removed(tmp_path):
+    file_name = os.path.join(tmp_path, 'config.json')
+    default_value = config.POWER_OFF_STABLE_AFTER_SECONDS
+    changes = []
+    config_file.on_config_reload(changes.append)
+    try:
+        with open(file_name, 'w') as openfile:
+            json.dump({'POWER_OFF_STABLE_AFTER_SECONDS': 45}, openfile)
+        assert load_config_file(file_name)
+        assert config.POWER_OFF_STABLE_AFTER_SECONDS == 45
+
+        with open(file_name, 'w') as openfile:
+            json.dump({'POWER_OFF_STABLE_AFTER_SECONDS': 'soon', 'NOT_A_SETTING': 1}, openfile)
+        assert not load_config_file(file_name)
+        assert config.POWER_OFF_STABLE_AFTER_SECONDS == 45
+
+        os.remove(file_name)
+        assert load_config_file(file_name)
+        assert config.POWER_OFF_STABLE_AFTER_SECONDS == default_value
+    finally:
+        config_file._reload_callbacks.remove(changes.append)
+    assert changes == [{'POWER_OFF_STABLE_AFTER_SECONDS'}] * 2
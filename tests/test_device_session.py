@@ -0,0 +1,50 @@
+import asyncio
+from ipaddress import IPv4Address
+
+from pyatv import conf, interface
+
+from benchmarks.fake_apple_tv import FakeAppleTV
+import config
+import device_session
+from device_session import DeviceSession
+
+
+def get_apple_tv_config(device_mac: str = 'AA:BB:CC:DD:EE:FF') -> conf.AppleTV:
+    return conf.AppleTV(IPv4Address('10.0.0.2'), 'Living Room',
+                        device_info=interface.DeviceInfo({interface.DeviceInfo.MAC: device_mac}))
+
+
+def test_reconnect_backoff_doubles_up_to_max_delay(monkeypatch):
+    monkeypatch.setattr(config, 'RECONNECT_INITIAL_DELAY_SECONDS', 1)
+    monkeypatch.setattr(config, 'RECONNECT_MAX_DELAY_SECONDS', 5)
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay: float, *args, **kwargs):
+        sleeps.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(device_session.asyncio, 'sleep', sleep)
+
+    connect_count = 0
+
+    async def connect(apple_tv: interface.BaseConfig, loop: asyncio.AbstractEventLoop, **kwargs) -> FakeAppleTV:
+        """Fail to connect 5 times, as if the device was unreachable, then connect to a fake Apple TV"""
+        nonlocal connect_count
+        connect_count += 1
+        if connect_count <= 5:
+            raise OSError('Host is unreachable')
+        return FakeAppleTV()
+
+    async def run() -> DeviceSession:
+        session = DeviceSession(get_apple_tv_config(), connect, listener_names=(), health_probe_enabled=False)
+        try:
+            await session.reconnect()
+        finally:
+            session.close()
+        return session
+
+    session = asyncio.run(run())
+    assert connect_count == 6
+    assert sleeps == [1, 2, 4, 5, 5, 5]
+    assert len(session.outages) == 1
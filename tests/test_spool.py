@@ -0,0 +1,46 @@
+import os
+
+from spool import ACK_BATCH_SIZE, Spool
+
+
+def read_spool_files(directory: str) -> bytes:
+    data = b''
+    for file_name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, file_name), 'rb') as openfile:
+            data += openfile.read()
+    return data
+
+
+def test_unacked_records_are_loaded_after_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    seqs = [spool.append({'url': 'https://example.com/{0:d}'.format(index)}) for index in range(ACK_BATCH_SIZE + 3)]
+    for seq in seqs[:ACK_BATCH_SIZE + 1]:
+        spool.ack(seq)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert spool.get_unacked() == [(seqs[-2], {'url': 'https://example.com/{0:d}'.format(ACK_BATCH_SIZE + 1)}),
+                                   (seqs[-1], {'url': 'https://example.com/{0:d}'.format(ACK_BATCH_SIZE + 2)})]
+    assert spool.append({'url': 'https://example.com/new'}) == seqs[-1] + 1
+    spool.close()
+
+
+def test_records_are_written_by_the_time_close_returns(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append({'url': 'https://example.com/written'})
+    spool.close()
+    assert b'https://example.com/written' in read_spool_files(str(tmp_path))
+
+
+def test_files_left_by_an_interrupted_compaction_are_deleted(tmp_path):
+    spool = Spool(str(tmp_path))
+    seq = spool.append({'url': 'https://example.com/kept'})
+    spool.close()
+    segment_file_name = next(file_name for file_name in os.listdir(tmp_path) if file_name.endswith('.seg'))
+    with open(os.path.join(tmp_path, segment_file_name + '.tmp'), 'wb') as temp_file:
+        temp_file.write(b'[1,{"url":"https://exa')
+
+    spool = Spool(str(tmp_path))
+    assert spool.get_unacked() == [(seq, {'url': 'https://example.com/kept'})]
+    spool.close()
+    assert not any(file_name.endswith('.tmp') for file_name in os.listdir(tmp_path))
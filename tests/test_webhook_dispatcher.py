@@ -0,0 +1,85 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import webhook_dispatcher
+from webhook_dispatcher import POST_FAILED, POST_REJECTED, POST_SENT, WebhookDispatcher
+
+
+async def send_to_stand_in(responses: list[web.Response], **kwargs) -> tuple[str, int, WebhookDispatcher]:
+    """Send one POST request through a WebhookDispatcher to a local stand-in for a webhook service, which replies with
+    responses in turn, and return the result, the number of requests it received, and the (closed) dispatcher"""
+    received = []
+
+    async def handle(request: web.Request) -> web.Response:
+        received.append(await request.json())
+        return responses[len(received) - 1]
+
+    app = web.Application()
+    app.router.add_post('/hook', handle)
+    async with TestServer(app) as server:
+        dispatcher = WebhookDispatcher(base_url=str(server.make_url('')), **kwargs)
+        try:
+            result = await dispatcher.send(str(server.make_url('/hook')), {'value1': 'on'})
+        finally:
+            await dispatcher.close()
+    assert all(json == {'value1': 'on'} for json in received)
+    return result, len(received), dispatcher
+
+
+def record_sleeps(monkeypatch) -> list[float]:
+    """Record the retry delays of WebhookDispatcher.send(), without waiting for them"""
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay: float, *args, **kwargs):
+        sleeps.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(webhook_dispatcher.asyncio, 'sleep', sleep)
+    return sleeps
+
+
+def test_retries_server_error_after_retry_after_seconds(monkeypatch):
+    sleeps = record_sleeps(monkeypatch)
+    responses = [web.Response(status=503, headers={'Retry-After': '7'}), web.Response(status=200)]
+    result, request_count, dispatcher = asyncio.run(send_to_stand_in(responses))
+    assert result == POST_SENT
+    assert request_count == 2
+    assert sleeps == [7]
+    assert (dispatcher.sent_count, dispatcher.retried_count, dispatcher.failed_count) == (1, 1, 0)
+
+
+def test_retry_after_is_capped_at_max_delay(monkeypatch):
+    sleeps = record_sleeps(monkeypatch)
+    responses = [web.Response(status=429, headers={'Retry-After': '3600'}),
+                 web.Response(status=429, headers={'Retry-After': 'Wed, 21 Oct 2099 07:28:00 GMT'}),
+                 web.Response(status=204)]
+    result, request_count, _ = asyncio.run(send_to_stand_in(responses, retry_max_delay_seconds=30))
+    assert result == POST_SENT
+    assert request_count == 3
+    assert sleeps == [30, 30]
+
+
+def test_retries_with_jittered_exponential_backoff_without_retry_after(monkeypatch):
+    sleeps = record_sleeps(monkeypatch)
+    responses = [web.Response(status=500) for _ in range(4)]
+    result, request_count, dispatcher = asyncio.run(send_to_stand_in(
+        responses, max_retries=3, retry_base_delay_seconds=1, retry_max_delay_seconds=3))
+    assert result == POST_FAILED
+    assert request_count == 4
+    # Each delay is between half and all of min(retry_max_delay_seconds, retry_base_delay_seconds * 2 ** attempt)
+    assert len(sleeps) == 3
+    for sleep, max_delay in zip(sleeps, [1, 2, 3]):
+        assert max_delay / 2 <= sleep <= max_delay
+    assert (dispatcher.sent_count, dispatcher.retried_count, dispatcher.failed_count) == (0, 3, 1)
+
+
+def test_client_error_is_rejected_without_retrying(monkeypatch):
+    sleeps = record_sleeps(monkeypatch)
+    responses = [web.Response(status=400, headers={'Retry-After': '1'})]
+    result, request_count, _ = asyncio.run(send_to_stand_in(responses))
+    assert result == POST_REJECTED
+    assert request_count == 1
+    assert sleeps == []
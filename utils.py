@@ -1,12 +1,14 @@
-import aiohttp
 import asyncio
 from datetime import datetime
-import json
-from os import path
+import platform
 from pyatv import scan, const, convert, interface
-import sys
+from signal import SIGINT, SIGTERM
+import time
+from typing import Iterable, Optional
 
 import config
+from log import flush_logs, get_logger
+from metrics import SCAN_SECONDS
 
 
 # The filename of the credentials JSON file, relative to the root path
@@ -16,17 +18,25 @@ CREDENTIALS_FILE_NAME: str = 'credentials.json'
 # The credentials JSON file key to store the last connected device MAC address
 CREDENTIALS_LAST_CONNECTED_KEY = '_last_connected'
 
+logger = get_logger()
 
-def get_log_prefix(include_time: bool = True, class_name: str = ""):
+
+def get_log_prefix(include_time: bool = True, class_name: str = "", device_name: str = ""):
     """Return log prefix string, plus 1 * ' ' for padding
 
+    Used to align interactive prompts with log lines. For logging itself, use log.get_logger()
+
     When include_time = True, return an ISO 8601 timestamp for the current time
 
     When include_time = False, return an equal-length padded string
+
+    When device_name is provided, it is appended to class_name, so that logs from multiple devices can be told apart
     """
     # isoformat() returns a str like 'YYYY-MM-DD HH:MM:SS', which has length of 19 characters
     timestamp = datetime.now().replace(
         microsecond=0).isoformat() if include_time else ' ' * 19
+    if device_name:
+        class_name = '{0:s} ({1:s})'.format(class_name, device_name)
     class_name_prefix = ' {0:s}:'.format(class_name) if class_name else ''
     return '{0:s}{1:s} '.format(timestamp, class_name_prefix)
 
@@ -47,23 +57,76 @@ def is_apple_tv(device: interface.BaseConfig):
     return device.device_info.operating_system == const.OperatingSystem.TvOS
 
 
-async def get_apple_tvs():
+class StartupProfile:
+    """Records how long each phase of startup took (e.g. imports, scan, connect), to report with main.py --profile-startup"""
+    start_time: float
+    phases: list[tuple[str, float]]
+
+    def __init__(self, start_time: float):
+        """start_time is the time.perf_counter() value when startup began, e.g. before importing other modules"""
+        self.start_time = start_time
+        self.phases = []
+        self._phase_start_time = start_time
+
+    def mark(self, phase_name: str):
+        """Record the time since the previous phase ended (or startup began) as phase_name"""
+        now = time.perf_counter()
+        self.phases.append((phase_name, now - self._phase_start_time))
+        self._phase_start_time = now
+
+    def log(self):
+        total_seconds = self._phase_start_time - self.start_time
+        logger.info('Startup took %.3fs: %s', total_seconds, ', '.join(
+            '{0:s} {1:.3f}s'.format(phase_name, seconds) for phase_name, seconds in self.phases))
+
+
+async def get_apple_tvs(device_macs: Optional[Iterable[str]] = None, exit_if_none: bool = True):
     """Scan for devices on network and returns a list of Apple TVs.
 
-    If there are none, print an error message and call exit(1).
+    When device_macs are provided and all of them have a last-known address in the discovery cache, first scan only those
+    addresses (unicast) with a short timeout, and fall back to a full network scan if any of them are not found there.
+
+    If there are none, log an error message and call exit(1), unless exit_if_none is False (e.g. when waiting for Apple TVs
+    to appear, see: ./presence.py).
     """
-    loop = asyncio.get_event_loop()
+    # Imported here to avoid a circular import, since discovery_cache imports utils
+    from discovery_cache import get_discovery_cache
 
-    print(f'{get_log_prefix()}Discovering devices on network...')
+    loop = asyncio.get_event_loop()
+    discovery_cache = get_discovery_cache()
+    start_time = time.perf_counter()
+
+    if device_macs:
+        device_macs = set(device_macs)
+        hosts = discovery_cache.get_hosts(device_macs)
+        if hosts:
+            logger.info('Discovering %d known device%s on network...',
+                        len(hosts), s_if_plural(len(hosts)))
+            devices = await scan(loop, timeout=config.DISCOVERY_CACHE_SCAN_TIMEOUT_SECONDS, hosts=hosts)
+            SCAN_SECONDS.observe(time.perf_counter() - start_time, 'unicast')
+            apple_tvs = [device for device in devices if is_apple_tv(device)]
+            if device_macs.issubset(apple_tv.device_info.mac for apple_tv in apple_tvs):
+                logger.info('Found %d known Apple TV%s in %.2fs', len(apple_tvs), s_if_plural(
+                    len(apple_tvs)), time.perf_counter() - start_time)
+                discovery_cache.update(apple_tvs)
+                return apple_tvs
+            logger.info(
+                'Not all known devices were found at their last-known addresses, so scanning the whole network...')
+
+    logger.info('Discovering devices on network...')
+    full_scan_start_time = time.perf_counter()
     devices = await scan(loop, timeout=config.SCAN_TIMEOUT_SECONDS)
+    SCAN_SECONDS.observe(time.perf_counter() - full_scan_start_time, 'full')
     apple_tvs = [device for device in devices if is_apple_tv(device)]
 
-    print(f'{get_log_prefix()}Found {len(devices)} device{s_if_plural(len(devices))}, including {len(apple_tvs)} Apple TV{s_if_plural(len(apple_tvs))}, on network')
+    logger.info('Found %d device%s, including %d Apple TV%s, on network in %.2fs', len(devices), s_if_plural(len(devices)),
+                len(apple_tvs), s_if_plural(len(apple_tvs)), time.perf_counter() - start_time)
 
-    if len(apple_tvs) == 0:
-        print(f'{get_log_prefix()}ERROR: No Apple TVs were found!', file=sys.stderr)
+    if len(apple_tvs) == 0 and exit_if_none:
+        logger.error('No Apple TVs were found!')
         exit(1)
 
+    discovery_cache.update(apple_tvs)
     return apple_tvs
 
 
@@ -89,67 +152,82 @@ def protocol_str_to_protocol(protocol_str: str):
 
 
 def read_credentials_json() -> dict:
-    """Read and return contents of credentials JSON file or {}"""
-    if path.exists(CREDENTIALS_FILE_NAME):
-        with open(CREDENTIALS_FILE_NAME, 'r') as openfile:
-            try:
-                credentials = json.load(openfile)
-                if credentials:
-                    return credentials
-            except:
-                pass
+    """Return contents of credentials JSON file or {}
 
-    return {}
+    Served from memory by the shared CredentialStore (see: ./credential_store.py)
+    """
+    # Imported here to avoid a circular import, since credential_store imports utils
+    from credential_store import get_credential_store
+    return get_credential_store().get_all()
 
 
 def write_credentials_json(credentials_json: dict):
     """Write to credentials JSON file, overwriting any existing contents"""
-    json_object = json.dumps(credentials_json, indent=2)
-    with open(CREDENTIALS_FILE_NAME, 'w') as outfile:
-        outfile.write(json_object)
+    from credential_store import get_credential_store
+    get_credential_store().replace_all(credentials_json)
 
 
 def get_credentials(device_mac: str):
     """Return credentials for provided device_mac in credentials JSON file or None if not saved"""
-    credentials = read_credentials_json()
-    return credentials[device_mac] if device_mac in credentials else None
+    from credential_store import get_credential_store
+    return get_credential_store().get_credentials(device_mac)
 
 
-def save_credential(device_mac: str, protocol: str, value: str):
-    """Write new or updated credentials for provided device_mac to credentials JSON file"""
-    credentials = read_credentials_json()
+def get_paired_mac_adrs() -> list[str]:
+    """Return MAC addresses of all devices with credentials in credentials JSON file"""
+    from credential_store import get_credential_store
+    return get_credential_store().get_paired_mac_adrs()
 
-    # Add or update credentials[device_mac]
-    cred_entry_for_device = credentials[device_mac] if device_mac in credentials else {
-    }
-    cred_entry_for_device[protocol] = value
-    credentials[device_mac] = cred_entry_for_device
 
-    write_credentials_json(credentials)
+def save_credential(device_mac: str, protocol: str, value: str):
+    """Write new or updated credentials for provided device_mac to credentials JSON file"""
+    from credential_store import get_credential_store
+    get_credential_store().save_credential(device_mac, protocol, value)
 
 
 def save_last_connected(device_mac: str):
     """Write new or updated device_mac value to "_last_connected" entry to credentials JSON file"""
-    credentials = read_credentials_json()
-    credentials[CREDENTIALS_LAST_CONNECTED_KEY] = device_mac
-    write_credentials_json(credentials)
+    from credential_store import get_credential_store
+    get_credential_store().save_last_connected(device_mac)
 
 
 async def publish_event_to_ifttt_webhooks(event_name: str):
-    """Send POST request with the provided event_name to IFTTT for Webhooks integrations (see: https://ifttt.com/maker_webhooks)"""
-    print(f'{get_log_prefix()}Sending POST request to IFTTT for event: "{event_name}"')
+    """Queue POST request with the provided event_name to IFTTT for Webhooks integrations (see: https://ifttt.com/maker_webhooks)
+
+    Requests are sent, and retried on failure, by the shared WebhookDispatcher (see: ./webhook_dispatcher.py)
+    """
+    # Imported here to avoid a circular import, since webhook_dispatcher imports utils
+    from webhook_dispatcher import get_webhook_dispatcher
+
+    logger.info('Sending POST request to IFTTT for event: "%s"', event_name)
 
     if not config.IFTTT_API_KEY:
-        print(f'{get_log_prefix(False)}WARNING: Skipping sending POST request to IFTTT because IFTTT_API_KEY was not specified in config.py!', file=sys.stderr)
+        logger.warning(
+            'Skipping sending POST request to IFTTT because IFTTT_API_KEY was not specified in config.py!')
         return
 
-    request_url = 'https://maker.ifttt.com/trigger/{0:s}/with/key/{1:s}'.format(
-        event_name, config.IFTTT_API_KEY)
+    get_webhook_dispatcher().publish_ifttt_event(event_name)
+
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(request_url) as response:
-                print(
-                    f'{get_log_prefix()}Received response from IFTTT with status code: {response.status}')
-    except Exception as ex:
-        print(f'{get_log_prefix()}ERROR: Failed when sending POST request to IFTTT! Details:\n{ex}', sys.stderr)
+async def wait_for_exit_request():
+    """Wait until the user asks to exit
+
+    On Windows, wait for "exit" to be typed, since signal handlers are not supported there. Otherwise, wait for SIGINT or SIGTERM.
+    """
+    if platform.system() == 'Windows':
+        from aioconsole import ainput
+        should_exit: bool = False
+        include_time: bool = False
+        while not should_exit:
+            flush_logs()
+            user_input: str = await ainput(f'{get_log_prefix(include_time)}Type "exit" to close connection and exit\n')
+            include_time = True
+            should_exit = user_input.strip() == 'exit'
+    else:
+        logger.info('Press Ctrl+C to close connection and exit')
+        # Attach signal handlers to trigger exit event when killed or terminated
+        loop = asyncio.get_running_loop()
+        exit_event = asyncio.Event()
+        for signal in [SIGINT, SIGTERM]:
+            loop.add_signal_handler(signal, exit_event.set)
+        await exit_event.wait()
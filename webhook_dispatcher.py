@@ -0,0 +1,347 @@
+import aiohttp
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import time
+from typing import Optional
+
+import config
+from config_file import on_config_reload
+from log import get_logger
+from metrics import Gauge, WEBHOOK_DROPPED, WEBHOOK_FAILURES, WEBHOOK_REQUEST_SECONDS, WEBHOOK_REQUESTS, WEBHOOK_RETRIES
+from spool import Spool
+from utils import s_if_plural
+
+
+# The base URL for IFTTT Webhooks integrations (see: https://ifttt.com/maker_webhooks)
+IFTTT_WEBHOOKS_BASE_URL: str = 'https://maker.ifttt.com'
+
+# The number of most recent request latencies kept for reporting percentiles
+LATENCY_SAMPLE_SIZE: int = 1000
+
+# Results of sending a POST request
+POST_SENT: str = 'sent'
+POST_REJECTED: str = 'rejected'  # A client error (other than 429) which would not succeed if sent again
+POST_FAILED: str = 'failed'  # Still failing after every retry, e.g. because the network is down
+
+logger = get_logger()
+
+
+def get_retry_after_seconds(response: aiohttp.ClientResponse) -> Optional[float]:
+    """Return the number of seconds requested by the response's Retry-After header, or None if not present or invalid
+
+    Retry-After may either be a number of seconds or an HTTP date (see: https://httpwg.org/specs/rfc9110.html#field.retry-after)
+    """
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_percentile(sorted_values: list[float], percentile: float) -> float:
+    """Return the nearest-rank percentile (0-100) of the provided sorted values, or 0.0 if empty"""
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1,
+              max(0, int(round(percentile / 100 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+class WebhookDispatcher:
+    """Long-lived webhook POST request dispatcher
+
+    Requests are added to a bounded queue and sent by a fixed number of workers sharing one pooled aiohttp.ClientSession,
+    so TCP and TLS connections are reused between events. Failed requests are retried with jittered exponential backoff,
+    honoring any Retry-After header.
+
+    With a spool, each request is written to it before being queued, and acknowledged once sent (or rejected), so that
+    requests which still failed after every retry, did not fit in the queue, or were still queued when closing are sent
+    later: every replay_interval_seconds, and after a restart.
+
+    NOTE: close() must be awaited when finished"""
+    base_url: str
+    max_concurrent_requests: int
+    max_retries: int
+    request_timeout_seconds: float
+    retry_base_delay_seconds: float
+    retry_max_delay_seconds: float
+
+    sent_count: int = 0
+    failed_count: int = 0
+    retried_count: int = 0
+    dropped_count: int = 0
+
+    def __init__(self, base_url: str = IFTTT_WEBHOOKS_BASE_URL,
+                 max_concurrent_requests: int = config.IFTTT_MAX_CONCURRENT_REQUESTS,
+                 queue_size: int = config.IFTTT_QUEUE_SIZE,
+                 max_retries: int = config.IFTTT_MAX_RETRIES,
+                 request_timeout_seconds: float = config.IFTTT_REQUEST_TIMEOUT_SECONDS,
+                 retry_base_delay_seconds: float = 0.5,
+                 retry_max_delay_seconds: float = 60,
+                 spool: Optional[Spool] = None,
+                 replay_interval_seconds: float = config.SPOOL_REPLAY_INTERVAL_SECONDS):
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        self.request_timeout_seconds = request_timeout_seconds
+        self.retry_base_delay_seconds = retry_base_delay_seconds
+        self.retry_max_delay_seconds = retry_max_delay_seconds
+        self.spool = spool
+        self.replay_interval_seconds = replay_interval_seconds
+        self.latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
+        self._queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._workers: list[asyncio.Task] = []
+        self._replay_task: Optional[asyncio.Task] = None
+        # Sequence numbers of spooled requests which are queued or being sent
+        self._queued_seqs: set[int] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        """Create the pooled session and start the workers, if not already started (requires a running event loop)"""
+        if self._session:
+            return
+        self._queue = asyncio.Queue(self._queue_size)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_concurrent_requests),
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout_seconds))
+        self._workers = [asyncio.ensure_future(self._worker())
+                         for _ in range(self.max_concurrent_requests)]
+        if self.spool:
+            self._replay_task = asyncio.ensure_future(self._replay())
+
+    def enqueue(self, url: str, json: Optional[dict] = None) -> bool:
+        """Add a POST request for the provided url to the queue, returning False if it was dropped because the queue is full"""
+        return self._enqueue(url, json, {'url': url, 'json': json})
+
+    def _enqueue(self, url: str, json: Optional[dict], record: dict) -> bool:
+        """Add a POST request to the queue, spooling record (see: get_spooled_url()) first if there is a spool"""
+        self.start()
+        seq = self.spool.append(record) if self.spool else None
+        try:
+            self._queue.put_nowait((url, json, seq))
+            if seq is not None:
+                self._queued_seqs.add(seq)
+            return True
+        except asyncio.QueueFull:
+            if seq is not None:
+                logger.warning('Webhook queue is full (%d pending), leaving POST request in the spool to send later',
+                               self._queue.maxsize)
+                return True
+            self.dropped_count += 1
+            WEBHOOK_DROPPED.inc()
+            logger.error(
+                'Dropping POST request because the webhook queue is full (%d pending)!', self._queue.maxsize)
+            return False
+
+    def get_ifttt_event_url(self, event_name: str) -> str:
+        return '{0:s}/trigger/{1:s}/with/key/{2:s}'.format(self.base_url, event_name, config.IFTTT_API_KEY)
+
+    def publish_ifttt_event(self, event_name: str, json: Optional[dict] = None) -> bool:
+        """Add a POST request with the provided event_name for IFTTT Webhooks integrations to the queue"""
+        # Spooled by event name, so that the API key in its URL is never written to disk
+        return self._enqueue(self.get_ifttt_event_url(event_name), json, {'ifttt_event_name': event_name, 'json': json})
+
+    def get_spooled_url(self, record: dict) -> str:
+        """Return the URL of a spooled POST request, rebuilding those of IFTTT events with the current API key"""
+        if 'ifttt_event_name' in record:
+            return self.get_ifttt_event_url(record['ifttt_event_name'])
+        return record['url']
+
+    def get_retry_delay_seconds(self, attempt: int) -> float:
+        """Return a jittered exponential backoff delay for the provided attempt number (starting from 0)"""
+        max_delay = min(self.retry_max_delay_seconds,
+                        self.retry_base_delay_seconds * 2 ** attempt)
+        return random.uniform(max_delay / 2, max_delay)
+
+    async def post(self, url: str, json: Optional[dict] = None) -> bool:
+        """Send a POST request to the provided url, retrying on failure, and return whether it eventually succeeded"""
+        return await self.send(url, json) == POST_SENT
+
+    async def send(self, url: str, json: Optional[dict] = None) -> str:
+        """Send a POST request to the provided url, retrying on failure, and return POST_SENT, POST_REJECTED, or POST_FAILED"""
+        self.start()
+        result = POST_FAILED
+        for attempt in range(self.max_retries + 1):
+            retry_delay = self.get_retry_delay_seconds(attempt)
+            start_time = time.perf_counter()
+            try:
+                async with self._session.post(url, json=json,
+                                              timeout=aiohttp.ClientTimeout(total=self.request_timeout_seconds)) as response:
+                    latency = time.perf_counter() - start_time
+                    self.latencies.append(latency)
+                    WEBHOOK_REQUESTS.inc(str(response.status))
+                    WEBHOOK_REQUEST_SECONDS.observe(
+                        latency, str(response.status))
+                    logger.info(
+                        'Received response from webhook with status code: %d', response.status)
+                    if response.status < 400:
+                        self.sent_count += 1
+                        return POST_SENT
+                    if response.status != 429 and response.status < 500:
+                        # Other client errors will not succeed when retried
+                        result = POST_REJECTED
+                        break
+                    retry_after = get_retry_after_seconds(response)
+                    if retry_after is not None:
+                        retry_delay = min(
+                            retry_after, self.retry_max_delay_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                latency = time.perf_counter() - start_time
+                self.latencies.append(latency)
+                WEBHOOK_REQUESTS.inc('error')
+                WEBHOOK_REQUEST_SECONDS.observe(latency, 'error')
+                logger.error(
+                    'Failed when sending POST request to webhook! Details: %r', ex)
+
+            if attempt < self.max_retries:
+                self.retried_count += 1
+                WEBHOOK_RETRIES.inc()
+                logger.info('Retrying POST request in %.1fs (%d of %d)...',
+                            retry_delay, attempt + 1, self.max_retries)
+                await asyncio.sleep(retry_delay)
+
+        self.failed_count += 1
+        WEBHOOK_FAILURES.inc()
+        logger.error('Giving up on POST request to webhook!')
+        return result
+
+    async def _worker(self):
+        while True:
+            url, json, seq = await self._queue.get()
+            try:
+                result = await self.send(url, json)
+                if seq is not None:
+                    self._queued_seqs.discard(seq)
+                    if result != POST_FAILED:
+                        self.spool.ack(seq)
+            finally:
+                self._queue.task_done()
+
+    def replay_spooled(self) -> int:
+        """Queue spooled requests which are not already queued (left from a previous run, or which failed), oldest first,
+        and return how many were queued"""
+        self.start()
+        self.spool.flush_acks()
+        replayed_count = 0
+        for seq, record in self.spool.get_unacked():
+            if seq in self._queued_seqs:
+                continue
+            try:
+                self._queue.put_nowait((self.get_spooled_url(record), record.get('json'), seq))
+            except asyncio.QueueFull:
+                break
+            self._queued_seqs.add(seq)
+            replayed_count += 1
+        if replayed_count:
+            logger.info('Replaying %d spooled POST request%s',
+                        replayed_count, s_if_plural(replayed_count))
+        return replayed_count
+
+    async def _replay(self):
+        while True:
+            self.replay_spooled()
+            await asyncio.sleep(self.replay_interval_seconds)
+
+    async def join(self):
+        """Wait until every queued request has been sent or given up on"""
+        if self._queue:
+            await self._queue.join()
+
+    def get_stats(self) -> dict:
+        """Return queue depth, request counts, and per-request latency percentiles (in seconds)"""
+        sorted_latencies = sorted(self.latencies)
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent_count,
+            'failed': self.failed_count,
+            'retried': self.retried_count,
+            'dropped': self.dropped_count,
+            'spooled': self.spool.unacked_count if self.spool else 0,
+            'latency_p50': get_percentile(sorted_latencies, 50),
+            'latency_p95': get_percentile(sorted_latencies, 95),
+            'latency_max': sorted_latencies[-1] if sorted_latencies else 0.0,
+        }
+
+    async def close(self, timeout: float = 5):
+        """Wait up to timeout seconds for queued requests to be sent, then stop the workers and close the session and spool"""
+        if not self._session:
+            if self.spool:
+                self.spool.close()
+            return
+        if self._replay_task:
+            self._replay_task.cancel()
+            self._replay_task = None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Closing webhook dispatcher with %d POST request%s still queued!',
+                           self.queue_depth, s_if_plural(self.queue_depth))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await self._session.close()
+        self._session = None
+        self._workers = []
+        self._queued_seqs.clear()
+        if self.spool:
+            # Requests still queued were not acknowledged, so they are sent after the next start
+            self.spool.close()
+
+
+_webhook_dispatcher: Optional[WebhookDispatcher] = None
+
+WEBHOOK_QUEUE_DEPTH = Gauge('atv_webhook_queue_depth', 'Webhook POST requests waiting to be sent',
+                            lambda: _webhook_dispatcher.queue_depth if _webhook_dispatcher else 0)
+SPOOL_BYTES = Gauge('atv_spool_bytes', 'Size of the webhook spool segment files',
+                    lambda: _webhook_dispatcher.spool.size if _webhook_dispatcher and _webhook_dispatcher.spool else 0)
+
+
+def get_webhook_dispatcher() -> WebhookDispatcher:
+    """Return the shared WebhookDispatcher, creating it if needed"""
+    global _webhook_dispatcher
+    if _webhook_dispatcher is None:
+        _webhook_dispatcher = WebhookDispatcher(
+            spool=Spool() if config.SPOOL_DIRECTORY else None)
+    return _webhook_dispatcher
+
+
+def apply_config_to_webhook_dispatcher(changed_names: set[str]):
+    """Apply reloaded settings to the shared WebhookDispatcher, if it was created"""
+    if _webhook_dispatcher is not None:
+        _webhook_dispatcher.max_retries = config.IFTTT_MAX_RETRIES
+        _webhook_dispatcher.request_timeout_seconds = config.IFTTT_REQUEST_TIMEOUT_SECONDS
+
+
+on_config_reload(apply_config_to_webhook_dispatcher)
+
+
+def start_webhook_dispatcher() -> WebhookDispatcher:
+    """Start the shared WebhookDispatcher, so that any requests spooled by a previous run are sent right away"""
+    webhook_dispatcher = get_webhook_dispatcher()
+    webhook_dispatcher.start()
+    return webhook_dispatcher
+
+
+async def close_webhook_dispatcher():
+    """Close the shared WebhookDispatcher, if it was created"""
+    global _webhook_dispatcher
+    if _webhook_dispatcher is not None:
+        await _webhook_dispatcher.close()
+        _webhook_dispatcher = None